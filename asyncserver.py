@@ -0,0 +1,312 @@
+import io
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import threading
+import argparse
+from functools import wraps
+from urllib.parse import unquote_to_bytes
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, ClientSession, TCPConnector
+from multidict import CIMultiDict
+
+import metrics
+import model
+import queueestimate
+import webserver
+from webserver import GZIP_MIN_BYTES, cluster_names, queue_data, completion_data, json_bytes
+
+# concurrent connections of the shared elastic search client, all clusters together
+ES_CONNECTIONS = int(os.environ.get('ETC_ES_CONNECTIONS', 32))
+
+# threads running SQLite reads (and the process scan of /update) for the async routes
+DB_THREADS = int(os.environ.get('ETC_DB_THREADS', 4))
+
+# threads running the other routes of the flask app
+WSGI_THREADS = int(os.environ.get('ETC_WSGI_THREADS', 16))
+
+# /queuetime/stream clients, each holds a thread while it waits for the next event
+STREAM_CLIENTS = int(os.environ.get('ETC_STREAM_CLIENTS', 256))
+
+
+async def run_db(app, func, *args, **kwargs):
+    """ Run a blocking call (SQLite reads) on the bounded database pool """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app['db_pool'], lambda: func(*args, **kwargs))
+
+_in_flight = {}
+
+async def coalesce(group, key, compute):
+    '''
+    Await the identical computation in flight or start one, like
+    webserver.coalesced. The computation is shielded so a client that
+    disconnects does not cancel it for the others.
+    '''
+    task = _in_flight.get(key)
+    if task is None:
+        metrics.coalesced_requests.inc(group=group, role="leader")
+        task = _in_flight[key] = asyncio.ensure_future(compute())
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    else:
+        metrics.coalesced_requests.inc(group=group, role="waiter")
+    return await asyncio.shield(task)
+
+def json_response(request, data):
+    '''
+    JSON response with the conditional GET of webserver.cached for routes
+    without data sources: the ETag is a hash of the body and clients must
+    revalidate. Large bodies are gzipped for clients that accept it.
+    '''
+    body = json_bytes(data)
+    etag = hashlib.sha1(body).hexdigest()[:20]
+    headers = {'ETag': f'W/"{etag}"', 'Cache-Control': 'no-cache'}
+    not_modified = any(tag.value in (etag, '*') for tag in request.if_none_match or ())
+    metrics.cache_lookup('http_etag', not_modified)
+    if not_modified:
+        return web.Response(status=304, headers=headers)
+
+    response = web.Response(body=body, content_type='application/json', headers=headers)
+    if len(body) >= GZIP_MIN_BYTES:
+        response.enable_compression()
+    return response
+
+def async_route(route):
+    '''
+    Time an async route like webserver.record_latency and count the requests
+    in flight. Profiled requests (?profile=1) go to the flask route instead,
+    the profiler measures one thread.
+    '''
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            if request.query.get('profile', request.headers.get('X-Profile')) not in (None, '', '0'):
+                return await wsgi(request)
+
+            start = time.perf_counter()
+            metrics.async_requests.inc(route=route)
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            finally:
+                metrics.async_requests.dec(route=route)
+                metrics.http_request_duration.observe(time.perf_counter() - start,
+                    route=route, method=request.method, status=status)
+        return wrapper
+    return decorator
+
+def unknown_source(source):
+    if source is not None and source not in cluster_names():
+        return web.Response(text=f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n',
+                            content_type='text/html')
+    return None
+
+async def queue_totals(app, size, source):
+    ''' Totals of the shared queue estimate, updated from a queue awaited on the shared client '''
+    estimate = queueestimate.estimate(size, source)
+    jobs = await model.get_queue_async(app['es'], size=size, source=source)
+    if jobs is None:
+        return 0, 0, 0
+    # new job types read their run time statistics from the database
+    await run_db(app, estimate.update, jobs)
+    return estimate.totals()
+
+@async_route('/queuetime')
+async def queue_times(request):
+    '''
+     """ /queuetime of webserver.py, the queue is awaited instead of holding a thread
+
+        Example:
+            curl "localhost:5000/queuetime?size=4444&nodes=5"
+    '''
+    size = int(request.query.get('size', 4444))
+    nodes = float(request.query.get('nodes', 1))
+    source = request.query.get('source')
+    error = unknown_source(source)
+    if error is not None:
+        return error
+
+    qmin, qmax, njobs = await coalesce('/queuetime', ('/queuetime', size, source),
+                                       lambda: queue_totals(request.app, size, source))
+    return json_response(request, queue_data(qmin/nodes, qmax/nodes, njobs, source))
+
+@async_route('/completiontime')
+async def completion_times(request):
+    '''
+     """ /completiontime of webserver.py, the running jobs are awaited instead of holding a thread
+
+        Example:
+            curl "localhost:5000/completiontime?size=10000&instance=*&jobs=0"
+    '''
+    size = int(request.query.get('size', 10000))
+    instance = request.query.get('instance', '*')
+    per_job = request.query.get('jobs', '1') != '0'
+    source = request.query.get('source')
+    error = unknown_source(source)
+    if error is not None:
+        return error
+
+    async def compute():
+        sjobs = await model.get_jobs_started_async(request.app['es'], size=size, source=source)
+        return await run_db(request.app, model.estimate_time_to_complete, size=size, instance=instance,
+                            sjobs=sjobs or [], source=source)
+
+    estimate = await coalesce('/completiontime', ('/completiontime', size, instance, source), compute)
+    return json_response(request, completion_data(estimate, source, per_job))
+
+@async_route('/update')
+async def update(request):
+    '''
+     """ /update of webserver.py, the process scan runs on the database pool
+
+        Example:
+            curl "localhost:5000/update"
+    '''
+    jdata = await run_db(request.app, webserver.launch_update)
+    return web.Response(body=json_bytes(jdata), content_type='application/json')
+
+def wsgi_environ(request, body):
+    ''' WSGI environ of an aiohttp request '''
+    path, _, query = request.raw_path.partition('?')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': request.url.host or 'localhost',
+        'SERVER_PORT': str(request.url.port or 80),
+        'SERVER_PROTOCOL': 'HTTP/%d.%d' % request.version,
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name in set(request.headers.keys()):
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            environ[key] = ', '.join(request.headers.getall(name))
+    return environ
+
+async def wsgi(request, pool='wsgi_pool'):
+    '''
+    Serve a request with the flask app of webserver.py on a thread pool, so
+    its routes keep their hooks (caching, coalescing, profiling, gzip). The
+    body is written chunk by chunk, streamed responses included.
+    '''
+    loop = asyncio.get_running_loop()
+    executor = request.app[pool]
+    environ = wsgi_environ(request, await request.read())
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'], started['headers'] = status, headers
+        return lambda data: None
+
+    # the next chunk and the close of a stream must not run at the same time
+    lock = threading.Lock()
+
+    def begin():
+        result = webserver.app(environ, start_response)
+        chunks = iter(result)
+        return result, chunks, next(chunks, None)
+
+    def read(chunks):
+        with lock:
+            return next(chunks, None)
+
+    def close(result):
+        with lock:
+            if hasattr(result, 'close'):
+                result.close()
+
+    result, chunks, chunk = await loop.run_in_executor(executor, begin)
+    response = None
+    try:
+        code, _, reason = started['status'].partition(' ')
+        response = web.StreamResponse(status=int(code), reason=reason or None, headers=CIMultiDict(started['headers']))
+        await response.prepare(request)
+        while chunk is not None:
+            if chunk:
+                await response.write(chunk)
+            chunk = await loop.run_in_executor(executor, read, chunks)
+        await response.write_eof()
+        return response
+    except ConnectionResetError:
+        # the client left, e.g. a closed /queuetime/stream
+        return response
+    finally:
+        # ends streams (e.g. unsubscribes from the queue producer) when the client leaves
+        await loop.run_in_executor(executor, close, result)
+
+async def stream(request):
+    return await wsgi(request, pool='stream_pool')
+
+async def open_pools(app):
+    app['es'] = ClientSession(connector=TCPConnector(limit=app['es_connections']))
+    app['db_pool'] = ThreadPoolExecutor(max_workers=app['db_threads'], thread_name_prefix='db')
+    app['wsgi_pool'] = ThreadPoolExecutor(max_workers=app['wsgi_threads'], thread_name_prefix='wsgi')
+    app['stream_pool'] = ThreadPoolExecutor(max_workers=STREAM_CLIENTS, thread_name_prefix='stream')
+
+async def close_pools(app):
+    await app['es'].close()
+    for pool in ('db_pool', 'wsgi_pool', 'stream_pool'):
+        app[pool].shutdown(wait=False)
+
+def make_app(es_connections=ES_CONNECTIONS, db_threads=DB_THREADS, wsgi_threads=WSGI_THREADS):
+    """ aiohttp application serving the elastic search bound routes asynchronously
+
+    /queuetime, /completiontime and /update await elastic search on one
+    pooled client (es_connections connections) and run their SQLite reads on
+    a pool of db_threads threads, so hundreds of slow queue requests wait
+    without holding a thread each. Every other route is served by the flask
+    app of webserver.py on its own pool of wsgi_threads threads, fast
+    /runtime calls never queue behind the queue requests.
+
+    Example:
+        web.run_app(make_app(), port=5000)
+    """
+    app = web.Application()
+    app['es_connections'] = es_connections
+    app['db_threads'] = db_threads
+    app['wsgi_threads'] = wsgi_threads
+    app.on_startup.append(open_pools)
+    app.on_cleanup.append(close_pools)
+    app.router.add_get('/queuetime', queue_times)
+    app.router.add_get('/completiontime', completion_times)
+    app.router.add_get('/update', update)
+    app.router.add_get('/queuetime/stream', stream)
+    app.router.add_route('*', '/{path:.*}', wsgi)
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Web server with asynchronous elastic search routes')
+    parser.add_argument('--host', default='0.0.0.0', type=str, help='Hostname or IP address')
+    parser.add_argument('--port', default=5000, type=int, help='Server port')
+    parser.add_argument('--es_connections', default=ES_CONNECTIONS, type=int, help='Connections of the elastic search client')
+    parser.add_argument('--db_threads', default=DB_THREADS, type=int, help='Threads reading the database for the async routes')
+    parser.add_argument('--wsgi_threads', default=WSGI_THREADS, type=int, help='Threads serving the other routes')
+    parser.add_argument('--profiling', action='store_true', default=False, help='Allow per-request profiling with ?profile=1')
+    parser.add_argument('--cadence', default=webserver.app.config['CADENCE'], type=float,
+                        help='Ingest cadence in days, max-age of cached estimates')
+    parser.add_argument('--warmup', default=webserver.WARMUP_KEYS, type=int,
+                        help='Job keys to preload before /ready reports healthy, 0 to skip')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    webserver.app.config['PROFILING'] = webserver.app.config['PROFILING'] or args.profiling
+    webserver.app.config['CADENCE'] = args.cadence
+    webserver.warmup.start(args.warmup)
+    web.run_app(make_app(args.es_connections, args.db_threads, args.wsgi_threads), host=args.host, port=args.port)
@@ -0,0 +1,328 @@
+import json
+import time
+import argparse
+import numpy as np
+
+from sql_database import get_database
+from groupstats import weighted_runtime_stats
+from rollup import NBINS, MIN_RUNTIME, BINS_PER_DECADE, bin_index, bin_centers
+
+# rows of cumulative histograms computed at once, bounds memory to CHUNK x NBINS
+CHUNK = 4096
+
+# what is predicted: value column, key columns and the prediction rule
+TARGETS = {
+    'run_time': ("run_time", ("job_type", "instance"), "runtime"),
+    'queue_time': ("queue_time", ("job_type", "queue"), "sketch"),
+}
+
+
+def _value_at(counts, cdf, k):
+    # k-th smallest of the expanded values (0-based), the jobs of a bin spread
+    # log-uniformly over it like in waittime.sketch_quantiles
+    idx = np.minimum((cdf <= k[:, None]).sum(axis=1), NBINS - 1)
+    rows = np.arange(len(idx))
+    below = cdf[rows, idx] - counts[rows, idx]
+    frac = np.clip((k - below + 0.5) / np.maximum(counts[rows, idx], 1), 0, 1)
+    return MIN_RUNTIME * 10**((idx + frac) / BINS_PER_DECADE)
+
+def _quantile(counts, cdf, total, q):
+    # percentile of the expanded values, interpolated between neighbours like weighted_percentile
+    pos = q/100. * np.maximum(total - 1, 0)
+    lower = np.floor(pos)
+    low, high = _value_at(counts, cdf, lower), _value_at(counts, cdf, np.minimum(lower + 1, np.maximum(total - 1, 0)))
+    return low + (high - low) * (pos - lower)
+
+def _moments(counts, centers):
+    total = counts.sum(axis=1)
+    n = np.maximum(total, 1)
+    mean = counts @ centers / n
+    var = counts @ centers**2 / n - mean**2
+    return mean, np.sqrt(np.maximum(var, 0))
+
+def binned_runtime_stats(counts):
+    """ groupstats.weighted_runtime_stats (the runtime_prediction model) of many histograms at once
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Jobs per rollup bin, one histogram per row
+
+    Returns
+    -------
+    run_avg, run_std, run_low, run_high : np.ndarray
+        Median, stdev, 1st and 99th percentile of every row (days), the
+        outliers above the 90th percentile masked from 10 jobs on
+    """
+    centers = bin_centers()
+    total = counts.sum(axis=1)
+    cdf = counts.cumsum(axis=1)
+
+    # from 10 jobs on the values at or above the 90th percentile are masked
+    p90 = _quantile(counts, cdf, total, 90)
+    masked = np.where((centers[None, :] < p90[:, None]) | (total[:, None] < 10), counts, 0)
+    keep = masked.sum(axis=1) > 0
+    counts = np.where(keep[:, None], masked, counts)
+    total = counts.sum(axis=1)
+    cdf = counts.cumsum(axis=1)
+
+    run_avg = _quantile(counts, cdf, total, 50)
+    _, run_std = _moments(counts, centers)
+    run_low = _quantile(counts, cdf, total, 1)
+    run_high = _quantile(counts, cdf, total, 99)
+
+    # a single job is its own spread
+    run_std = np.where(total == 1, run_avg, run_std)
+
+    # below 10 jobs the interval is the range of the history
+    few = total < 10
+    if few.any():
+        nonzero = counts[few] > 0
+        run_low[few] = centers[np.argmax(nonzero, axis=1)]
+        run_high[few] = centers[NBINS - 1 - np.argmax(nonzero[:, ::-1], axis=1)]
+    return run_avg, run_std, run_low, run_high
+
+def binned_sketch_stats(counts):
+    """ Median, stdev, 1st and 99th percentile of many histograms, like waittime.sketch_quantiles """
+    total = counts.sum(axis=1)
+    cdf = counts.cumsum(axis=1)
+    _, std = _moments(counts, bin_centers())
+    return _quantile(counts, cdf, total, 50), std, _quantile(counts, cdf, total, 1), _quantile(counts, cdf, total, 99)
+
+PREDICTORS = {'runtime': binned_runtime_stats, 'sketch': binned_sketch_stats}
+
+def expanding_predictions(bins, history, predictor, chunk=CHUNK):
+    """ Predict every job of one key from the jobs before it
+
+    Parameters
+    ----------
+    bins : np.ndarray
+        Rollup bin of the value of each job, in timestamp order
+
+    history : np.ndarray
+        Number of jobs strictly before each job (jobs with the same
+        timestamp are not before each other), non-decreasing
+
+    predictor : callable
+        Maps a matrix of histograms to arrays (mean, stdev, low, high)
+
+    Returns
+    -------
+    predictions : np.ndarray
+        (n, 4) mean, stdev, low and high of every job, NaN without history
+    """
+    n = len(bins)
+    out = np.full((n, 4), np.nan)
+    onehot = np.eye(NBINS, dtype=np.int32)
+    for start in range(0, n, chunk):
+        end = min(start + chunk, n)
+        base = history[start]
+        # histogram of the jobs before the chunk's first history, then one row per job after it
+        counts = np.bincount(bins[:base], minlength=NBINS).astype(np.int32)
+        cumulative = np.vstack([counts, counts + np.cumsum(onehot[bins[base:history[end-1]]], axis=0)])
+        rows = history[start:end] - base
+        known = history[start:end] > 0
+        if known.any():
+            out[start:end][known] = np.column_stack(predictor(cumulative[rows[known]]))
+    return out
+
+def load_jobs(sqldb, target='run_time', source=None):
+    """ Keys, values and timestamps of the jobs to replay, sorted by key then timestamp
+
+    Returns
+    -------
+    data : dict
+        Arrays key (joined key columns), value (days), timestamp (str)
+    """
+    value, keys, _ = TARGETS[target]
+    condition, values = f"{value} >= ?", [0]
+    if source is not None:
+        condition += " AND source = ?"
+        values.append(source)
+
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    data = db.column_query("job_times", list(keys) + [value, "timestamp"], condition, values)
+    db.close()
+
+    key = data[keys[0]].astype(str)
+    for column in keys[1:]:
+        key = np.char.add(np.char.add(key, "\x1f"), data[column].astype(str))
+    timestamp = data["timestamp"].astype(str)
+    order = np.lexsort((timestamp, key))
+    return {'key': key[order], 'value': data[value].astype(float)[order], 'timestamp': timestamp[order]}
+
+def backtest(data, predictor='runtime', start=None, chunk=CHUNK):
+    """ Replay the jobs in timestamp order, predicting each from the jobs of its key before it
+
+    Parameters
+    ----------
+    data : dict
+        Output of load_jobs
+
+    predictor : str
+        Prediction rule, see PREDICTORS
+
+    start : str
+        Only score jobs at or after this timestamp, older jobs are history only
+
+    Returns
+    -------
+    scored : dict
+        Arrays key, actual, mean, low and high of every scored job with history
+    """
+    keys, values, timestamps = data['key'], data['value'], data['timestamp']
+    func = PREDICTORS[predictor]
+    bins = bin_index(values)
+    predictions = np.full((len(values), 4), np.nan)
+
+    bounds = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1], True])
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        ts = timestamps[lo:hi]
+        # jobs strictly before: the position of the first job with the same timestamp
+        history = np.searchsorted(ts, ts, side='left')
+        predictions[lo:hi] = expanding_predictions(bins[lo:hi], history, func, chunk=chunk)
+
+    scored = ~np.isnan(predictions[:, 0])
+    if start is not None:
+        scored &= timestamps >= start
+    return {'key': keys[scored], 'actual': values[scored], 'mean': predictions[scored, 0],
+            'low': predictions[scored, 2], 'high': predictions[scored, 3]}
+
+def accuracy(scored, by_key=True):
+    """ MAPE of the mean and coverage of the [low, high] interval, overall and per key
+
+    Jobs with an actual value of 0 count towards the coverage but not the MAPE.
+
+    Returns
+    -------
+    report : dict
+        {'overall': {...}, 'keys': {key: {...}}} with jobs, mape (%),
+        median_ape (%) and coverage (fraction) of each
+    """
+    actual = scored['actual']
+    positive = actual > 0
+    ape = np.full(len(actual), np.nan)
+    ape[positive] = np.abs(scored['mean'][positive] - actual[positive]) / actual[positive] * 100
+    covered = (scored['low'] <= actual) & (actual <= scored['high'])
+
+    def summary(mask):
+        errors = ape[mask & positive]
+        return {'jobs': int(mask.sum()),
+                'mape': float(errors.mean()) if len(errors) else None,
+                'median_ape': float(np.median(errors)) if len(errors) else None,
+                'coverage': float(covered[mask].mean()) if mask.any() else None}
+
+    report = {'overall': summary(np.ones(len(actual), dtype=bool))}
+    if by_key:
+        keys = scored['key']
+        bounds = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1], True])
+        report['keys'] = {}
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            mask = np.zeros(len(actual), dtype=bool)
+            mask[lo:hi] = True
+            report['keys'][keys[lo].replace("\x1f", " ")] = summary(mask)
+    return report
+
+def check_model(data, scored_keys=None, samples=200, seed=0):
+    """ Relative difference of the vectorized predictions and weighted_runtime_stats on exact values
+
+    The backtest works on the rollup histograms (50 bins per decade), the
+    web server on the exact run times. Compares the median of random jobs.
+
+    Returns
+    -------
+    diff : dict
+        Median and maximum relative difference
+    """
+    rng = np.random.default_rng(seed)
+    keys, values, timestamps = data['key'], data['value'], data['timestamp']
+    bounds = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1], True])
+    diffs = []
+    for i in rng.choice(len(values), size=min(samples, len(values)), replace=False):
+        lo = bounds[np.searchsorted(bounds, i, side='right') - 1]
+        before = values[lo:lo + np.searchsorted(timestamps[lo:i+1], timestamps[i], side='left')]
+        if len(before) == 0:
+            continue
+        exact = weighted_runtime_stats(before, np.ones(len(before), dtype=int))[0]
+        binned = binned_runtime_stats(np.bincount(bin_index(before), minlength=NBINS)[None, :])[0][0]
+        if exact > 0:
+            diffs.append(abs(binned - exact) / exact)
+    diffs = np.array(diffs)
+    return {'samples': len(diffs),
+            'median_rel_diff': float(np.median(diffs)) if len(diffs) else None,
+            'max_rel_diff': float(diffs.max()) if len(diffs) else None}
+
+def serving_latency(sqldb, data, target='run_time', samples=50, seed=0):
+    """ Latency of the web server's prediction for random keys of the history, in milliseconds """
+    import model
+    rng = np.random.default_rng(seed)
+    ukeys = np.unique(data['key'])
+    times = []
+    for key in rng.choice(ukeys, size=min(samples, len(ukeys)), replace=False).tolist():
+        first, second = key.split("\x1f")
+        t0 = time.perf_counter()
+        if target == 'run_time':
+            model.runtime_prediction(first, second, sqldb=sqldb)
+        else:
+            model.waittime_prediction(first, second, sqldb=sqldb)
+        times.append(time.perf_counter() - t0)
+    times = np.array(times)*1e3
+    return {'samples': len(times), 'p50_ms': float(np.percentile(times, 50)), 'p99_ms': float(np.percentile(times, 99))}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay job_times in timestamp order and score the predictions')
+    parser.add_argument('--sqldb', default='job.db', type=str, help='Database file or directory')
+    parser.add_argument('--target', default='run_time', choices=list(TARGETS), help='Run times (runtime_prediction) or queue times (waittime_prediction)')
+    parser.add_argument('--predictor', default=None, choices=list(PREDICTORS), help='Prediction rule, defaults to the one of the target')
+    parser.add_argument('--source', default=None, type=str, help='Only the jobs of this cluster')
+    parser.add_argument('--start', default=None, type=str, help='Only score jobs from this timestamp on, e.g. 2022-01-01')
+    parser.add_argument('--top', default=20, type=int, help='Keys with the most jobs to list')
+    parser.add_argument('--check', default=200, type=int, help='Jobs compared with weighted_runtime_stats on exact values, 0 to skip')
+    parser.add_argument('--latency', default=50, type=int, help='Keys timed through model.py, 0 to skip')
+    parser.add_argument('--output', default=None, type=str, help='JSON report with every key')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    predictor = args.predictor or TARGETS[args.target][2]
+
+    t0 = time.perf_counter()
+    data = load_jobs(args.sqldb, args.target, args.source)
+    load_seconds = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    scored = backtest(data, predictor, start=args.start)
+    replay_seconds = time.perf_counter() - t0
+    report = accuracy(scored)
+
+    report.update({'target': args.target, 'predictor': predictor, 'rows': len(data['value']),
+                   'load_seconds': load_seconds, 'replay_seconds': replay_seconds,
+                   'predictions_per_second': len(scored['actual']) / max(replay_seconds, 1e-9)})
+    if args.check > 0 and predictor == 'runtime':
+        report['check'] = check_model(data, samples=args.check)
+    if args.latency > 0:
+        report['serving_latency'] = serving_latency(args.sqldb, data, args.target, samples=args.latency)
+
+    print(f"{report['rows']} jobs loaded in {load_seconds:.1f} s, {len(scored['actual'])} predictions "
+          f"replayed in {replay_seconds:.1f} s ({report['predictions_per_second']:.0f}/s)")
+    overall = report['overall']
+    if overall['mape'] is not None:
+        print(f"overall: MAPE {overall['mape']:.1f}%, median APE {overall['median_ape']:.1f}%, "
+              f"[p1, p99] coverage {overall['coverage']*100:.1f}%")
+    if 'check' in report and report['check']['samples'] > 0:
+        print(f"binned vs exact median: {report['check']['median_rel_diff']*100:.2f}% median, "
+              f"{report['check']['max_rel_diff']*100:.2f}% max difference over {report['check']['samples']} jobs")
+    if 'serving_latency' in report:
+        print(f"serving latency: p50 {report['serving_latency']['p50_ms']:.1f} ms, "
+              f"p99 {report['serving_latency']['p99_ms']:.1f} ms")
+
+    print(f"{'jobs':>8} {'MAPE %':>8} {'cover %':>8}  key")
+    for key, stats in sorted(report['keys'].items(), key=lambda kv: -kv[1]['jobs'])[:args.top]:
+        mape = f"{stats['mape']:.1f}" if stats['mape'] is not None else "-"
+        print(f"{stats['jobs']:>8} {mape:>8} {stats['coverage']*100:>8.1f}  {key}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
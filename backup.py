@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from sql_database import BACKENDS, SQLDatabase, get_database
+from columnar_database import parse_schema
+
+MANIFEST = "manifest.json"
+
+# rows per exported file, bounds the memory of export and import
+CHUNK_ROWS = 500000
+
+
+def _pack(kind, values):
+    """ Arrays storing one column of a chunk, text is dictionary encoded """
+    values = np.asarray(values, dtype=object)
+    null = np.array([v is None for v in values], dtype=bool)
+    if kind == 'text':
+        codes = np.full(len(values), -1, dtype=np.int32)
+        uniq = np.array([], dtype=str)
+        if (~null).any():
+            uniq, codes[~null] = np.unique(values[~null].astype(str), return_inverse=True)
+        return {'dict': uniq, 'codes': codes}
+    if kind == 'real':
+        return {'values': np.where(null, np.nan, values).astype(np.float64)}
+    packed = {'values': np.where(null, 0, values).astype(np.int64)}
+    if null.any():
+        packed['null'] = null
+    return packed
+
+def _unpack(kind, arrays):
+    """ Python values of a packed column, None for nulls """
+    if kind == 'text':
+        codes = arrays['codes']
+        if (codes < 0).any():
+            values = np.empty(len(codes), dtype=object)
+            values[codes >= 0] = arrays['dict'][codes[codes >= 0]]
+            return values.tolist()
+        return arrays['dict'][codes].tolist()
+    values = arrays['values'].astype(object)
+    if kind == 'real':
+        values[np.isnan(arrays['values'])] = None
+    elif 'null' in arrays:
+        values[arrays['null']] = None
+    return values.tolist()
+
+def _sources(db, table):
+    # every partition file is paged through on its own, their keys overlap
+    if hasattr(db, 'partitions') and table in db.partitioned:
+        for key in db.partitions(table):
+            part = SQLDatabase()
+            part.open(db.partition_file(table, key))
+            yield part
+            part.close()
+    else:
+        yield db
+
+def _pages(db, table, columns, key, chunk):
+    """ Rows of a table in chunks, paged by its integer key when it has one """
+    if key is None:
+        rows = db.table_query(table, ", ".join(columns), "", [])
+        for i in range(0, len(rows), chunk):
+            yield rows[i:i+chunk]
+        return
+
+    low = db.table_query(table, "MIN(%s)" % key, "", [])[0][0]
+    while low is not None:
+        rows = db.table_query(table, ", ".join(columns), "%s >= ? AND %s < ?" % (key, key), [low, low + chunk])
+        if len(rows) > 0:
+            yield rows
+        low = db.table_query(table, "MIN(%s)" % key, "%s >= ?" % key, [low + chunk])[0][0]
+
+def export_database(db_path, out_dir, tables=None, chunk=CHUNK_ROWS, verbose=True):
+    """ Dump tables to compressed column files, chunk by chunk
+
+    Every chunk of a table is an .npz file with one array per column (text
+    columns as a dictionary and codes), described by manifest.json. The
+    integer primary key (uid) is not exported, rows are renumbered on import.
+
+    Parameters
+    ----------
+    db_path : str
+        Database file or directory, any backend
+
+    out_dir : str
+        New directory for the export
+
+    tables : list of str
+        Tables to export, defaults to all of them (job_times and the stats tables)
+
+    chunk : int
+        Maximum rows per file
+
+    Returns
+    -------
+    manifest : dict
+        Schema, columns, chunk files and row count of every table
+    """
+    db = get_database(db_path)
+    db.open(db_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    if tables is None:
+        tables = [t[0] for t in db.table_names if not t[0].startswith('sqlite_')]
+
+    manifest = {'source': os.path.abspath(db_path), 'created': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+                'tables': {}}
+    for table in tables:
+        start = time.perf_counter()
+        schema = db.table_schema(table)
+        names, kinds, key = parse_schema(schema)
+        columns = [n for n in names if n != key]
+        kinds = dict(zip(names, kinds))
+
+        files = []
+        nrows = 0
+        for source in _sources(db, table):
+            for rows in _pages(source, table, columns, key, chunk):
+                arrays = {}
+                for name, values in zip(columns, zip(*rows)):
+                    for part, array in _pack(kinds[name], values).items():
+                        arrays[f"{name}.{part}"] = array
+                name = "%s_%06d.npz" % (table, len(files))
+                np.savez_compressed(os.path.join(out_dir, name), **arrays)
+                files.append({'file': name, 'rows': len(rows)})
+                nrows += len(rows)
+
+        manifest['tables'][table] = {'schema': schema, 'columns': columns,
+                                     'kinds': [kinds[c] for c in columns], 'rows': nrows, 'files': files}
+        if verbose:
+            elapsed = time.perf_counter() - start
+            print(f"{table}: exported {nrows} rows in {len(files)} files ({elapsed:.1f} s)")
+
+    db.close()
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def import_database(in_dir, db_path, period=None, backend=None, verbose=True):
+    """ Load an export into a new database with bulk inserts
+
+    Parameters
+    ----------
+    in_dir : str
+        Directory written by export_database
+
+    db_path : str
+        New database file or directory
+
+    period : str
+        Partition job_times by year, month or day
+
+    backend : str
+        Storage backend (sqlite or columnar), defaults to ETC_STORAGE or sqlite
+
+    Returns
+    -------
+    nrows : dict
+        Rows inserted per table
+    """
+    with open(os.path.join(in_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    if os.path.exists(db_path):
+        print(f"Database already exists: {db_path}")
+        return {}
+
+    db = get_database(db_path, period=period, backend=backend)
+    db.create_db(db_path)
+
+    nrows = {}
+    for table, info in manifest['tables'].items():
+        start = time.perf_counter()
+        db.create_table(table, columns=info['schema'])
+        nrows[table] = 0
+        for entry in info['files']:
+            with np.load(os.path.join(in_dir, entry['file'])) as data:
+                values = [_unpack(kind, {k.split('.', 1)[1]: data[k] for k in data.files if k.split('.', 1)[0] == name})
+                          for name, kind in zip(info['columns'], info['kinds'])]
+            db.insert_many(table, info['columns'], zip(*values))
+            nrows[table] += entry['rows']
+
+        if verbose:
+            elapsed = time.perf_counter() - start
+            rate = nrows[table] / elapsed * 60 if elapsed > 0 else 0
+            print(f"{table}: imported {nrows[table]} rows in {elapsed:.1f} s ({rate/1e6:.2f}M rows/minute)")
+
+    db.close()
+    return nrows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a job database to compressed column files or import it back')
+    parser.add_argument('command', choices=['export', 'import'], help='export a database or import an export')
+    parser.add_argument('--sqldb', default='job.db', type=str, help='Database file or directory to export from or import into')
+    parser.add_argument('--dir', default='job_export', type=str, help='Export directory')
+    parser.add_argument('--tables', nargs='+', default=None, help='Tables to export, defaults to all')
+    parser.add_argument('--chunk', default=CHUNK_ROWS, type=int, help='Rows per exported file')
+    parser.add_argument('--partition', default=None, choices=['year', 'month', 'day'], help='Import into a database partitioned by this period')
+    parser.add_argument('--backend', default=None, choices=BACKENDS, help='Storage backend of the imported database, defaults to ETC_STORAGE or sqlite')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.command == 'export':
+        export_database(args.sqldb, args.dir, tables=args.tables, chunk=args.chunk)
+    else:
+        import_database(args.dir, args.sqldb, period=args.partition, backend=args.backend)
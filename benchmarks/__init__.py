@@ -0,0 +1,7 @@
+"""
+Performance benchmarks for the job ETC model
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run --rows 100000 1000000 --output bench.json
+"""
@@ -0,0 +1,141 @@
+"""
+/runtime latency while hundreds of /queuetime requests wait on a slow elastic search
+
+The stand-in elastic search answers after --delay seconds. Each server (the
+threaded flask server of webserver.py and asyncserver.py) is started in its
+own process, then --slow concurrent /queuetime requests with distinct sizes
+(so they are not coalesced) are sent while /runtime is timed in a loop. The
+threads of the server process are sampled during the run. Run from the
+repository root:
+
+    python -m benchmarks.async_routes --slow 300 --delay 2
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import numpy as np
+
+from benchmarks.synthetic import generate_job_db, generate_hits
+from benchmarks.fake_es import FakeElasticSearch
+from benchmarks.run import git_commit
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'flask': "import webserver; webserver.app.run(host='localhost', port={port}, threaded=True)",
+    'async': "import asyncserver; asyncserver.web.run_app(asyncserver.make_app(), host='localhost', port={port}, print=None)",
+}
+
+
+def start_server(name, port, workdir):
+    env = dict(os.environ, PYTHONPATH=REPO)
+    proc = subprocess.Popen([sys.executable, "-c", SERVERS[name].format(port=port)], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    import requests
+    for _ in range(100):
+        try:
+            requests.get(f"http://localhost:{port}/ready", timeout=1)
+            return proc
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{name} server did not start")
+
+async def sample_threads(pid, samples, done):
+    import psutil
+    process = psutil.Process(pid)
+    while not done.is_set():
+        samples.append(process.num_threads())
+        await asyncio.sleep(0.05)
+
+async def run_load(url, runtime_path, args, pid):
+    """ Slow requests in the background, /runtime timed in turn until they are answered """
+    import aiohttp
+    threads, done = [], asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        async def slow(i):
+            t0 = time.perf_counter()
+            async with session.get(f"{url}/queuetime?size={1000 + i}&nodes=5") as res:
+                await res.read()
+                return res.status, time.perf_counter() - t0
+
+        sampler = asyncio.ensure_future(sample_threads(pid, threads, done))
+        pending = asyncio.gather(*[slow(i) for i in range(args.slow)])
+        await asyncio.sleep(args.delay / 4) # slow requests are waiting on elastic search
+
+        times = []
+        while not pending.done():
+            t0 = time.perf_counter()
+            async with session.get(url + runtime_path) as res:
+                await res.read()
+            times.append(time.perf_counter() - t0)
+        slow_results = await pending
+        done.set()
+        await sampler
+
+    times = np.array(times)*1e3
+    slow_times = np.array([t for _, t in slow_results])
+    return {
+        'runtime_requests': len(times),
+        'runtime_p50_ms': float(np.percentile(times, 50)),
+        'runtime_p99_ms': float(np.percentile(times, 99)),
+        'runtime_max_ms': float(times.max()),
+        'slow_ok': sum(status == 200 for status, _ in slow_results),
+        'slow_max_s': float(slow_times.max()),
+        'peak_threads': max(threads)
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='/runtime latency during slow /queuetime requests, flask vs asyncserver')
+    parser.add_argument('--rows', default=20000, type=int, help='Rows of the synthetic database')
+    parser.add_argument('--ntypes', default=20, type=int, help='Number of distinct job types')
+    parser.add_argument('--queued', default=500, type=int, help='Jobs in the queue')
+    parser.add_argument('--slow', default=300, type=int, help='Concurrent /queuetime requests')
+    parser.add_argument('--delay', default=2, type=float, help='Seconds elastic search takes to answer')
+    parser.add_argument('--servers', nargs='+', default=list(SERVERS), choices=list(SERVERS), help='Servers to compare')
+    parser.add_argument('--port', default=5099, type=int, help='Port of the servers')
+    parser.add_argument('--workdir', default='bench_data', type=str, help='Directory for the synthetic database')
+    parser.add_argument('--output', default=None, type=str, help='JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    workdir = os.path.abspath(os.path.join(args.workdir, "async_routes"))
+    os.makedirs(workdir, exist_ok=True)
+    db_file = os.path.join(workdir, "job.db")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    population = generate_job_db(db_file, args.rows, ntypes=args.ntypes)
+
+    es = FakeElasticSearch(generate_hits(population, args.queued, status="job-queued", seed=5), delay=args.delay).start()
+    with open(os.path.join(workdir, "clusters.json"), "w") as f:
+        json.dump({"clusters": [{"name": "default", "endpoint": es.url}]}, f)
+
+    top = str(population.job_types[np.argmax(population.popularity)])
+    runtime_path = f"/runtime?jobtype={top}&instance=c5.9xlarge"
+
+    report = {'commit': git_commit(), 'cpus': os.cpu_count(), 'slow': args.slow, 'delay': args.delay, 'results': {}}
+    try:
+        for name in args.servers:
+            proc = start_server(name, args.port, workdir)
+            try:
+                result = asyncio.run(run_load(f"http://localhost:{args.port}", runtime_path, args, proc.pid))
+            finally:
+                proc.terminate()
+                proc.wait()
+            report['results'][name] = result
+            print(f"  {name}: /runtime p50 {result['runtime_p50_ms']:.1f} ms, p99 {result['runtime_p99_ms']:.1f} ms "
+                  f"over {result['runtime_requests']} requests, {result['slow_ok']}/{args.slow} /queuetime "
+                  f"answered in {result['slow_max_s']:.1f} s, peak {result['peak_threads']} threads")
+    finally:
+        es.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
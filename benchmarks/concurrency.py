@@ -0,0 +1,134 @@
+"""
+Read latency of the model while update.py ingests into the same database
+
+A bulk ingest from the stand-in elastic search runs in its own process, as
+update.py does in production, while this process times run time queries on
+read only connections. The same run is repeated with the rollback journal
+the database used before WAL for comparison. With fewer cores than
+processes the reads also wait for the CPU, compare their CPU time. Run from
+the repository root:
+
+    python -m benchmarks.concurrency --rows 200000 --ingest_hits 20000
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+
+import model
+import sql_database
+from benchmarks.synthetic import generate_job_db, generate_hits
+from benchmarks.fake_es import FakeElasticSearch
+from benchmarks.run import git_commit
+
+JOURNAL_MODES = ('wal', 'delete')
+
+
+def _ingest(db_file, hits, journal_mode):
+    # runs in a spawned process, like update.py next to the web server, with
+    # the stand-in elastic search so serving it does not slow down the reads
+    import update
+    from clusters import Cluster
+    sql_database.JOURNAL_MODE = journal_mode
+    es = FakeElasticSearch(hits).start()
+    try:
+        update.populate_backup_table(db_file, clusters=[Cluster("default", es.url)])
+    finally:
+        es.stop()
+
+def _percentiles(times, cpu_times, failures):
+    times = np.array(times)*1e3
+    return {
+        'reads': len(times),
+        'failed': failures,
+        'p50_ms': float(np.percentile(times, 50)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'max_ms': float(times.max()),
+        # stays flat when the reads only wait for a CPU shared with the ingest
+        'cpu_p50_ms': float(np.percentile(cpu_times, 50))*1e3
+    }
+
+def read_latency(db_file, keys, seconds=None, until=None):
+    """ Time return_runtimes_sql on the keys in turn, for some seconds or until a process exits
+
+    A read that returns no run times for a key known to have some failed
+    (e.g. "database is locked"). Waiting for a lock takes wall time but no
+    CPU time, both are recorded.
+    """
+    times, cpu_times, failures, i = [], [], 0, 0
+    end = time.perf_counter() + (seconds or 0)
+    while (until.is_alive() if until is not None else time.perf_counter() < end):
+        jobtype, instance = keys[i % len(keys)]
+        t0, c0 = time.perf_counter(), time.thread_time()
+        run_times = model.return_runtimes_sql(jobtype, instance, sqldb=db_file)
+        times.append(time.perf_counter() - t0)
+        cpu_times.append(time.thread_time() - c0)
+        failures += int(len(run_times) == 0)
+        i += 1
+    return times, cpu_times, failures
+
+def bench_mode(workdir, template, population, keys, journal_mode, args):
+    """ Baseline read latency, then read latency during an ingest """
+    db_file = os.path.join(workdir, f"job_{journal_mode}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+    shutil.copy(template, db_file)
+    db = sql_database.SQLDatabase()
+    sql_database.JOURNAL_MODE, mode = journal_mode, sql_database.JOURNAL_MODE
+    db.open(db_file)
+    db.close()
+    sql_database.JOURNAL_MODE = mode
+
+    baseline = _percentiles(*read_latency(db_file, keys, seconds=args.baseline_seconds))
+
+    hits = generate_hits(population, args.ingest_hits, start="2023-01-01T00:00:00", seed=3)
+    ingest = multiprocessing.get_context('spawn').Process(target=_ingest, args=(db_file, hits, journal_mode))
+    t0 = time.perf_counter()
+    ingest.start()
+    during = _percentiles(*read_latency(db_file, keys, until=ingest))
+    ingest.join()
+    elapsed = time.perf_counter() - t0
+
+    db.open(db_file, readonly=True)
+    rows = db.count_rows("job_times", "*", "", [])
+    db.close()
+
+    result = {'journal_mode': journal_mode, 'baseline': baseline, 'during_ingest': during,
+              'ingest_seconds': elapsed, 'rows': rows, 'exitcode': ingest.exitcode}
+    print(f"  {journal_mode}: p50 {baseline['p50_ms']:.1f} -> {during['p50_ms']:.1f} ms "
+          f"(cpu {baseline['cpu_p50_ms']:.1f} -> {during['cpu_p50_ms']:.1f} ms), "
+          f"p99 {baseline['p99_ms']:.1f} -> {during['p99_ms']:.1f} ms, max {during['max_ms']:.0f} ms, "
+          f"{during['failed']} of {during['reads']} reads failed, ingest {elapsed:.1f} s")
+    return result
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Read latency during an ingest, WAL vs rollback journal')
+    parser.add_argument('--rows', default=200000, type=int, help='Rows of the synthetic database')
+    parser.add_argument('--ntypes', default=200, type=int, help='Number of distinct job types')
+    parser.add_argument('--ingest_hits', default=20000, type=int, help='Completed jobs ingested concurrently')
+    parser.add_argument('--keys', default=20, type=int, help='Most frequent (job type, instance) keys read in turn')
+    parser.add_argument('--baseline_seconds', default=3, type=float, help='Seconds of reads without an ingest')
+    parser.add_argument('--modes', nargs='+', default=list(JOURNAL_MODES), choices=JOURNAL_MODES, help='Journal modes to compare')
+    parser.add_argument('--workdir', default='bench_data', type=str, help='Directory for the synthetic databases')
+    parser.add_argument('--output', default=None, type=str, help='JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    workdir = os.path.join(args.workdir, "concurrency")
+    os.makedirs(workdir, exist_ok=True)
+    template = os.path.join(workdir, "template.db")
+    population = generate_job_db(template, args.rows, ntypes=args.ntypes)
+
+    from startup import top_keys
+    keys = top_keys(template, args.keys)
+    report = {'commit': git_commit(), 'cpus': os.cpu_count(), 'rows': args.rows, 'ingest_hits': args.ingest_hits,
+              'results': [bench_mode(workdir, template, population, keys, mode, args) for mode in args.modes]}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
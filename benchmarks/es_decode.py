@@ -0,0 +1,140 @@
+"""
+Checks and measurements of the streaming elastic search decoder
+
+Decodes the recorded responses in benchmarks/fixtures split into chunks of
+several sizes and compares the hits with json.loads, then measures bytes
+transferred and peak memory per page with and without _source includes.
+Run from the repository root:
+
+    python -m benchmarks.es_decode --hits 1000
+"""
+import os
+import json
+import glob
+import time
+import argparse
+import tracemalloc
+
+import update
+from es_client import HitStream
+from benchmarks.synthetic import JobModel, generate_hits
+from benchmarks.fake_es import FakeElasticSearch
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+CHUNK_SIZES = (1, 7, 100, 4096, 65536)
+
+
+def _chunks(body, size):
+    return (body[i:i+size] for i in range(0, len(body), size))
+
+def check_fixtures(verbose=True):
+    """ Decode every fixture with several chunk sizes and compare with json.loads
+
+    Returns
+    -------
+    failures : list of str
+        Fixture and chunk size of every mismatch
+    """
+    failures = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.json"))):
+        with open(path, 'rb') as f:
+            body = f.read()
+        expected = json.loads(body)
+        hits = expected.get('hits', {}).get('hits', [])
+        total = expected.get('hits', {}).get('total')
+
+        for size in CHUNK_SIZES:
+            stream = HitStream(_chunks(body, size))
+            decoded = list(stream)
+            if decoded != hits or stream.total != total or stream.bytes != len(body):
+                failures.append(f"{os.path.basename(path)} chunk {size}")
+        if 'error' in expected and 'error' not in HitStream(_chunks(body, 7)).text:
+            failures.append(f"{os.path.basename(path)} error text")
+
+    # the ingested values must not depend on the _source includes
+    with open(os.path.join(FIXTURES, "es_jobs_page.json"), 'rb') as f:
+        full = update.parse_jobs(HitStream(_chunks(f.read(), 4096)))
+    with open(os.path.join(FIXTURES, "es_jobs_page_ingest_fields.json"), 'rb') as f:
+        part = update.parse_jobs(HitStream(_chunks(f.read(), 4096)))
+    if any((full[k] != part[k]).any() for k in full):
+        failures.append("parse_jobs differs with ingest fields")
+
+    if verbose:
+        print("fixtures:", "all checks passed" if len(failures) == 0 else "FAILED " + ", ".join(failures))
+    return failures
+
+def _peak(func):
+    tracemalloc.start()
+    try:
+        t0 = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t0
+        return result, tracemalloc.get_traced_memory()[1], elapsed
+    finally:
+        tracemalloc.stop()
+
+def measure_page(nhits=1000, seed=4):
+    """ Bytes and peak memory of decoding one page, whole documents vs ingest fields
+
+    Returns
+    -------
+    results : dict
+        Bytes, peak traced memory and decode seconds per variant
+    """
+    es = FakeElasticSearch(generate_hits(JobModel(ntypes=50), nhits, seed=seed))
+    query = {"query": {"bool": {"must": [{"match": {"status": "successful"}}]}}, "from": 0, "size": nhits}
+    full = json.dumps(es.search(query)).encode()
+    part = json.dumps(es.search(dict(query, _source={"includes": update.INGEST_FIELDS}))).encode()
+
+    def loads(body):
+        return lambda: update.parse_jobs(json.loads(body)['hits']['hits'])
+
+    def streamed(body):
+        return lambda: update.parse_jobs(HitStream(_chunks(body, 65536)))
+
+    results = {}
+    for name, body, decode in [('full_json', full, loads), ('full_stream', full, streamed),
+                               ('fields_json', part, loads), ('fields_stream', part, streamed)]:
+        _, peak, elapsed = _peak(decode(body))
+        results[name] = {'bytes': len(body), 'peak_bytes': peak, 'seconds': elapsed}
+        print(f"  {name}: {len(body)/1024:.0f} kB on the wire, peak {peak/1024:.0f} kB, {elapsed*1e3:.1f} ms")
+    return results
+
+def measure_ingest(nhits=5000, seed=5):
+    """ Pages of update.search_jobs against the stand-in elastic search """
+    es = FakeElasticSearch(generate_hits(JobModel(ntypes=50), nhits, seed=seed)).start()
+    try:
+        results = {}
+        for name, source in [('full', None), ('fields', update.INGEST_FIELDS)]:
+            nbytes, peak, npages = 0, 0, 0
+            t0 = time.perf_counter()
+            for i in range(0, nhits, 1000):
+                stream = update.search_jobs(es_endpoint=es.url, start_idx=i, size=1000, source=source)
+                update.parse_jobs(stream)
+                nbytes += stream.bytes
+                peak = max(peak, stream.peak_buffer)
+                npages += 1
+            results[name] = {'pages': npages, 'bytes_per_page': nbytes / npages, 'peak_buffer': peak,
+                             'seconds': time.perf_counter() - t0}
+            print(f"  ingest {name}: {nbytes/npages/1024:.0f} kB per page, decoder buffer peak {peak/1024:.0f} kB")
+        return results
+    finally:
+        es.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check and measure the streaming elastic search decoder')
+    parser.add_argument('--hits', default=1000, type=int, help='Hits per measured page')
+    parser.add_argument('--output', default=None, type=str, help='JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    failures = check_fixtures()
+    report = {'fixtures': failures, 'page': measure_page(args.hits), 'ingest': measure_ingest(args.hits*5)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if len(failures) > 0:
+        raise SystemExit(1)
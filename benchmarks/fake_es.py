@@ -0,0 +1,123 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def filter_source(source, includes):
+    """ Copy of a document with only the dotted paths in includes """
+    out = {}
+    for path in includes:
+        keys = path.split('.')
+        value = source
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            node = out
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = value
+    return out
+
+
+class FakeElasticSearch:
+    """ Local stand-in for the elastic search _search API
+
+    Serves generated hits for the handful of query shapes used by model.py and
+    update.py: a must-list with a status match, an optional @timestamp range,
+    from/size paging, sorts on _source fields and _source includes.
+
+    Example:
+        es = FakeElasticSearch(hits)
+        es.start()
+        model.es_endpoint = es.url
+        ...
+        es.stop()
+    """
+    def __init__(self, hits, host="localhost", port=0, delay=0):
+        self.hits = sorted(hits, key=lambda hit: hit['_source']['@timestamp'])
+        self.delay = delay  # seconds before each response, a slow or distant cluster
+        self.requests = 0
+        self.bytes_sent = 0
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                query = json.loads(self.rfile.read(length) or b"{}")
+                body = json.dumps(fake.search(query)).encode()
+                if fake.delay > 0:
+                    time.sleep(fake.delay)
+
+                fake.requests += 1
+                fake.bytes_sent += len(body)
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://localhost:{port}/"
+
+    def search(self, query):
+        """ Evaluate a query against the generated hits """
+        status = None
+        gt = gte = None
+        for clause in query.get('query', {}).get('bool', {}).get('must', []):
+            if 'match' in clause and 'status' in clause['match']:
+                status = clause['match']['status']
+            if 'range' in clause and '@timestamp' in clause['range']:
+                gt = clause['range']['@timestamp'].get('gt')
+                gte = clause['range']['@timestamp'].get('gte')
+
+        matches = [hit for hit in self.hits
+                   if (status is None or hit['_source']['status'] == status) and
+                      (gt is None or hit['_source']['@timestamp'] > gt) and
+                      (gte is None or hit['_source']['@timestamp'] >= gte)]
+
+        # sort clauses are applied last to first, each sort keeps the order of ties
+        for clause in reversed(query.get('sort', [])):
+            field, order = next(iter(clause.items()))
+            order = order.get('order', 'asc') if isinstance(order, dict) else order
+            matches.sort(key=lambda hit: hit['_source'].get(field, ''), reverse=order == 'desc')
+
+        start = int(query.get('from', 0))
+        size = int(query.get('size', 10))
+        total = len(matches)
+        matches = matches[start:start+size]
+
+        includes = query.get('_source', {}).get('includes') if isinstance(query.get('_source'), dict) else None
+        if includes is not None:
+            matches = [dict(hit, _source=filter_source(hit['_source'], includes)) for hit in matches]
+
+        return {
+            'took': 1,
+            'timed_out': False,
+            'hits': {
+                'total': {'value': total, 'relation': 'eq'},
+                'hits': matches
+            }
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
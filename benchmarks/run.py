@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+from metrics import peak_rss_mb
+from benchmarks.synthetic import generate_job_db, generate_hits
+from benchmarks.fake_es import FakeElasticSearch
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def latency(client, url, nrequests):
+    """ Time repeated GET requests against the flask app
+
+    Returns
+    -------
+    stats : dict
+        Latency percentiles in milliseconds
+    """
+    client.get(url) # warm up
+
+    times = []
+    for i in range(nrequests):
+        t0 = time.perf_counter()
+        res = client.get(url)
+        times.append(time.perf_counter() - t0)
+        if res.status_code != 200:
+            print(f"  {url} returned {res.status_code}")
+
+    times = np.array(times)*1e3
+    return {
+        'url': url,
+        'requests': nrequests,
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'max_ms': float(times.max())
+    }
+
+def bench_endpoints(db_file, population, args):
+    """ Latency of the prediction endpoints against a synthetic database """
+    import model
+    import webserver
+
+    # most popular job type, which is also the most expensive to summarize
+    top = str(population.job_types[np.argmax(population.popularity)])
+    urls = {
+        'runtime': f"/runtime?jobtype={top}&instance=c5.9xlarge",
+        'runtime_any_instance': f"/runtime?jobtype={top}&instance=*",
+        'runcost': f"/runcost?jobtype={top}&instance=c5.9xlarge",
+        'queuetime': f"/queuetime?size={args.queue_size}&nodes=5",
+    }
+    if args.rows_full_scan >= args.current_rows:
+        urls['runtime_all'] = "/runtime?jobtype=*&instance=*"
+
+    es = FakeElasticSearch(generate_hits(population, args.queue_size, status="job-queued", seed=1)).start()
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(db_file))) # model reads job.db from the working directory
+    endpoint = model.es_endpoint
+    model.es_endpoint = es.url
+    try:
+        client = webserver.app.test_client()
+        results = {}
+        for name, url in urls.items():
+            results[name] = latency(client, url, args.requests)
+            print(f"  {name}: p50 {results[name]['p50_ms']:.1f} ms, p99 {results[name]['p99_ms']:.1f} ms")
+    finally:
+        model.es_endpoint = endpoint
+        os.chdir(cwd)
+        es.stop()
+
+    return results
+
+def bench_ingest(workdir, population, args):
+    """ Rows per second of populate_backup_table from the stand-in elastic search """
+    import update
+
+    db_file = os.path.join(workdir, "ingest.db")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+
+    es = FakeElasticSearch(generate_hits(population, args.ingest_hits, seed=2)).start()
+    endpoint = update.default_es_endpoint
+    update.default_es_endpoint = es.url
+    try:
+        t0 = time.perf_counter()
+        update.populate_backup_table(db_file)
+        elapsed = time.perf_counter() - t0
+    finally:
+        update.default_es_endpoint = endpoint
+        es.stop()
+
+    db = update.SQLDatabase()
+    db.open(db_file)
+    rows = db.count_rows("job_times", "*", "", [])
+    db.close()
+
+    print(f"  ingest: {rows} rows in {elapsed:.1f} s")
+    return {
+        'hits': args.ingest_hits,
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed if elapsed > 0 else None,
+        'es_requests': es.requests,
+        'es_bytes': es.bytes_sent
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the job ETC model on synthetic data')
+    parser.add_argument('--rows', nargs='+', type=int, default=[100000], help='Database sizes to benchmark (e.g. 100000 1000000 50000000)')
+    parser.add_argument('--ntypes', default=200, type=int, help='Number of distinct job types')
+    parser.add_argument('--workdir', default='bench_data', type=str, help='Directory for the synthetic databases, reused between runs')
+    parser.add_argument('--requests', default=20, type=int, help='Timed requests per endpoint')
+    parser.add_argument('--queue_size', default=2000, type=int, help='Number of queued jobs served by the stand-in elastic search')
+    parser.add_argument('--ingest_hits', default=5000, type=int, help='Number of completed jobs to ingest')
+    parser.add_argument('--rows_full_scan', default=1000000, type=int, help='Largest database to benchmark jobtype=*&instance=* on')
+    parser.add_argument('--output', default='bench_results.json', type=str, help='JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': []
+    }
+
+    for rows in args.rows:
+        print(f"Benchmarking {rows} rows")
+        args.current_rows = rows
+        sizedir = os.path.join(args.workdir, str(rows))
+        os.makedirs(sizedir, exist_ok=True)
+        db_file = os.path.join(sizedir, "job.db")
+
+        t0 = time.perf_counter()
+        population = generate_job_db(db_file, rows, ntypes=args.ntypes)
+        generate_seconds = time.perf_counter() - t0
+
+        result = {
+            'rows': rows,
+            'db_bytes': os.path.getsize(db_file),
+            'generate_seconds': generate_seconds,
+            'latency': bench_endpoints(db_file, population, args),
+            'peak_rss_mb_after_latency': peak_rss_mb(),
+        }
+        result['ingest'] = bench_ingest(sizedir, population, args)
+        result['peak_rss_mb'] = peak_rss_mb()
+        report['results'].append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,264 @@
+"""
+Conformance checks and benchmarks shared by the storage backends
+
+Every backend runs the same operations and its results are compared with
+the sqlite backend, then the queries model.py issues are timed on a
+synthetic history. Run from the repository root, e.g.
+
+    python -m benchmarks.storage --rows 1000000 --output storage.json
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+
+from sql_database import BACKENDS, get_database
+from benchmarks.synthetic import JOB_COLUMNS, INSTANCES, generate_job_db
+from benchmarks.run import git_commit
+
+# rows exercising nulls, unicode, duplicates and equal run times
+SAMPLE_ROWS = [
+    ("job-a:1", "c5.9xlarge", 0.5, "2021-01-03T00:00:00.000Z", None),
+    ("job-a:1", "c5.9xlarge", 0.25, "2021-01-04T00:00:00.000Z", '{"a": 1}'),
+    ("job-a:1", "t3.large", 0.75, "2021-02-01T12:00:00.000Z", ""),
+    ("job-b:2", "c5.9xlarge", 1.5, "2021-02-02T00:00:00.000Z", None),
+    ("job-b:2", "", 0.0, "2021-03-01T00:00:00.000Z", None),
+    ("jöb-ü:3", "r5.4xlarge", 2.0, "2021-03-01T00:00:00.000Z", "δ"),
+    ("job-c:4", None, None, "2021-03-05T00:00:00.000Z", None),
+] + [("job-d:5", "m5.2xlarge", 0.1 * (i % 7 + 1), "2021-04-%02dT00:00:00.000Z" % (i % 28 + 1), None)
+     for i in range(40)]
+
+# (name, method, args) queries issued by model.py, update.py, rollup.py and decayed_stats.py
+CHECKS = [
+    ('all_rows', 'table_query', ("*", "", [])),
+    ('job_type', 'table_query', ("*", "job_type=?", ["job-a:1"])),
+    ('instance', 'table_query', ("*", "instance=?", ["c5.9xlarge"])),
+    ('job_type_instance', 'table_query', ("*", "job_type=? AND instance=?", ["job-a:1", "c5.9xlarge"])),
+    ('unicode', 'table_query', ("job_type, data", "job_type=?", ["jöb-ü:3"])),
+    ('missing', 'table_query', ("*", "job_type=?", ["no-such-job"])),
+    ('in_list', 'table_query', ("job_type, run_time", "job_type IN (?, ?, ?)", ["job-a:1", "job-d:5", "x"])),
+    ('in_list_instance', 'table_query', ("job_type, run_time", "job_type IN (?, ?) AND instance=?", ["job-a:1", "job-b:2", "c5.9xlarge"])),
+    ('literal', 'table_query', ("job_type, instance, run_time, timestamp", "run_time > 0", [])),
+    ('range', 'table_query', ("uid", "timestamp < ?", ["2021-02-02T00:00:00.000Z"])),
+    ('max_timestamp', 'table_query', ("MAX(timestamp)", "", [])),
+    ('min_run_time', 'table_query', ("MIN(run_time)", "", [])),
+    ('sum_run_time', 'table_query', ("SUM(run_time)", "instance=?", ["c5.9xlarge"])),
+    ('max_empty', 'table_query', ("MAX(run_time)", "job_type=?", ["no-such-job"])),
+    ('months', 'table_query', ("DISTINCT substr(timestamp, 1, 7)", "timestamp < ?", ["2021-04-01"])),
+    ('month_rows', 'table_query', ("job_type, instance, run_time", "substr(timestamp, 1, 7) = ? AND timestamp < ?", ["2021-04", "2021-04-10"])),
+    ('count', 'count_rows', ("*", "", [])),
+    ('count_column', 'count_rows', ("instance", "", [])),
+    ('count_duplicate', 'count_rows', ("*", "timestamp = ? AND job_type = ? AND instance = ?",
+                                       ["2021-01-03T00:00:00.000Z", "job-a:1", "c5.9xlarge"])),
+    ('column_query', 'column_query', (["job_type", "run_time"], "job_type=?", ["job-d:5"])),
+]
+
+
+def _normalize(result):
+    """Comparable form of a query result, rows sorted and floats rounded"""
+    def value(v):
+        if isinstance(v, (float, np.floating)):
+            return None if np.isnan(v) else round(float(v), 9)
+        if isinstance(v, np.generic):
+            return v.item()
+        return v
+    if isinstance(result, dict):
+        return {k: [value(v) for v in np.asarray(a).tolist()] for k, a in result.items()}
+    if isinstance(result, list):
+        return sorted((tuple(value(v) for v in row) for row in result), key=repr)
+    return value(result)
+
+def _run_checks(db):
+    return {name: _normalize(getattr(db, method)("job_times", *args)) for name, method, args in CHECKS}
+
+def _create(path, backend):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    db = get_database(path, backend=backend)
+    db.create_db(path)
+    db.create_table("job_times", columns=JOB_COLUMNS)
+    db.create_table("job_stats", columns="job_type text, total integer, PRIMARY KEY (job_type)")
+    return db
+
+def conformance(workdir):
+    """ Run CHECKS on every backend after the same sequence of writes
+
+    Returns
+    -------
+    failures : dict
+        Backend -> names of the checks that differ from sqlite
+    """
+    columns = ["job_type", "instance", "run_time", "timestamp", "data"]
+    results = {}
+    for backend in BACKENDS:
+        path = os.path.join(workdir, "conformance_%s.db" % backend)
+        stages = {}
+
+        db = _create(path, backend)
+        db.insert_many("job_times", columns, SAMPLE_ROWS[:20])
+        for row in SAMPLE_ROWS[20:]:
+            db.insert_records("job_times", dict(zip(columns, row)))
+        db.replace_records("job_stats", [{"job_type": "job-a:1", "total": 3}, {"job_type": "job-b:2", "total": 2}])
+        db.replace_records("job_stats", [{"job_type": "job-a:1", "total": 4}])
+        stages['buffered'] = _run_checks(db)
+        stages['stats_table'] = _normalize(db.table_query("job_stats", "*", "", []))
+        db.close()
+
+        db = get_database(path)
+        db.open(path)
+        stages['reopened'] = _run_checks(db)
+        stages['tables'] = _normalize([t for t in db.table_names if not t[0].startswith('sqlite_')])
+        stages['columns'] = db.table_column_name("job_times")
+        db.delete_records("job_times", "substr(timestamp, 1, 7) = ? AND timestamp < ?", ["2021-04", "2021-04-10"])
+        db.delete_records("job_times", "job_type=?", ["job-b:2"])
+        db.insert_records("job_times", dict(zip(columns, ("job-e:6", "t3.large", 3.0, "2021-05-01T00:00:00.000Z", None))))
+        stages['deleted'] = _run_checks(db)
+        db.vacuum()
+        stages['vacuumed'] = _run_checks(db)
+
+        # a column added to existing rows, then written and filtered on
+        db.add_column("job_times", "source text DEFAULT 'default'")
+        db.insert_records("job_times", dict(zip(columns + ["source"], ("job-e:6", "t3.large", 4.0, "2021-05-02T00:00:00.000Z", None, "other"))))
+        db.close()
+        db = get_database(path)
+        db.open(path)
+        stages['migrated'] = {
+            'columns': db.table_column_name("job_times"),
+            'sources': _normalize(db.table_query("job_times", "DISTINCT source", "", [])),
+            'default': _normalize(db.table_query("job_times", "job_type, run_time", "source=?", ["default"])),
+            'other': _normalize(db.column_query("job_times", ["job_type", "run_time"], "source=? AND job_type=?", ["other", "job-e:6"])),
+            'max': _normalize(db.table_query("job_times", "MAX(timestamp)", "source=?", ["default"])),
+        }
+        db.close()
+        results[backend] = stages
+
+    reference = results['sqlite']
+    failures = {}
+    for backend, stages in results.items():
+        failed = []
+        for stage, result in stages.items():
+            if isinstance(result, dict) and stage not in ('stats_table',):
+                failed.extend(f"{stage}/{name}" for name in result if result[name] != reference[stage][name])
+            elif result != reference[stage]:
+                failed.append(stage)
+        failures[backend] = failed
+        print(f"  {backend}: {'all checks passed' if len(failed) == 0 else 'FAILED ' + ', '.join(failed)}")
+    return failures
+
+def _copy_rows(src_file, dst_path, backend, chunk=200000):
+    """ Copy job_times from a sqlite file into a new database of another backend """
+    src = get_database(src_file)
+    src.open(src_file)
+    dst = _create(dst_path, backend)
+    columns = ["job_type", "instance", "run_time", "timestamp"]
+    last = 0
+    while True:
+        rows = src.table_query("job_times", "uid, " + ", ".join(columns), "uid > ? AND uid <= ?", [last, last + chunk])
+        if len(rows) == 0:
+            break
+        dst.insert_many("job_times", ["uid"] + columns, rows)
+        last += chunk
+    dst.close()
+    src.close()
+
+def _disk_bytes(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+def _timed(func, repeat):
+    func() # warm up
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return {'p50_ms': float(np.median(times))*1e3, 'min_ms': float(np.min(times))*1e3}
+
+def benchmark(workdir, rows, ntypes, repeat):
+    """ Time the queries of model.py on every backend
+
+    Returns
+    -------
+    results : dict
+        Backend -> disk size and latency per query
+    """
+    import model
+
+    sizedir = os.path.join(workdir, str(rows))
+    os.makedirs(sizedir, exist_ok=True)
+    sqlite_file = os.path.join(sizedir, "job.db")
+    population = generate_job_db(sqlite_file, rows, ntypes=ntypes)
+    top = str(population.job_types[np.argmax(population.popularity)])
+    jobtypes = [str(j) for j in population.job_types]
+
+    paths = {'sqlite': sqlite_file}
+    for backend in BACKENDS:
+        if backend == 'sqlite':
+            continue
+        paths[backend] = os.path.join(sizedir, "job_%s.db" % backend)
+        t0 = time.perf_counter()
+        _copy_rows(sqlite_file, paths[backend], backend)
+        print(f"  loaded {backend} in {time.perf_counter() - t0:.1f} s")
+
+    queries = {
+        'runtime_top': lambda p: model.runtime_prediction(top, "c5.9xlarge", sqldb=p),
+        'runtime_any_instance': lambda p: model.runtime_prediction(top, "*", sqldb=p),
+        'runtime_all': lambda p: model.runtime_prediction("*", "*", sqldb=p),
+        'grouped_all_types': lambda p: model.grouped_runtime_prediction(jobtypes, "*", sqldb=p),
+        'instances_top': lambda p: model.instance_runtime_prediction(top, sqldb=p),
+        'max_timestamp': lambda p: _query(p, "table_query", "MAX(timestamp)", "", []),
+        'count_duplicate': lambda p: _query(p, "count_rows", "*", "timestamp = ? AND job_type = ? AND instance = ?",
+                                            ["2021-01-01T00:00:00.000Z", top, str(INSTANCES[0])]),
+    }
+
+    results = {}
+    for backend, path in paths.items():
+        results[backend] = {'disk_bytes': _disk_bytes(path), 'latency': {}}
+        for name, query in queries.items():
+            results[backend]['latency'][name] = _timed(lambda: query(path), repeat)
+            print(f"  {backend} {name}: p50 {results[backend]['latency'][name]['p50_ms']:.1f} ms")
+    return results
+
+def _query(path, method, *args):
+    db = get_database(path)
+    db.open(path)
+    try:
+        return getattr(db, method)("job_times", *args)
+    finally:
+        db.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Conformance checks and benchmarks of the storage backends')
+    parser.add_argument('--rows', nargs='*', type=int, default=[200000], help='Database sizes to benchmark, none for conformance only')
+    parser.add_argument('--ntypes', default=200, type=int, help='Number of distinct job types')
+    parser.add_argument('--workdir', default='bench_data', type=str, help='Directory for the synthetic databases, reused between runs')
+    parser.add_argument('--repeat', default=5, type=int, help='Timed runs per query')
+    parser.add_argument('--output', default=None, type=str, help='JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+
+    print("Conformance")
+    failures = conformance(args.workdir)
+    report = {'commit': git_commit(), 'date': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+              'conformance': failures, 'results': []}
+
+    for rows in args.rows:
+        print(f"Benchmarking {rows} rows")
+        report['results'].append({'rows': rows, 'backends': benchmark(args.workdir, rows, args.ntypes, args.repeat)})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if any(len(failed) > 0 for failed in failures.values()):
+        raise SystemExit(1)
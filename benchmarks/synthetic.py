@@ -0,0 +1,190 @@
+import os
+import numpy as np
+
+from sql_database import SQLDatabase
+from timeutils import to_datetime64
+
+JOB_COLUMNS = ("uid integer primary key autoincrement, job_type text, "
+               "instance text, run_time real, timestamp datetime, data text")
+
+INSTANCES = np.array(['c5.9xlarge', 'c5.4xlarge', 'm5.2xlarge', 'r5.4xlarge', 't3.large'])
+INSTANCE_WEIGHTS = np.array([0.55, 0.2, 0.12, 0.08, 0.05])
+
+
+class JobModel:
+    """ Synthetic population of job types
+
+    Job type popularity follows a zipf law like production, where a handful of
+    PGEs make up most of the history, and some job types have two run time
+    modes to mimic different input parameters.
+    """
+    def __init__(self, ntypes=200, zipf=1.3, seed=42):
+        self.rng = np.random.default_rng(seed)
+        self.job_types = np.array([f"job-synthetic-{i:04d}:develop" for i in range(ntypes)])
+
+        popularity = 1. / np.arange(1, ntypes+1)**zipf
+        self.popularity = popularity / popularity.sum()
+
+        # median run times between ~1 min and ~8 hours, in days
+        self.median = 10**self.rng.uniform(-3, -0.5, ntypes)
+        self.sigma = self.rng.uniform(0.05, 0.5, ntypes)
+        self.bimodal = self.rng.random(ntypes) < 0.2
+        self.mode_ratio = self.rng.uniform(2, 6, ntypes)
+
+        # slower/faster hardware
+        self.instance_speed = np.array([1.0, 1.8, 2.2, 1.5, 4.0])
+
+    def sample(self, n):
+        """ Draw n jobs
+
+        Returns
+        -------
+        job_idx : np.ndarray
+            Index into job_types
+
+        inst_idx : np.ndarray
+            Index into INSTANCES
+
+        run_times : np.ndarray
+            Run time in days
+        """
+        job_idx = self.rng.choice(len(self.job_types), size=n, p=self.popularity)
+        inst_idx = self.rng.choice(len(INSTANCES), size=n, p=INSTANCE_WEIGHTS)
+
+        run_times = self.median[job_idx] * np.exp(self.sigma[job_idx]*self.rng.standard_normal(n))
+        second_mode = self.bimodal[job_idx] & (self.rng.random(n) < 0.4)
+        run_times[second_mode] *= self.mode_ratio[job_idx[second_mode]]
+        run_times *= self.instance_speed[inst_idx]
+        return job_idx, inst_idx, run_times
+
+def timestamps(n, start="2020-01-01T00:00:00", days=900, rng=None):
+    """ Sorted ISO-8601 timestamps spread over a number of days """
+    rng = rng or np.random.default_rng()
+    offsets = np.sort(rng.uniform(0, days*86400e3, n)).astype('int64')
+    times = np.datetime64(start, 'ms') + offsets.astype('timedelta64[ms]')
+    return np.char.add(np.datetime_as_string(times, unit='ms'), 'Z')
+
+def generate_job_db(db_file, rows, ntypes=200, chunk=200000, seed=42, verbose=True):
+    """ Create a job_times database filled with synthetic jobs
+
+    Parameters
+    ----------
+    db_file : str
+        SQLite database file, reused if it already holds enough rows
+
+    rows : int
+        Number of jobs to generate
+
+    ntypes : int
+        Number of distinct job types
+
+    chunk : int
+        Rows generated and inserted per transaction, bounds memory use
+
+    Returns
+    -------
+    model : JobModel
+        Population the jobs were drawn from
+    """
+    model = JobModel(ntypes=ntypes, seed=seed)
+    db = SQLDatabase()
+
+    if os.path.exists(db_file):
+        db.open(db_file)
+        existing = db.count_rows("job_times", "*", "", [])
+        db.close()
+        if existing == rows:
+            return model
+        os.remove(db_file)
+
+    db.create_db(db_file)
+    db.create_table('job_times', columns=JOB_COLUMNS)
+
+    # spread all the rows over the same period, chunk by chunk in time order
+    rng = np.random.default_rng(seed)
+    stamps_per_day = max(rows / 900., 1)
+    day = 0.
+    for i in range(0, rows, chunk):
+        n = min(chunk, rows - i)
+        job_idx, inst_idx, run_times = model.sample(n)
+        span = n / stamps_per_day
+        start = np.datetime64("2020-01-01T00:00:00", 'ms') + np.timedelta64(int(day*86400e3), 'ms')
+        stamps = timestamps(n, start=str(start), days=span, rng=rng)
+        day += span
+
+        db.insert_many('job_times', ['job_type', 'instance', 'run_time', 'timestamp'],
+                       zip(model.job_types[job_idx].tolist(), INSTANCES[inst_idx].tolist(),
+                           run_times.tolist(), stamps.tolist()))
+        if verbose:
+            print(f"  {db_file}: {i+n}/{rows} rows")
+
+    db.close()
+    return model
+
+def generate_hits(model, n, start="2022-06-01T00:00:00", status="successful", seed=0):
+    """ Elastic search hits shaped like HySDS job_status documents
+
+    Parameters
+    ----------
+    model : JobModel
+        Population to draw jobs from
+
+    n : int
+        Number of hits
+
+    start : str
+        Timestamp of the oldest hit
+
+    status : str
+        Value of the status field (e.g. successful, job-queued, job-started)
+
+    Returns
+    -------
+    hits : list of dicts
+    """
+    rng = np.random.default_rng(seed)
+    job_idx, inst_idx, run_times = model.sample(n)
+    stamps = timestamps(n, start=start, days=max(n/500., 1), rng=rng)
+    start_times = to_datetime64(stamps.tolist())
+    queue_times = (rng.exponential(0.01, n)*86400e3).astype('int64').astype('timedelta64[ms]')
+    run_deltas = (run_times*86400e3).astype('int64').astype('timedelta64[ms]')
+
+    def iso(times):
+        return np.char.add(np.datetime_as_string(times, unit='ms'), 'Z').tolist()
+
+    queued = iso(start_times - queue_times)
+    started = iso(start_times)
+    ended = iso(start_times + run_deltas)
+    stamps = stamps.tolist()
+
+    hits = []
+    for i in range(n):
+        job_type = str(model.job_types[job_idx[i]])
+        instance = str(INSTANCES[inst_idx[i]])
+        hits.append({
+            '_index': 'job_status-current',
+            '_id': f"{job_type}-{seed}-{i}",
+            '_source': {
+                'type': job_type,
+                'status': status,
+                '@timestamp': ended[i] if status in ("successful", "job-completed") else stamps[i],
+                'job_id': f"{job_type}-{seed}-{i}",
+                'job': {
+                    'job_info': {
+                        'time_queued': queued[i],
+                        'time_start': started[i],
+                        'time_end': ended[i],
+                        'execute_node': f"ip-10-0-{i%255}-{i%7}",
+                        'job_queue': f"{instance}-queue",
+                        'facts': {'ec2_instance_type': instance},
+                        'metrics': {'inputs_localized': [], 'products_staged': []}
+                    },
+                    'params': {
+                        'job_specification': {
+                            'params': [{'name': 'bbox', 'value': [float(i % 10), float(i % 3)]}]
+                        }
+                    }
+                }
+            }
+        })
+    return hits
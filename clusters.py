@@ -0,0 +1,122 @@
+import os
+import json
+
+import es_client
+
+# elastic search of the original cluster, used when no cluster file exists
+DEFAULT_ENDPOINT = "http://18.236.110.240:49200/"
+DEFAULT_SOURCE = "default"
+
+# clusters ingested and queried, see clusters.example.json
+CLUSTERS_FILE = os.environ.get('ETC_CLUSTERS', 'clusters.json')
+
+# column recording the cluster of each job, rows ingested before it existed get the default
+SOURCE_COLUMN = "source text DEFAULT '%s'" % DEFAULT_SOURCE
+
+
+class Cluster:
+    """ One HySDS/ADES elastic search endpoint
+
+    Parameters
+    ----------
+    name : str
+        Value of the source column for the jobs of this cluster
+
+    endpoint : str
+        Elastic search URL
+
+    index : str
+        Index or search path of the job documents
+
+    status_index : str
+        Index of the current job states (running jobs), defaults to index
+
+    verify : bool
+        Verify TLS certificates, defaults to False except for localhost
+
+    headers : dict
+        Extra HTTP headers
+
+    auth : list
+        User name and password
+    """
+    def __init__(self, name, endpoint, index="_search", status_index=None, verify=None, headers=None, auth=None):
+        self.name = name
+        self.endpoint = endpoint
+        self.index = index
+        self.status_index = status_index or index
+        self.verify = verify
+        self.headers = headers
+        self.auth = tuple(auth) if auth is not None else None
+
+    def request_kwargs(self):
+        """ Headers, TLS verification and credentials of the requests to this cluster """
+        kwargs = {}
+        if self.headers is not None:
+            kwargs['headers'] = self.headers
+        elif "localhost" in self.endpoint:
+            kwargs['headers'] = {"Content-Type": "application/json"}
+        if self.verify is not None:
+            kwargs['verify'] = self.verify
+        elif "localhost" not in self.endpoint:
+            kwargs['verify'] = False
+        if self.auth is not None:
+            kwargs['auth'] = self.auth
+        return kwargs
+
+    def search_hits(self, query, source=None, index=None):
+        """ es_client.search_hits against this cluster """
+        return es_client.search_hits(query, self.endpoint, index or self.index, source=source, **self.request_kwargs())
+
+    async def search_hits_async(self, session, query, source=None, index=None):
+        """ es_client.search_hits_async against this cluster, on a shared aiohttp session """
+        import aiohttp
+        kwargs = self.request_kwargs()
+        if 'verify' in kwargs:
+            kwargs['ssl'] = bool(kwargs.pop('verify'))
+        if 'auth' in kwargs:
+            kwargs['auth'] = aiohttp.BasicAuth(*kwargs['auth'])
+        return await es_client.search_hits_async(session, query, self.endpoint, index or self.index, source=source, **kwargs)
+
+    def __repr__(self):
+        return "Cluster(%r, %r, %r)" % (self.name, self.endpoint, self.index)
+
+
+def load_clusters(path=CLUSTERS_FILE, endpoint=DEFAULT_ENDPOINT):
+    """ Clusters listed in a JSON file, or the default cluster without one
+
+    The default cluster reads running jobs from the mozart job_status index
+    when JUSERNAME and JPASSWORD are set.
+
+    Format:
+
+        {"clusters": [{"name": "maap-ops", "endpoint": "https://...", "index": "_search"}, ...]}
+
+    Returns
+    -------
+    clusters : list of Cluster
+        Ordered as in the file, names are unique
+    """
+    if path is None or not os.path.exists(path):
+        if 'JUSERNAME' in os.environ:
+            return [Cluster(DEFAULT_SOURCE, endpoint, status_index="job_status-current/_search", verify=False,
+                            auth=(os.environ['JUSERNAME'], os.environ.get('JPASSWORD')))]
+        return [Cluster(DEFAULT_SOURCE, endpoint)]
+
+    with open(path) as f:
+        config = json.load(f)
+
+    clusters = [Cluster(**entry) for entry in config['clusters']]
+    names = [c.name for c in clusters]
+    if len(set(names)) != len(names) or len(names) == 0:
+        raise ValueError("Cluster names in %s must be unique and non-empty: %s" % (path, names))
+    return clusters
+
+def select(clusters, source=None):
+    """ The clusters matching a source name, all of them for None or * """
+    if source is None or source == "*":
+        return list(clusters)
+    selected = [c for c in clusters if c.name == source]
+    if len(selected) == 0:
+        raise ValueError("Unknown source %s, configured clusters: %s" % (source, [c.name for c in clusters]))
+    return selected
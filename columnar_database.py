@@ -0,0 +1,809 @@
+import os
+import re
+import json
+import shutil
+import logging
+import numpy as np
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import track_sql
+from profiling import pool_map
+from storage import StorageBackend
+from sql_database import SQLDatabase
+
+# rows per segment file, also the size of the in-memory write buffer
+SEGMENT_ROWS = 262144
+
+# null marker of integer columns, text nulls have the code -1 and reals are NaN
+NULL_INT = np.iinfo(np.int64).min
+
+_token = re.compile(r"\s*(\?|'(?:[^']|'')*'|-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|[A-Za-z_][A-Za-z_0-9]*"
+                    r"|<=|>=|<>|!=|==|=|<|>|\(|\)|,|\*)")
+_aggregate = re.compile(r'^(MIN|MAX|SUM|COUNT)\s*\((.*)\)$', re.IGNORECASE | re.DOTALL)
+_distinct = re.compile(r'^DISTINCT\s+(.*)$', re.IGNORECASE | re.DOTALL)
+_constraints = ('PRIMARY', 'UNIQUE', 'FOREIGN', 'CHECK', 'CONSTRAINT')
+_default = re.compile(r"\bDEFAULT\s+('(?:[^']|'')*'|\S+)", re.IGNORECASE)
+
+
+def _split(text):
+    """Split on commas outside of parentheses"""
+    parts, depth, current = [], 0, ''
+    for c in text:
+        if c == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        depth += (c == '(') - (c == ')')
+        current += c
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+def parse_schema(columns):
+    """Column names, kinds (int, real or text) and autoincrement key of a sqlite column definition"""
+    names, kinds, autoincrement = [], [], None
+    for part in _split(columns):
+        words = part.split()
+        if len(words) == 0 or words[0].upper() in _constraints:
+            continue
+        decl = ' '.join(words[1:]).upper()
+        kind = 'int' if 'INT' in decl else 'real' if any(t in decl for t in ('REAL', 'FLOA', 'DOUB')) else 'text'
+        if kind == 'int' and 'PRIMARY KEY' in decl:
+            autoincrement = words[0]
+        names.append(words[0])
+        kinds.append(kind)
+    return names, kinds, autoincrement
+
+
+class _Text:
+    """Dictionary encoded text column: int32 codes into sorted utf-8 values"""
+    def __init__(self, codes, values, unique=True):
+        self.codes = codes
+        self.values = values
+        self.unique = unique
+
+    @classmethod
+    def encode(cls, items):
+        items = np.asarray(items, dtype=object)
+        null = np.array([v is None for v in items], dtype=bool)
+        codes = np.full(len(items), -1, dtype=np.int32)
+        if (~null).any():
+            uniq, inverse = np.unique(items[~null].astype(str), return_inverse=True)
+            codes[~null] = inverse
+            return cls(codes, np.char.encode(uniq, 'utf-8'))
+        return cls(codes, np.array([], dtype='S1'))
+
+    def take(self, mask=None):
+        codes = self.codes if mask is None else self.codes[mask]
+        return _Text(codes, self.values, self.unique)
+
+    def decode(self):
+        """Strings, with None for nulls"""
+        values = np.char.decode(self.values, 'utf-8') if len(self.values) > 0 else np.array([], dtype=str)
+        null = self.codes < 0
+        if null.any():
+            out = np.empty(len(self.codes), dtype=object)
+            out[~null] = values[self.codes[~null]]
+            return out
+        return values[self.codes]
+
+    def substr(self, start, length):
+        values = [v[start-1:start-1+length] for v in np.char.decode(self.values, 'utf-8').tolist()]
+        return _Text(self.codes, np.char.encode(np.array(values, dtype=str), 'utf-8') if values else self.values, unique=False)
+
+    def compare(self, op, value):
+        if value is None:
+            return np.zeros(len(self.codes), dtype=bool)
+        value = str(value).encode('utf-8')
+        if op in ('=', '==') and self.unique:
+            # binary search of the sorted dictionary, then one integer comparison
+            i = np.searchsorted(self.values, value)
+            if i >= len(self.values) or self.values[i] != value:
+                return np.zeros(len(self.codes), dtype=bool)
+            return self.codes == i
+        hits = _compare(self.values, op, value)
+        if not hits.any():
+            return np.zeros(len(self.codes), dtype=bool)
+        return np.append(hits, False)[self.codes]
+
+    def isin(self, items):
+        items = [str(v).encode('utf-8') for v in items if v is not None]
+        hits = np.isin(self.values, np.array(items, dtype=self.values.dtype if len(items) == 0 else None))
+        if not hits.any():
+            return np.zeros(len(self.codes), dtype=bool)
+        return np.append(hits, False)[self.codes]
+
+    def used(self):
+        return np.unique(self.codes[self.codes >= 0])
+
+def _compare(array, op, value):
+    if op in ('=', '=='):
+        return array == value
+    if op in ('!=', '<>'):
+        return array != value
+    if op == '<':
+        return array < value
+    if op == '<=':
+        return array <= value
+    if op == '>':
+        return array > value
+    return array >= value
+
+def _encode(kind, items):
+    if kind == 'text':
+        return _Text.encode(items)
+    if kind == 'real':
+        return np.array([np.nan if v is None else v for v in items], dtype=np.float64)
+    return np.array([NULL_INT if v is None else v for v in items], dtype=np.int64)
+
+def _decode(kind, column):
+    """Python values of a column, None for nulls"""
+    if kind == 'text':
+        return column.decode().tolist()
+    if kind == 'real':
+        values = column.astype(object)
+        values[np.isnan(column)] = None
+        return values.tolist()
+    values = column.astype(object)
+    values[column == NULL_INT] = None
+    return values.tolist()
+
+def _literal(token):
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    if token.upper() == 'NULL':
+        return None
+    return float(token) if any(c in token for c in '.eE') else int(token)
+
+def _null(kind, column):
+    if kind == 'text':
+        return column.codes < 0
+    if kind == 'real':
+        return np.isnan(column)
+    return column == NULL_INT
+
+
+class _Query:
+    """Parsed columns and WHERE clause, limited to what the repo's queries use
+
+    Conditions are AND-ed comparisons (=, !=, <, <=, >, >=, IN) of a column or
+    substr(column, start, length) with ? placeholders or literals. Columns are
+    *, column names or substr expressions, a single MIN/MAX/SUM/COUNT aggregate,
+    or DISTINCT of one expression.
+    """
+    def __init__(self, names, columns, condition, values):
+        self.names = names
+        self.values = list(values)
+        self.terms = self._parse_condition(condition) if condition.strip() else []
+
+        columns = columns.strip()
+        self.aggregate = self.distinct = None
+        match = _aggregate.match(columns)
+        if match and ',' not in columns:
+            arg = match.group(2).strip()
+            self.aggregate = match.group(1).upper()
+            self.select = [None if arg == '*' else self._parse_expr(arg)]
+            return
+        match = _distinct.match(columns)
+        if match:
+            self.distinct = True
+            self.select = [self._parse_expr(match.group(1))]
+            return
+        self.select = []
+        for part in _split(columns):
+            if part == '*':
+                self.select.extend(('col', n) for n in names)
+            else:
+                self.select.append(self._parse_expr(part))
+
+    def _parse_expr(self, text):
+        tokens = _token.findall(text)
+        if len(tokens) == 1 and tokens[0] in self.names:
+            return ('col', tokens[0])
+        if len(tokens) == 8 and tokens[0].lower() == 'substr' and tokens[2] in self.names:
+            return ('substr', tokens[2], int(tokens[4]), int(tokens[6]))
+        raise ValueError("Unsupported expression for the columnar backend: %s" % text)
+
+    def _literal(self, token):
+        if token == '?':
+            return self.values.pop(0)
+        return _literal(token)
+
+    def _parse_condition(self, condition):
+        terms = []
+        tokens = _token.findall(condition)
+        if _token.sub('', condition).strip():
+            raise ValueError("Unsupported condition for the columnar backend: %s" % condition)
+        for term in self._split_and(tokens):
+            if term in (['1', '=', '1'], ['1']):
+                continue
+            if len(term) >= 4 and term[1].upper() == 'IN' and term[2] == '(' and term[-1] == ')':
+                operands = [self._literal(t) for t in term[3:-1] if t != ',']
+                terms.append((self._parse_expr(term[0]), 'IN', operands))
+            elif len(term) >= 3 and term[-2] in ('=', '==', '!=', '<>', '<', '<=', '>', '>='):
+                terms.append((self._parse_expr(' '.join(term[:-2])), term[-2], self._literal(term[-1])))
+            else:
+                raise ValueError("Unsupported condition for the columnar backend: %s" % condition)
+        return terms
+
+    @staticmethod
+    def _split_and(tokens):
+        term = []
+        depth = 0
+        for t in tokens:
+            depth += (t == '(') - (t == ')')
+            if t.upper() == 'AND' and depth == 0:
+                yield term
+                term = []
+            elif t.upper() == 'OR':
+                raise ValueError("OR conditions are not supported by the columnar backend")
+            else:
+                term.append(t)
+        yield term
+
+    def columns(self):
+        """Names of the columns the query reads"""
+        exprs = [e for e in self.select if e is not None] + [term[0] for term in self.terms]
+        return sorted({e[1] for e in exprs})
+
+
+class _Segment:
+    """Columns of one segment, loaded lazily from disk or held in memory"""
+    def __init__(self, kinds, path=None, nrows=0, columns=None):
+        self.kinds = kinds
+        self.path = path
+        self.nrows = nrows
+        self._columns = dict(columns or {})
+
+    def column(self, name):
+        if name not in self._columns:
+            if self.kinds[name] == 'text':
+                codes = np.load(os.path.join(self.path, name + '.codes.npy'), mmap_mode='r')
+                values = np.load(os.path.join(self.path, name + '.dict.npy'))
+                self._columns[name] = _Text(codes, values)
+            else:
+                self._columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    def expr(self, expr, mask=None):
+        column = self.column(expr[1])
+        if expr[0] == 'substr':
+            column = column.substr(expr[2], expr[3])
+        if mask is None:
+            return column
+        return column.take(mask) if isinstance(column, _Text) else column[mask]
+
+    def mask(self, terms):
+        mask = np.ones(self.nrows, dtype=bool)
+        for expr, op, value in terms:
+            column = self.expr(expr)
+            if op == 'IN' and isinstance(column, _Text):
+                mask &= column.isin(value)
+            elif op == 'IN':
+                hit = np.zeros(self.nrows, dtype=bool)
+                for v in value:
+                    hit |= self._compare(expr, column, '=', v)
+                mask &= hit
+            else:
+                mask &= self._compare(expr, column, op, value)
+            if not mask.any():
+                break
+        return mask
+
+    def _compare(self, expr, column, op, value):
+        if isinstance(column, _Text):
+            return column.compare(op, value)
+        if value is None:
+            return np.zeros(self.nrows, dtype=bool)
+        result = _compare(column, op, float(value))
+        if self.kinds[expr[1]] == 'int':
+            result &= column != NULL_INT
+        return result
+
+    def write(self, path, exist_ok=False):
+        os.makedirs(path, exist_ok=exist_ok)
+        for name, kind in self.kinds.items():
+            column = self.column(name)
+            if kind == 'text':
+                np.save(os.path.join(path, name + '.codes.npy'), column.codes)
+                np.save(os.path.join(path, name + '.dict.npy'), column.values)
+            else:
+                np.save(os.path.join(path, name + '.npy'), column)
+
+
+class ColumnarDatabase(StorageBackend):
+    """Directory of column files for scan-heavy tables
+
+    Tables registered as columnar (job_times by default) are stored as
+    segments of up to SEGMENT_ROWS rows, one numpy file per column. Text is
+    dictionary encoded, so filters on job_type or instance compare integer
+    codes, and files are memory mapped so a query only reads the columns it
+    uses. Inserts are buffered and appended to the last segment on close.
+    Other tables live in main.db.
+
+    columnar.json lists the segments of every table and is replaced
+    atomically, so readers in other processes see either the old or the new
+    segments. Only one process should write at a time.
+    """
+    CONFIG = 'columnar.json'
+    MAIN = 'main.db'
+
+    _pool = None
+
+    def __init__(self, columnar=('job_times',)):
+        self.columnar = list(columnar)
+        self.tables = {}
+
+        self._connected = False
+        self._db_dir = None
+        self.main = SQLDatabase()
+        self._buffers = {}
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def isConnected(self):
+        return self._connected
+
+    @property
+    def db_name(self):
+        return self._db_dir
+
+    @property
+    def table_names(self):
+        if self.isConnected:
+            names = set(self.main.table_names or [])
+            names.update((table,) for table in self.tables)
+            return sorted(names)
+        else:
+            self.logger.warning('Database not open')
+
+    @classmethod
+    def _executor(cls):
+        if cls._pool is None:
+            cls._pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+        return cls._pool
+
+    def _load_config(self):
+        with open(os.path.join(self._db_dir, self.CONFIG)) as f:
+            settings = json.load(f)
+        self.columnar = settings['columnar']
+        self.tables = settings['tables']
+
+    def _save_config(self):
+        path = os.path.join(self._db_dir, self.CONFIG)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'columnar': self.columnar, 'tables': self.tables}, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def open(self, db_dir, timeout=30, readonly=False):
+        """Open a columnar database directory
+
+        Parameters
+        ----------
+        db_dir : str
+            Database directory
+
+        timeout : float
+            Timeout in seconds of main.db
+
+        readonly : bool
+            Open main.db read only, column files are always mapped read only
+
+        Returns
+        -------
+        None
+        """
+        self._connect(db_dir, timeout, partial(self.main.open, readonly=readonly))
+        return
+
+    def _connect(self, db_dir, timeout, main_open):
+        if not os.path.isfile(os.path.join(db_dir, self.CONFIG)):
+            self.logger.error('Columnar database %s not found.' % db_dir)
+            return
+
+        self._db_dir = db_dir
+        self._load_config()
+        main_open(os.path.join(db_dir, self.MAIN), timeout=timeout)
+        if self.main.isConnected:
+            self._connected = True
+
+        return
+
+    def create_db(self, db_dir, timeout=30):
+        """Create a columnar database directory
+
+        Parameters
+        ----------
+        db_dir : str
+            Database directory
+
+        timeout : float
+            Timeout in seconds of main.db
+
+        Returns
+        -------
+        None
+        """
+        os.makedirs(db_dir, exist_ok=True)
+        self._db_dir = db_dir
+        if not os.path.isfile(os.path.join(db_dir, self.CONFIG)):
+            self._save_config()
+        self._connect(db_dir, timeout, self.main.create_db)
+
+    def close(self):
+        if self.isConnected:
+            for table_name in list(self._buffers):
+                self._flush(table_name)
+            self.main.close()
+            self._connected = False
+        else:
+            self.logger.warning('Database not open')
+
+    def _schema(self, table_name):
+        names, kinds, autoincrement = parse_schema(self.tables[table_name]['schema'])
+        return names, dict(zip(names, kinds)), autoincrement
+
+    def _segment_path(self, table_name, segment):
+        return os.path.join(self._db_dir, table_name, segment)
+
+    def _segments(self, table_name):
+        # segments on disk plus the rows buffered by this connection
+        names, kinds, _ = self._schema(table_name)
+        segments = [_Segment(kinds, self._segment_path(table_name, name), nrows)
+                    for name, nrows in self.tables[table_name]['segments']]
+        buffered = self._buffers.get(table_name)
+        if buffered:
+            columns = {n: _encode(kinds[n], col) for n, col in zip(names, zip(*buffered))}
+            segments.append(_Segment(kinds, nrows=len(buffered), columns=columns))
+        return segments
+
+    def _write_segments(self, table_name, segments, replace=()):
+        """Write in-memory segments and swap them for the replaced ones in the config"""
+        info = self.tables[table_name]
+        added = []
+        for segment in segments:
+            name = 'seg_%06d' % info['next_segment']
+            info['next_segment'] += 1
+            tmp = self._segment_path(table_name, '.tmp_' + name)
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            segment.write(tmp)
+            os.rename(tmp, self._segment_path(table_name, name))
+            added.append([name, segment.nrows])
+
+        kept = [s for s in info['segments'] if s[0] not in replace]
+        info['segments'] = kept + added
+        self._save_config()
+        for name in replace:
+            shutil.rmtree(self._segment_path(table_name, name), ignore_errors=True)
+
+    def _merge(self, table_name, segments):
+        """One in-memory segment holding the rows of several segments"""
+        names, kinds, _ = self._schema(table_name)
+        columns = {}
+        for name in names:
+            parts = [s.column(name) for s in segments]
+            if kinds[name] == 'text':
+                columns[name] = _Text.encode(np.concatenate([p.decode().astype(object) for p in parts]))
+            else:
+                columns[name] = np.concatenate([np.asarray(p) for p in parts])
+        return _Segment(kinds, nrows=sum(s.nrows for s in segments), columns=columns)
+
+    def _flush(self, table_name):
+        # append buffered rows to the last segment while it is not full
+        buffered = self._buffers.pop(table_name, None)
+        if not buffered:
+            return
+        names, kinds, _ = self._schema(table_name)
+        columns = {n: _encode(kinds[n], col) for n, col in zip(names, zip(*buffered))}
+        new = _Segment(kinds, nrows=len(buffered), columns=columns)
+
+        replace = []
+        segments = self.tables[table_name]['segments']
+        if len(segments) > 0 and segments[-1][1] + new.nrows <= SEGMENT_ROWS:
+            last = _Segment(kinds, self._segment_path(table_name, segments[-1][0]), segments[-1][1])
+            new = self._merge(table_name, [last, new])
+            replace = [segments[-1][0]]
+        self._write_segments(table_name, [new], replace)
+
+    @contextmanager
+    def transaction(self):
+        """Commit the writes of a block together, see SQLDatabase.transaction
+
+        The rows buffered for columnar tables during the block are written
+        out before main.db commits, and dropped when the block raises.
+        """
+        if self.main._in_transaction:
+            yield
+            return
+        sizes = {table_name: len(buffer) for table_name, buffer in self._buffers.items()}
+        try:
+            with self.main.transaction():
+                yield
+                for table_name in list(self._buffers):
+                    self._flush(table_name)
+        except BaseException:
+            for table_name in list(self._buffers):
+                del self._buffers[table_name][sizes.get(table_name, 0):]
+            raise
+
+    def create_table(self, table_name, columns=""):
+        if not self.isConnected:
+            self.logger.warning('Database not open')
+        elif table_name in self.columnar:
+            if table_name not in self.tables:
+                os.makedirs(os.path.join(self._db_dir, table_name), exist_ok=True)
+                self.tables[table_name] = {'schema': columns, 'segments': [], 'next_segment': 0, 'next_uid': 1}
+                self._save_config()
+        else:
+            self.main.create_table(table_name, columns=columns)
+
+    def drop_table(self, table_name):
+        if table_name not in self.tables:
+            return self.main.drop_table(table_name)
+        self._buffers.pop(table_name, None)
+        del self.tables[table_name]
+        self._save_config()
+        shutil.rmtree(os.path.join(self._db_dir, table_name), ignore_errors=True)
+
+    def table_column_name(self, table_name):
+        if table_name not in self.tables:
+            return self.main.table_column_name(table_name)
+        return self._schema(table_name)[0]
+
+    def table_schema(self, table_name):
+        if table_name not in self.tables:
+            return self.main.table_schema(table_name)
+        return self.tables[table_name]['schema']
+
+    def add_column(self, table_name, column):
+        if table_name not in self.tables:
+            return self.main.add_column(table_name, column)
+        names, kinds, _ = self._schema(table_name)
+        (name,), (kind,), _ = parse_schema(column)
+        if name in names:
+            self.logger.error('Failed to add column to table %s' % table_name)
+            self.logger.error('columnar error : duplicate column name %s' % name)
+            return
+
+        # existing segments get a constant column before the schema lists it
+        default = _default.search(column)
+        default = None if default is None else _literal(default.group(1))
+        self._flush(table_name)
+        for segment, nrows in self.tables[table_name]['segments']:
+            constant = _Segment({name: kind}, nrows=nrows, columns={name: _encode(kind, [default]*nrows)})
+            constant.write(self._segment_path(table_name, segment), exist_ok=True)
+        self.tables[table_name]['schema'] += ", " + column
+        self._save_config()
+
+    def _scan(self, table_name, query, func):
+        # run func(segment, mask) on every segment in parallel
+        def run(segment):
+            return func(segment, segment.mask(query.terms))
+
+        segments = self._segments(table_name)
+        if len(segments) <= 1:
+            return [run(s) for s in segments]
+        try:
+            return pool_map(self._executor, run, segments)
+        except FileNotFoundError:
+            # a writer compacted the table since the config was read
+            self._load_config()
+            return pool_map(self._executor, run, self._segments(table_name))
+
+    def _query(self, table_name, columns, condition, values):
+        try:
+            return _Query(self._schema(table_name)[0], columns, condition, values)
+        except (ValueError, IndexError) as err:
+            self.logger.error('Failed to query tables(s): %s' % table_name)
+            self.logger.error('columnar error : %s' % err)
+
+    @track_sql('table_query')
+    def table_query(self, table_name, columns, condition, values):
+        if not self.isConnected:
+            self.logger.warning('Database not open')
+            return list()
+        if table_name not in self.tables:
+            return self.main.table_query(table_name, columns, condition, values)
+
+        query = self._query(table_name, columns, condition, values)
+        if query is None:
+            return list()
+        _, kinds, _ = self._schema(table_name)
+
+        if query.aggregate is not None:
+            return [(self._aggregate(table_name, query, kinds),)]
+
+        if query.distinct:
+            expr = query.select[0]
+            def distinct(segment, mask):
+                column = segment.expr(expr, mask)
+                if isinstance(column, _Text):
+                    return set(np.char.decode(column.values[column.used()], 'utf-8').tolist()) | \
+                        ({None} if (column.codes < 0).any() else set())
+                return set(_decode(kinds[expr[1]], np.unique(column)))
+            found = set().union(*self._scan(table_name, query, distinct))
+            return [(v,) for v in sorted(found, key=lambda v: (v is None, v))]
+
+        def rows(segment, mask):
+            if not mask.any():
+                return []
+            return list(zip(*[_decode('text' if e[0] == 'substr' else kinds[e[1]], segment.expr(e, mask))
+                              for e in query.select]))
+        return [row for part in self._scan(table_name, query, rows) for row in part]
+
+    def _aggregate(self, table_name, query, kinds):
+        expr = query.select[0]
+        func = query.aggregate
+
+        def reduce(segment, mask):
+            if expr is None:
+                return int(mask.sum()), None
+            column = segment.expr(expr, mask)
+            kind = 'text' if expr[0] == 'substr' or kinds[expr[1]] == 'text' else kinds[expr[1]]
+            valid = ~_null(kind, column)
+            if func == 'COUNT':
+                return int(valid.sum()), None
+            if not valid.any():
+                return 0, None
+            if kind == 'text':
+                if func == 'SUM':
+                    raise ValueError("SUM of a text column is not supported by the columnar backend")
+                if column.unique:
+                    # sorted dictionary, utf-8 byte order is code point order
+                    codes = column.codes[valid]
+                    code = codes.min() if func == 'MIN' else codes.max()
+                    return int(valid.sum()), column.values[code].decode('utf-8')
+                used = np.char.decode(column.values[column.used()], 'utf-8').tolist()
+                return int(valid.sum()), (min(used) if func == 'MIN' else max(used))
+            column = np.asarray(column)[valid]
+            value = column.sum() if func == 'SUM' else column.min() if func == 'MIN' else column.max()
+            return int(valid.sum()), value.item()
+
+        parts = [p for p in self._scan(table_name, query, reduce)]
+        if func == 'COUNT':
+            return sum(n for n, _ in parts)
+        found = [v for n, v in parts if n > 0 and v is not None]
+        if len(found) == 0:
+            return None
+        if func == 'MAX':
+            return max(found)
+        if func == 'MIN':
+            return min(found)
+        return sum(found)
+
+    @track_sql('count_rows')
+    def count_rows(self, table_name, columns, condition, values):
+        if not self.isConnected:
+            self.logger.warning('Database not open')
+            return 0
+        if table_name not in self.tables:
+            return self.main.count_rows(table_name, columns, condition, values)
+        rows = self.table_query(table_name, 'COUNT(%s)' % columns, condition, values)
+        return rows[0][0] if len(rows) > 0 else 0
+
+    def column_query(self, table_name, columns, condition, values):
+        if not self.isConnected or table_name not in self.tables:
+            return super().column_query(table_name, columns, condition, values)
+
+        query = self._query(table_name, ', '.join(columns), condition, values)
+        if query is None:
+            return {c: np.array([]) for c in columns}
+        _, kinds, _ = self._schema(table_name)
+
+        def arrays(segment, mask):
+            out = []
+            for e in query.select:
+                column = segment.expr(e, mask)
+                out.append(column.decode() if isinstance(column, _Text) else np.asarray(column))
+            return out
+        parts = self._scan(table_name, query, arrays)
+
+        data = {}
+        for i, c in enumerate(columns):
+            chunks = [p[i] for p in parts]
+            if len(chunks) == 0:
+                data[c] = np.array([])
+            elif any(chunk.dtype == object for chunk in chunks):
+                data[c] = np.concatenate([chunk.astype(object) for chunk in chunks])
+            else:
+                data[c] = np.concatenate(chunks)
+            if kinds[query.select[i][1]] == 'real':
+                data[c] = data[c].astype(float)
+        return data
+
+    @track_sql('insert_records')
+    def insert_records(self, table_name, entries):
+        if table_name not in self.tables:
+            return self.main.insert_records(table_name, entries)
+        columns = list(entries.keys())
+        self._append(table_name, columns, [[entries[c] for c in columns]])
+
+    @track_sql('insert_many')
+    def insert_many(self, table_name, columns, rows):
+        if table_name not in self.tables:
+            return self.main.insert_many(table_name, columns, rows)
+        self._append(table_name, columns, rows)
+
+    def _append(self, table_name, columns, rows):
+        if not self.isConnected:
+            self.logger.warning('Database not open')
+            return
+
+        names, _, autoincrement = self._schema(table_name)
+        unknown = [c for c in columns if c not in names]
+        if len(unknown) > 0:
+            self.logger.error('Failed to insert the records')
+            self.logger.error('columnar error : no column(s) %s in %s' % (unknown, table_name))
+            return
+
+        index = [list(columns).index(n) if n in columns else None for n in names]
+        info = self.tables[table_name]
+        buffer = self._buffers.setdefault(table_name, [])
+        for row in rows:
+            row = [None if i is None else row[i] for i in index]
+            if autoincrement is not None:
+                k = names.index(autoincrement)
+                if row[k] is None:
+                    row[k] = info['next_uid']
+                info['next_uid'] = max(info['next_uid'], row[k] + 1)
+            buffer.append(row)
+            if len(buffer) >= SEGMENT_ROWS:
+                self._flush(table_name)
+                buffer = self._buffers.setdefault(table_name, [])
+
+    @track_sql('replace_records')
+    def replace_records(self, table_name, entries):
+        if table_name not in self.tables:
+            return self.main.replace_records(table_name, entries)
+        self.logger.error('replace_records is not supported on columnar table %s' % table_name)
+
+    def table_update(self, table_name, entries, condition):
+        if table_name not in self.tables:
+            return self.main.table_update(table_name, entries, condition)
+        self.logger.error('table_update is not supported on columnar table %s' % table_name)
+
+    @track_sql('delete_records')
+    def delete_records(self, table_name, condition, values):
+        if table_name not in self.tables:
+            return self.main.delete_records(table_name, condition, values)
+        query = self._query(table_name, '*', condition, values)
+        if query is None:
+            return
+
+        # rewrite the segments holding deleted rows
+        self._flush(table_name)
+        names, kinds, _ = self._schema(table_name)
+        replace, rewritten = [], []
+        for (name, nrows), segment in zip(self.tables[table_name]['segments'], self._segments(table_name)):
+            mask = segment.mask(query.terms)
+            if not mask.any():
+                continue
+            replace.append(name)
+            if not mask.all():
+                columns = {n: segment.expr(('col', n), ~mask) for n in names}
+                rewritten.append(_Segment(kinds, nrows=int((~mask).sum()), columns=columns))
+        if len(replace) > 0:
+            self._write_segments(table_name, rewritten, replace)
+
+    def vacuum(self):
+        """Compact every columnar table into full segments"""
+        for table_name in self.tables:
+            self._flush(table_name)
+            segments = self._segments(table_name)
+            names = [s[0] for s in self.tables[table_name]['segments']]
+            if all(s.nrows == SEGMENT_ROWS for s in segments[:-1]):
+                continue
+            merged = self._merge(table_name, segments) if len(segments) > 0 else None
+            compacted = []
+            if merged is not None:
+                _, kinds, _ = self._schema(table_name)
+                for start in range(0, merged.nrows, SEGMENT_ROWS):
+                    rows = slice(start, min(start + SEGMENT_ROWS, merged.nrows))
+                    columns = {n: (c.take(rows) if isinstance(c, _Text) else c[rows]) for n, c in merged._columns.items()}
+                    compacted.append(_Segment(kinds, nrows=rows.stop - rows.start, columns=columns))
+            self._write_segments(table_name, compacted, names)
+        self.main.vacuum()
@@ -0,0 +1,77 @@
+from clusters import DEFAULT_SOURCE
+
+# latest @timestamp ingested from every cluster. Kept apart from job_times so
+# the cursor survives rollup.py deleting the rows it was derived from.
+CURSOR_TABLE = "ingest_cursors"
+CURSOR_COLUMNS = "source text PRIMARY KEY, timestamp text"
+
+# cursor of a cluster nothing has been ingested from yet
+START_TIMESTAMP = "2020-01-01T00:00:00"
+
+
+def save_cursor(db, source, timestamp):
+    """ Move the cursor of a cluster forward to a timestamp, it never moves back
+
+    Parameters
+    ----------
+    db : StorageBackend
+        Database opened for writing, with the cursor table
+
+    source : str
+        Cluster name
+
+    timestamp : str
+        Latest @timestamp ingested from the cluster
+    """
+    rows = db.table_query(CURSOR_TABLE, "timestamp", "source=?", [source]) or []
+    if len(rows) == 0 or rows[0][0] is None or str(timestamp) > rows[0][0]:
+        db.replace_records(CURSOR_TABLE, [{'source': source, 'timestamp': str(timestamp)}])
+
+def record_cursors(db):
+    """ Save the latest timestamp in job_times of every cluster as its cursor
+
+    Run before rows are deleted (rollup.py) and when a database from before
+    the cursor table is first ingested into.
+
+    Parameters
+    ----------
+    db : StorageBackend
+        Database opened for writing
+    """
+    db.create_table(CURSOR_TABLE, columns=CURSOR_COLUMNS)
+    if "source" not in (db.table_column_name("job_times") or []):
+        # jobs ingested before multi-cluster ingest belong to the default cluster
+        rows = db.table_query("job_times", "MAX(timestamp)", "", [])
+        if len(rows) > 0 and rows[0][0] is not None:
+            save_cursor(db, DEFAULT_SOURCE, rows[0][0])
+        return
+
+    sources = {row[0] for row in db.table_query("job_times", "DISTINCT source", "", []) or []}
+    for source in sorted(source for source in sources if source is not None):
+        rows = db.table_query("job_times", "MAX(timestamp)", "source=?", [source])
+        if len(rows) > 0 and rows[0][0] is not None:
+            save_cursor(db, source, rows[0][0])
+
+def load_cursors(db, sources):
+    """ Cursor of every cluster, START_TIMESTAMP for the ones never ingested
+
+    Parameters
+    ----------
+    db : StorageBackend
+        Database opened for writing
+
+    sources : list of str
+        Cluster names
+
+    Returns
+    -------
+    cursors : dict
+        Cluster name -> timestamp to ingest after
+    """
+    db.create_table(CURSOR_TABLE, columns=CURSOR_COLUMNS)
+    stored = dict(db.table_query(CURSOR_TABLE, "source, timestamp", "", []) or [])
+    if any(source not in stored for source in sources):
+        # databases from before the cursor table, or clusters added since the last ingest
+        record_cursors(db)
+        stored = dict(db.table_query(CURSOR_TABLE, "source, timestamp", "", []) or [])
+    return {source: stored.get(source) or START_TIMESTAMP for source in sources}
@@ -0,0 +1,123 @@
+import os
+import time
+import queue
+import fcntl
+import threading
+from concurrent.futures import Future
+
+from sql_database import get_database
+
+# writes waiting for the writer thread before submitters block
+WRITE_QUEUE = 8
+
+_STOP = object()
+
+
+def lock_file(db_path):
+    """ Lock file held by the process writing to a database """
+    return os.path.normpath(db_path) + ".writer.lock"
+
+
+class DatabaseWriter:
+    """ The only connection writing to a database
+
+    Writes are functions of the open database, submitted from any thread and
+    run one at a time, in order, on the writer thread. The queue is bounded so
+    producers faster than the database block instead of buffering pages.
+    A lock file next to the database keeps other writer processes (update.py,
+    rollup.py) waiting while it is open. Readers are not affected: they open
+    the database read only and in WAL mode see the last committed write.
+
+    Parameters
+    ----------
+    db_path : str
+        Database file or directory, must exist
+
+    maxsize : int
+        Writes queued before submit blocks
+
+    Example:
+        with DatabaseWriter('job.db') as writer:
+            future = writer.submit(insert_page, jobs)
+            count = writer.call(lambda db: db.count_rows("job_times", "*", "", []))
+    """
+    def __init__(self, db_path, maxsize=WRITE_QUEUE):
+        self.db_path = db_path
+        self.writes = queue.Queue(maxsize=maxsize)
+        self.db = None
+        self._lock = None
+        self._thread = None
+
+    def start(self):
+        """ Take the writer lock, open the database and start the writer thread """
+        self._lock = open(lock_file(self.db_path), 'w')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print(f"Waiting for the other writer of {self.db_path}")
+            start = time.perf_counter()
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+            print(f"Writer lock of {self.db_path} acquired after {time.perf_counter() - start:.1f} s")
+
+        # sqlite connections belong to the thread that opened them
+        opened = Future()
+        self._thread = threading.Thread(target=self._run, args=(opened,), name="db-writer", daemon=True)
+        self._thread.start()
+        if not opened.result():
+            self._thread.join()
+            self._thread = None
+            self._release()
+            raise RuntimeError("Unable to open %s for writing" % self.db_path)
+        return self
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue func(db, *args, **kwargs), returns a Future of its result """
+        if self._thread is None:
+            raise RuntimeError("Writer of %s is not running" % self.db_path)
+        future = Future()
+        self.writes.put((future, func, args, kwargs))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """ Run func(db, *args, **kwargs) on the writer and wait for its result """
+        return self.submit(func, *args, **kwargs).result()
+
+    def _run(self, opened):
+        self.db = get_database(self.db_path)
+        self.db.open(self.db_path)
+        opened.set_result(self.db.isConnected)
+        if not self.db.isConnected:
+            return
+
+        while True:
+            item = self.writes.get()
+            if item is _STOP:
+                self.db.close()
+                return
+            future, func, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(self.db, *args, **kwargs))
+            except BaseException as err:
+                future.set_exception(err)
+
+    def close(self):
+        """ Finish the queued writes, close the database and release the lock """
+        if self._thread is not None:
+            self.writes.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        self._release()
+
+    def _release(self):
+        if self._lock is not None:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
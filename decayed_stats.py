@@ -0,0 +1,186 @@
+import numpy as np
+
+from timeutils import to_days
+
+# default half-life of a sample's weight in days
+HALF_LIFE = 30.
+
+STATS_TABLE = "decayed_stats"
+STATS_COLUMNS = ("job_type text, instance text, half_life real, weight real, "
+                 "mean real, m2 real, last_time real, PRIMARY KEY (job_type, instance)")
+
+
+class DecayedStats:
+    """ Exponentially time-decayed mean and variance (weighted Welford)
+
+    Every sample starts with a weight of one which halves every `half_life` days,
+    so recent run times dominate the estimate after a regime change.
+    """
+    def __init__(self, half_life=HALF_LIFE, weight=0., mean=0., m2=0., last_time=None):
+        self.half_life = half_life
+        self.weight = weight
+        self.mean = mean
+        self.m2 = m2
+        self.last_time = last_time
+
+    def decay(self, dt):
+        """ Weight multiplier for a time difference in days """
+        return 0.5 ** (dt / self.half_life)
+
+    def update(self, value, time):
+        """ Add a sample
+
+        Parameters
+        ----------
+        value : float
+            Sample value (e.g. run time in days)
+
+        time : float
+            Time of the sample in days since the unix epoch
+        """
+        if self.last_time is None:
+            self.last_time = time
+
+        if time >= self.last_time:
+            # age the accumulator up to the new sample
+            factor = self.decay(time - self.last_time)
+            self.weight *= factor
+            self.m2 *= factor
+            self.last_time = time
+            w = 1.
+        else:
+            # late arrival, age the sample instead
+            w = self.decay(self.last_time - time)
+
+        self.weight += w
+        delta = value - self.mean
+        self.mean += w * delta / self.weight
+        self.m2 += w * delta * (value - self.mean)
+
+    def merge(self, other):
+        """ Combine with another accumulator (Chan's parallel algorithm)
+
+        Parameters
+        ----------
+        other : DecayedStats
+            Accumulator to merge into this one
+        """
+        if other.weight <= 0:
+            return
+        if self.weight <= 0:
+            self.weight, self.mean, self.m2, self.last_time = \
+                other.weight, other.mean, other.m2, other.last_time
+            return
+
+        # bring both to a common reference time
+        t = max(self.last_time, other.last_time)
+        fa = self.decay(t - self.last_time)
+        fb = self.decay(t - other.last_time)
+        wa, wb = self.weight * fa, other.weight * fb
+
+        weight = wa + wb
+        delta = other.mean - self.mean
+        self.mean += delta * wb / weight
+        self.m2 = self.m2 * fa + other.m2 * fb + delta**2 * wa * wb / weight
+        self.weight = weight
+        self.last_time = t
+
+    @property
+    def variance(self):
+        if self.weight <= 0:
+            return 0.
+        return self.m2 / self.weight
+
+    @property
+    def std(self):
+        return np.sqrt(max(self.variance, 0.))
+
+    def effective_count(self, time):
+        """ Sum of the sample weights as seen at `time` (days since epoch) """
+        if self.last_time is None:
+            return 0.
+        return self.weight * self.decay(max(0., time - self.last_time))
+
+    def to_record(self, job_type, instance):
+        return {
+            'job_type': job_type,
+            'instance': instance,
+            'half_life': self.half_life,
+            'weight': self.weight,
+            'mean': self.mean,
+            'm2': self.m2,
+            'last_time': self.last_time
+        }
+
+    @classmethod
+    def from_row(cls, row):
+        """ Build from a (half_life, weight, mean, m2, last_time) row """
+        return cls(half_life=row[0], weight=row[1], mean=row[2], m2=row[3], last_time=row[4])
+
+
+def update_decayed_stats(db, job_types, instances, run_times, timestamps, half_life=HALF_LIFE):
+    """ Fold newly ingested jobs into the persisted accumulators
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database with a decayed_stats table
+
+    job_types : array of str
+        Job type of each new job
+
+    instances : array of str
+        Instance type of each new job
+
+    run_times : array of float
+        Run time of each new job in days
+
+    timestamps : array of str
+        ISO-8601 timestamp of each new job
+
+    half_life : float
+        Half-life of the sample weights in days
+    """
+    if len(run_times) == 0:
+        return
+
+    times = to_days(list(timestamps))
+    order = np.argsort(times, kind='stable')
+
+    accumulators = {}
+    for j in order:
+        if np.isnan(times[j]):
+            continue
+
+        key = (str(job_types[j]), str(instances[j]))
+        if key not in accumulators:
+            rows = db.table_query(STATS_TABLE, "half_life, weight, mean, m2, last_time",
+                                  "job_type=? AND instance=?", list(key))
+            if len(rows) > 0 and rows[0][0] == half_life:
+                accumulators[key] = DecayedStats.from_row(rows[0])
+            else:
+                # new key or the half-life was reconfigured
+                accumulators[key] = DecayedStats(half_life=half_life)
+
+        accumulators[key].update(float(run_times[j]), float(times[j]))
+
+    db.replace_records(STATS_TABLE, [acc.to_record(*key) for key, acc in accumulators.items()])
+
+def rebuild_decayed_stats(db, half_life=HALF_LIFE):
+    """ Recompute all accumulators from the job_times table, e.g. after changing the half-life
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database
+
+    half_life : float
+        Half-life of the sample weights in days
+    """
+    db.create_table(STATS_TABLE, columns=STATS_COLUMNS)
+    db.delete_records(STATS_TABLE, "1=1", [])
+    rows = db.table_query("job_times", "job_type, instance, run_time, timestamp", "run_time > 0", [])
+    if len(rows) == 0:
+        return
+    job_types, instances, run_times, timestamps = zip(*rows)
+    update_decayed_stats(db, job_types, instances, run_times, timestamps, half_life=half_life)
@@ -1,2 +1,2 @@
 #!/bin/bash
-python /home/job-etc/webserver.py
\ No newline at end of file
+python /home/job-etc/asyncserver.py
\ No newline at end of file
@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import time
+import codecs
+
+import metrics
+
+
+class HitStream:
+    """ Hits of a search response decoded one at a time as the body arrives
+
+    Only the bytes of the hit being decoded are held in memory, instead of the
+    whole body and every hit as nested dicts like res.json(). The total is
+    parsed from the part of the body before the hits.
+
+    Example:
+        stream = HitStream(res.iter_content(65536))
+        for hit in stream:
+            ...
+        print(stream.total, stream.bytes, stream.peak_buffer)
+    """
+    _hits = re.compile(r'"hits"\s*:\s*\[')
+    _outer = re.compile(r'"hits"\s*:\s*\{')
+    _total = re.compile(r'"total"\s*:\s*')
+
+    def __init__(self, chunks, status_code=200, on_close=None):
+        self.status_code = status_code
+        self.total = None
+        self.bytes = 0          # body bytes received
+        self.peak_buffer = 0    # most characters buffered at once
+        self.hits_read = 0
+        self.text = ''          # body up to the hits, e.g. an error message
+
+        self._chunks = iter(chunks)
+        self._on_close = on_close
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._done = False
+        self._read_header()
+
+    def _read(self):
+        for chunk in self._chunks:
+            if chunk:
+                self.bytes += len(chunk)
+                self._buffer += self._utf8.decode(chunk)
+                self.peak_buffer = max(self.peak_buffer, len(self._buffer))
+                return True
+        return False
+
+    def _read_header(self):
+        while True:
+            match = self._hits.search(self._buffer)
+            if match is not None:
+                break
+            if not self._read():
+                # no hits array, e.g. an error response
+                self.text = self._buffer
+                self._done = True
+                return
+
+        self.text = self._buffer[:match.start()]
+        outer = self._outer.search(self.text)
+        total = self._total.search(self.text, outer.end()) if outer is not None else None
+        if total is not None:
+            self.total, _ = self._decoder.raw_decode(self.text, total.end())
+        self._buffer = self._buffer[match.end():]
+
+    def __iter__(self):
+        try:
+            yield from self._iter_hits()
+        finally:
+            if self._on_close is not None:
+                self._on_close(self)
+                self._on_close = None
+
+    def _iter_hits(self):
+        pos = 0
+        while not self._done:
+            # skip separators between hits
+            while pos < len(self._buffer) and self._buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(self._buffer):
+                self._buffer, pos = '', 0
+                if not self._read():
+                    raise ValueError("Search response ended inside the hits")
+                continue
+            if self._buffer[pos] == ']':
+                self._done = True
+                while self._read(): # count the rest of the body
+                    self._buffer = ''
+                break
+
+            try:
+                hit, end = self._decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:
+                # incomplete hit, keep it and append the next chunk
+                self._buffer, pos = self._buffer[pos:], 0
+                if not self._read():
+                    raise
+                continue
+
+            self.hits_read += 1
+            pos = end
+            yield hit
+        self._buffer = ''
+
+def search_hits(query, endpoint, index="_search", source=None, chunk_size=65536, **kwargs):
+    """ Streaming search, hits are decoded incrementally instead of with res.json()
+
+    Parameters
+    ----------
+    query : dict
+        Elastic search query
+
+    endpoint : str
+        Elastic search endpoint
+
+    index : str
+        Index and API path appended to the endpoint
+
+    source : list of str
+        _source fields to return (dotted paths), None for whole documents
+
+    chunk_size : int
+        Bytes read from the connection at a time
+
+    kwargs : dict
+        Passed on to requests.post (headers, verify, auth, ...)
+
+    Returns
+    -------
+    hits : HitStream
+        Iterable of hits with the total, status code and bytes transferred
+    """
+    if source is not None:
+        query = dict(query, _source={"includes": list(source)})
+    import requests
+    body = json.dumps(query)
+    start = time.perf_counter()
+    res = requests.post(os.path.join(endpoint, index), data=body, stream=True, **kwargs)
+
+    # the duration and response size are known once the body has been read, as in search_hits_async
+    def close(stream):
+        metrics.es_request_duration.observe(time.perf_counter() - start, index=index, status=res.status_code)
+        metrics.es_response_bytes.observe(stream.bytes, index=index)
+        res.close()
+
+    stream = HitStream(res.iter_content(chunk_size), status_code=res.status_code, on_close=close)
+    metrics.es_request_bytes.observe(len(body), index=index)
+    return stream
+
+async def search_hits_async(session, query, endpoint, index="_search", source=None, **kwargs):
+    """ search_hits awaited on a shared aiohttp session, for asyncserver.py
+
+    The body is read without blocking the event loop and decoded by the same
+    HitStream, once it has arrived.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Pooled client shared by all requests of the server
+
+    query, endpoint, index, source :
+        As for search_hits
+
+    kwargs : dict
+        Passed on to session.post (headers, ssl, auth, ...)
+
+    Returns
+    -------
+    hits : HitStream
+    """
+    if source is not None:
+        query = dict(query, _source={"includes": list(source)})
+    body = json.dumps(query)
+    start = time.perf_counter()
+    async with session.post(os.path.join(endpoint, index), data=body, **kwargs) as res:
+        content = await res.read()
+        status = res.status
+
+    metrics.es_request_duration.observe(time.perf_counter() - start, index=index, status=status)
+    metrics.es_request_bytes.observe(len(body), index=index)
+    metrics.es_response_bytes.observe(len(content), index=index)
+    return HitStream([content], status_code=status)
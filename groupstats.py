@@ -0,0 +1,277 @@
+import numpy as np
+
+
+def group_sort(keys, values):
+    """ Sort values by key and then by value
+
+    Parameters
+    ----------
+    keys : array
+        Group key of each value (e.g. job type)
+
+    values : array of float
+        Values to summarize
+
+    Returns
+    -------
+    ukeys : np.ndarray
+        Sorted unique keys
+
+    sorted_values : np.ndarray
+        Values sorted by key, ascending within each key
+
+    starts : np.ndarray
+        Index of the first value of each key in sorted_values
+
+    counts : np.ndarray
+        Number of values of each key
+    """
+    ukeys, inverse = np.unique(np.asarray(keys), return_inverse=True)
+    values = np.asarray(values, dtype=float)
+    order = np.lexsort((values, inverse))
+    counts = np.bincount(inverse, minlength=len(ukeys))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    return ukeys, values[order], starts, counts
+
+def segment_percentile(sorted_values, starts, counts, q):
+    """ Percentile of each segment of an array sorted within segments
+
+    Uses linear interpolation like np.percentile. Empty segments return NaN.
+
+    Parameters
+    ----------
+    sorted_values : np.ndarray
+        Values, ascending within each segment
+
+    starts : np.ndarray
+        First index of each segment
+
+    counts : np.ndarray
+        Length of each segment
+
+    q : float
+        Percentile between 0 and 100
+
+    Returns
+    -------
+    percentiles : np.ndarray
+    """
+    result = np.full(len(starts), np.nan)
+    ok = counts > 0
+    pos = starts[ok] + q/100. * (counts[ok] - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    result[ok] = sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+    return result
+
+def segment_sum(values, starts, counts):
+    """ Sum of each segment, empty segments sum to zero """
+    result = np.zeros(len(starts))
+    ok = counts > 0
+    if ok.any():
+        result[ok] = np.add.reduceat(values, starts[ok])
+    return result
+
+def segment_mean_std(values, starts, counts):
+    """ Mean and (population) standard deviation of each segment """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = segment_sum(values, starts, counts) / counts
+        spread = np.repeat(mean, counts)
+        std = np.sqrt(segment_sum((values - spread)**2, starts, counts) / counts)
+    return mean, std
+
+def group_runtime_stats(keys, run_times):
+    """ The runtime_prediction model evaluated for every key at once
+
+    Groups with ten or more samples drop values at or above their 90th percentile
+    and report the median, standard deviation and 1st/99th percentiles of the
+    rest. Smaller groups report the median, standard deviation, min and max,
+    a single run time is its own standard deviation. Groups whose values are
+    all equal keep the full sample.
+
+    Parameters
+    ----------
+    keys : array
+        Group key of each run time (e.g. job type)
+
+    run_times : array of float
+        Run times in days
+
+    Returns
+    -------
+    ukeys : np.ndarray
+        Sorted unique keys
+
+    run_avg, run_std, run_low, run_high : np.ndarray
+        Statistics aligned with ukeys
+
+    counts : np.ndarray
+        Number of samples per key
+    """
+    ukeys, values, starts, counts = group_sort(keys, run_times)
+    if len(ukeys) == 0:
+        empty = np.array([])
+        return ukeys, empty, empty, empty, empty, counts
+
+    # values below the 90th percentile form a prefix of each sorted segment
+    p90 = segment_percentile(values, starts, counts, 90)
+    below = segment_sum((values < np.repeat(p90, counts)).astype(float), starts, counts).astype(int)
+    masked = (counts >= 10) & (below > 0)
+    kept = np.where(masked, below, counts)
+
+    # compact the kept values so every segment is contiguous again
+    offsets = np.concatenate([[0], np.cumsum(kept)[:-1]]).astype(int)
+    index = np.repeat(starts - offsets, kept) + np.arange(kept.sum())
+    kept_values = values[index]
+
+    run_avg = segment_percentile(kept_values, offsets, kept, 50)
+    _, run_std = segment_mean_std(kept_values, offsets, kept)
+    run_low = np.where(masked, segment_percentile(kept_values, offsets, kept, 1),
+                       segment_percentile(kept_values, offsets, kept, 0))
+    run_high = np.where(masked, segment_percentile(kept_values, offsets, kept, 99),
+                        segment_percentile(kept_values, offsets, kept, 100))
+    run_std = np.where(counts == 1, run_avg, run_std)
+    return ukeys, run_avg, run_std, run_low, run_high, counts
+
+def merged_runtime_stats(keys, run_times, hists, centers):
+    """ group_runtime_stats with rolled up histograms merged into their keys
+
+    Keys with a histogram are summarized with weighted_runtime_stats over
+    their recent run times plus the bin centers weighted by the counts,
+    which is what runtime_prediction does for one key.
+
+    Parameters
+    ----------
+    keys : array
+        Group key of each recent run time
+
+    run_times : array of float
+        Recent run times in days
+
+    hists : dict
+        Key -> jobs per histogram bin
+
+    centers : np.ndarray
+        Run time of every histogram bin in days
+
+    Returns
+    -------
+    stats : dict
+        Key -> (run_avg, run_std, run_low, run_high, count) for every key
+        with recent run times or a histogram
+    """
+    keys = np.asarray(keys)
+    ukeys, run_avg, run_std, run_low, run_high, counts = group_runtime_stats(keys, run_times)
+    stats = {str(k): (run_avg[i], run_std[i], run_low[i], run_high[i], int(counts[i])) for i, k in enumerate(ukeys)}
+    if len(hists) == 0:
+        return stats
+
+    ukeys, values, starts, counts = group_sort(keys, run_times)
+    for key, hist in hists.items():
+        i = np.searchsorted(ukeys, key)
+        recent = values[starts[i]:starts[i]+counts[i]] if i < len(ukeys) and ukeys[i] == key else np.array([])
+        merged = weighted_runtime_stats(np.concatenate([recent, centers]),
+                                        np.concatenate([np.ones(len(recent), dtype=int), hist]))
+        stats[key] = tuple(merged) + (len(recent) + int(np.sum(hist)),)
+    return stats
+
+def weighted_percentile(values, weights, q):
+    """ Percentile of integer-weighted values
+
+    Equal to np.percentile of the values repeated by their weights, without
+    expanding them.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values sorted in ascending order
+
+    weights : np.ndarray
+        Positive integer weight (count) of each value
+
+    q : float
+        Percentile between 0 and 100
+
+    Returns
+    -------
+    percentile : float
+    """
+    ends = np.cumsum(weights) - 1 # last position of each value when expanded
+    pos = q/100. * ends[-1]
+    i = np.searchsorted(ends, pos, side='left')
+    if i == 0 or pos >= ends[i-1] + 1:
+        return values[i]
+    frac = pos - ends[i-1]
+    return values[i-1] + (values[i] - values[i-1]) * frac
+
+def weighted_runtime_stats(values, weights):
+    """ The runtime_prediction model for integer-weighted run times
+
+    Gives the same result as runtime_prediction on the values repeated by
+    their weights, e.g. histogram bin centers weighted by their counts.
+
+    Parameters
+    ----------
+    values : array of float
+        Run times in days
+
+    weights : array of int
+        Number of jobs with each run time
+
+    Returns
+    -------
+    run_avg, run_std, run_low, run_high : float
+    """
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=np.int64)
+    keep = weights > 0
+    order = np.argsort(values[keep], kind='stable')
+    values, weights = values[keep][order], weights[keep][order]
+
+    n = weights.sum()
+    if n == 0:
+        return 0, 0, 0, 0
+
+    def std(v, w):
+        mean = np.sum(v*w) / w.sum()
+        return np.sqrt(np.sum(w*(v - mean)**2) / w.sum())
+
+    if n == 1:
+        return values[0], values[0], values[0], values[0]
+    if n < 10:
+        return weighted_percentile(values, weights, 50), std(values, weights), values[0], values[-1]
+
+    mask = values < weighted_percentile(values, weights, 90)
+    if mask.any():
+        values, weights = values[mask], weights[mask]
+    return weighted_percentile(values, weights, 50), std(values, weights), \
+        weighted_percentile(values, weights, 1), weighted_percentile(values, weights, 99)
+
+def group_summary(keys, values, percentiles=(1, 50, 99)):
+    """ Descriptive statistics of the values of every key at once
+
+    Parameters
+    ----------
+    keys : array
+        Group key of each value (e.g. job type)
+
+    values : array of float
+        Values to summarize
+
+    percentiles : tuple of float
+        Percentiles to report, between 0 and 100
+
+    Returns
+    -------
+    summary : dict
+        Arrays aligned with the sorted unique keys: key, count, mean, std
+        (population), min, max and p<q> for every percentile
+    """
+    ukeys, values, starts, counts = group_sort(keys, values)
+    mean, std = segment_mean_std(values, starts, counts)
+    summary = {'key': ukeys, 'count': counts, 'mean': mean, 'std': std,
+               'min': segment_percentile(values, starts, counts, 0),
+               'max': segment_percentile(values, starts, counts, 100)}
+    for q in percentiles:
+        summary[f'p{q:g}'] = segment_percentile(values, starts, counts, q)
+    return summary
@@ -0,0 +1,277 @@
+import sys
+import time
+import bisect
+import resource
+import threading
+from functools import wraps
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# payload buckets in bytes
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """ Base class for a metric family with optional labels """
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Counter(Metric):
+    """ Monotonically increasing value """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """ Value that can go up and down """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    """ Cumulative histogram of observations, e.g. request durations """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0]*(len(self.buckets)+1), 0., 0]
+            state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """ Context manager observing the elapsed wall time """
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return 0 if state is None else state[2]
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(float(total))}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+class Registry:
+    """ Collection of metrics rendered in the Prometheus text format """
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Duplicate metric {metric.name}")
+            self._metrics[metric.name] = metric
+
+    def add_collector(self, collector):
+        """ Register a callable run at scrape time, e.g. to refresh gauges """
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                scrape_errors.inc(collector=getattr(collector, '__name__', 'collector'))
+
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+scrape_errors = Counter("etc_metrics_collector_errors_total", "Failed metric collectors at scrape time", ["collector"])
+
+http_request_duration = Histogram("etc_http_request_duration_seconds", "Web server request latency", ["route", "method", "status"])
+
+sql_query_duration = Histogram("etc_sql_query_duration_seconds", "SQLite call duration by call site", ["call", "table"])
+
+es_request_duration = Histogram("etc_es_request_duration_seconds", "Elastic search request duration", ["index", "status"])
+es_request_bytes = Histogram("etc_es_request_bytes", "Elastic search request payload size", ["index"], buckets=SIZE_BUCKETS)
+es_response_bytes = Histogram("etc_es_response_bytes", "Elastic search response payload size", ["index"], buckets=SIZE_BUCKETS)
+
+ingest_rows = Gauge("etc_ingest_last_rows", "Rows inserted by the last ingest run")
+ingest_seconds = Gauge("etc_ingest_last_duration_seconds", "Duration of the last ingest run")
+ingest_rate = Gauge("etc_ingest_last_rows_per_second", "Insert rate of the last ingest run")
+ingest_timestamp = Gauge("etc_ingest_last_timestamp_seconds", "Unix time the last ingest run finished")
+
+cache_requests = Counter("etc_cache_requests_total", "Cache lookups by cache and result (hit or miss)", ["cache", "result"])
+cache_hit_ratio = Gauge("etc_cache_hit_ratio", "Fraction of cache lookups that were hits", ["cache"])
+
+coalesced_requests = Counter("etc_coalesced_requests_total", "Calls that computed a result (leader) or shared one in flight (waiter)", ["group", "role"])
+
+stream_clients = Gauge("etc_queue_stream_clients", "Clients subscribed to /queuetime/stream")
+stream_events = Counter("etc_queue_stream_events_total", "Queue estimates published to /queuetime/stream")
+stream_dropped = Counter("etc_queue_stream_dropped_total", "Events dropped for clients that fell behind")
+queue_rebuilds = Counter("etc_queue_estimate_rebuilds_total", "Full rebuilds of the incremental queue estimate that matched (consistent) or fixed (corrected) it", ["result"])
+
+running_jobs = Gauge("etc_running_jobs", "Jobs in the running job index of /eta")
+running_resyncs = Counter("etc_running_index_resyncs_total", "Full reloads of the running job index that matched (consistent) or fixed (corrected) it", ["result"])
+
+async_requests = Gauge("etc_async_requests_in_flight", "Requests of asyncserver.py awaiting elastic search or the database", ["route"])
+
+
+def track_sql(call):
+    """ Decorator timing a SQLDatabase method, labelled by call site and table """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, table_name, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(self, table_name, *args, **kwargs)
+            finally:
+                sql_query_duration.observe(time.perf_counter() - start, call=call, table=table_name)
+        return wrapper
+    return decorator
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024**2 # bytes
+    return rss / 1024 # kilobytes
+
+def cache_lookup(cache, hit):
+    """ Record a cache hit or miss """
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+def _update_cache_ratios():
+    caches = {key[0] for key in list(cache_requests._values)}
+    for cache in caches:
+        hits = cache_requests.value(cache=cache, result="hit")
+        total = hits + cache_requests.value(cache=cache, result="miss")
+        cache_hit_ratio.set(hits / total if total else 0., cache=cache)
+
+REGISTRY.add_collector(_update_cache_ratios)
+
+INGEST_TABLE = "ingest_runs"
+INGEST_COLUMNS = "uid integer primary key autoincrement, finished real, seconds real, rows integer"
+
+def record_ingest(db, seconds, rows):
+    """ Persist the summary of an ingest run, which happens in its own process
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open job database
+
+    seconds : float
+        Duration of the run
+
+    rows : int
+        Number of rows inserted
+    """
+    db.create_table(INGEST_TABLE, columns=INGEST_COLUMNS)
+    db.insert_records(INGEST_TABLE, {"finished": time.time(), "seconds": seconds, "rows": rows})
+
+def load_ingest_metrics(db):
+    """ Set the ingest gauges from the most recent run stored in the database """
+    if (INGEST_TABLE,) not in (db.table_names or []):
+        return
+    rows = db.table_query(INGEST_TABLE, "finished, seconds, rows", "uid = (SELECT MAX(uid) FROM %s)" % INGEST_TABLE, [])
+    if len(rows) > 0:
+        finished, seconds, nrows = rows[0]
+        ingest_timestamp.set(finished)
+        ingest_seconds.set(seconds)
+        ingest_rows.set(nrows)
+        ingest_rate.set(nrows / seconds if seconds > 0 else 0.)
@@ -4,16 +4,28 @@ import json
 import logging
 import warnings
 import argparse
-import requests
 import numpy as np
-from astropy.time import Time
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings('ignore')
 
-from sql_database import SQLDatabase
+from clusters import CLUSTERS_FILE, DEFAULT_ENDPOINT, load_clusters, select
+from sql_database import get_database
+from decayed_stats import DecayedStats, STATS_TABLE
+from groupstats import merged_runtime_stats, weighted_runtime_stats
+from rollup import HIST_TABLE, NBINS, load_histogram, bin_centers, decode_counts
+from timeutils import now_days, to_datetime64
+from waittime import QUANTILES, load_wait_sketch, sketch_quantiles
+from param_stats import load_params_sketch, sketch_stats
+from profiling import pool_map
 
-es_endpoint = "http://18.236.110.240:49200/"
+# endpoint of the default cluster when no clusters file is configured, patched by the benchmarks
+es_endpoint = DEFAULT_ENDPOINT
 
-def runtime_prediction(jobtype, instance="c5.9xlarge", size=100):
+# _source fields read from queued and running job documents
+QUEUE_FIELDS = ["type"]
+STARTED_FIELDS = ["type", "job_id", "job.job_info.time_start"]
+
+def runtime_prediction(jobtype, instance="c5.9xlarge", size=100, sqldb='job.db', source=None):
     """ Returns the average and standard deviation of the runtime for a job type.
 
     Parameters
@@ -27,8 +39,11 @@ def runtime_prediction(jobtype, instance="c5.9xlarge", size=100):
     size : int
         Number of hits to use to compute the average
 
-    url : str
-        Elastic search endpoint
+    sqldb : str
+        SQLite database file
+
+    source : str
+        Only jobs of this cluster, None or * for all clusters
 
     Returns
     -------
@@ -45,17 +60,27 @@ def runtime_prediction(jobtype, instance="c5.9xlarge", size=100):
         Upper percentile of runtime
     """
 
-    jobs = return_jobs_sql(jobtype, instance, size=size)
+    run_times = return_runtimes_sql(jobtype, instance, sqldb=sqldb, source=source)
+    if source is None or source == "*":
+        counts = return_histogram_sql(jobtype, instance, sqldb=sqldb)
+    else:
+        counts = np.zeros(NBINS, dtype=np.int64) # rolled up histograms are not kept per cluster
     
-    if len(jobs) == 0:
+    if len(run_times) == 0 and counts.sum() == 0:
         print(f"No {jobtype} found in db...")
-        return 0,0
+        return 0,0,0,0
 
     # simple model
-    run_times = np.array([job['run_time'] for job in jobs])
 
-    # mask outliers
+    if counts.sum() > 0:
+        # old jobs were rolled up into histograms, merge them with the recent rows
+        return weighted_runtime_stats(np.concatenate([run_times, bin_centers()]),
+                                      np.concatenate([np.ones(len(run_times), dtype=int), counts]))
+
+    # mask outliers, all equal run times have none
     mask = run_times < np.percentile(run_times, 90)
+    if not mask.any():
+        mask[:] = True
 
     if np.isnan(run_times.mean()):
         return 0,0,0,0 # not enough historical data
@@ -67,10 +92,131 @@ def runtime_prediction(jobtype, instance="c5.9xlarge", size=100):
         else:
             return np.median(run_times[mask]), np.std(run_times[mask]), np.percentile(run_times[mask],1), np.percentile(run_times[mask],99)
 
+def decayed_prediction(jobtype, instance="c5.9xlarge", sqldb='job.db'):
+    """ Returns the time-decayed average and standard deviation of the runtime for a job type.
+
+    Reads the accumulators maintained by update.py, so an exact job type and
+    instance is a single primary key lookup. Wildcards merge the matching keys.
+
+    Parameters
+    ----------
+    jobtype : str
+        Name of the job type to search for, or *
+
+    instance : str
+        Name of the instance running the job, or *
+
+    sqldb : str
+        SQLite database file
+
+    Returns
+    -------
+    run_avg : float
+        Decayed average runtime of the job type in days
+
+    run_std : float
+        Decayed standard deviation of the runtime in days
+
+    weight : float
+        Effective number of samples behind the estimate as of now
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+
+    columns = "half_life, weight, mean, m2, last_time"
+    if jobtype == "*" and instance == "*":
+        rows = db.table_query(STATS_TABLE, columns, "", [])
+    elif jobtype == "*":
+        rows = db.table_query(STATS_TABLE, columns, "instance=?", [instance])
+    elif instance == "*":
+        rows = db.table_query(STATS_TABLE, columns, "job_type=?", [jobtype])
+    else:
+        rows = db.table_query(STATS_TABLE, columns, "job_type=? AND instance=?", [jobtype, instance])
+
+    db.close()
+
+    if len(rows) == 0:
+        print(f"No decayed statistics for {jobtype} on {instance}...")
+        return 0,0,0
+
+    stats = DecayedStats.from_row(rows[0])
+    for row in rows[1:]:
+        stats.merge(DecayedStats.from_row(row))
+
+    return stats.mean, stats.std, stats.effective_count(now_days())
+
+def params_prediction(jobtype, instance, fingerprint, sqldb='job.db'):
+    """ Returns runtime_prediction for the jobs of a job type that ran with the same parameters
+
+    Read from the per (job type, instance, params fingerprint) sketches
+    maintained by update.py, so an exact key is a single primary key lookup.
+
+    Parameters
+    ----------
+    jobtype : str
+        Name of the job type
+
+    instance : str
+        Name of the instance, or *
+
+    fingerprint : str
+        param_stats.params_fingerprint of the job's parameters
+
+    sqldb : str
+        SQLite database file
+
+    Returns
+    -------
+    run_avg, run_std, run_low, run_high : float
+        As runtime_prediction, in days
+
+    count : int
+        Number of jobs of the mode, 0 when it is unknown
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    counts = load_params_sketch(db, jobtype, instance, fingerprint)
+    db.close()
+    return (*sketch_stats(counts), int(counts.sum()))
+
+def waittime_prediction(jobtype, queue="*", sqldb='job.db', quantiles=QUANTILES):
+    """ Returns quantiles of the time jobs wait in the queue before they start
+
+    Read from the per job type and queue sketches maintained by update.py,
+    so an exact key is a single primary key lookup.
+
+    Parameters
+    ----------
+    jobtype : str
+        Name of the job type, or *
+
+    queue : str
+        Name of the queue the job is submitted to, or *
+
+    sqldb : str
+        SQLite database file
+
+    quantiles : list of float
+        Percentiles to return
+
+    Returns
+    -------
+    waits : np.ndarray
+        Queue time at every quantile in days, NaN without history
+
+    count : int
+        Number of jobs behind the estimate
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    counts = load_wait_sketch(db, jobtype, queue)
+    db.close()
+    return sketch_quantiles(counts, quantiles), int(counts.sum())
+
 def return_jobs_sql(jobtype, instance, size=100, sqldb='job.db'):
     # query for N jobs of type job_type
-    db = SQLDatabase()
-    db.open(sqldb)
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
 
     if jobtype == "*" and instance == "*":
         jerbs = db.table_query("job_times", "*", "", [] )
@@ -101,111 +247,318 @@ def return_jobs_sql(jobtype, instance, size=100, sqldb='job.db'):
     del jerbs
     return jdata
 
-def get_queue(size=1000):
+def job_condition(jobtype, instance, source=None):
+    """ WHERE clause and values selecting a job type, instance and cluster, * matches any """
+    terms, values = [], []
+    for column, value in (("job_type", jobtype), ("instance", instance), ("source", source)):
+        if value is not None and value != "*":
+            terms.append(column + "=?")
+            values.append(value)
+    return " AND ".join(terms), values
+
+def return_runtimes_sql(jobtype, instance, sqldb='job.db', source=None):
+    """ Returns the run times of a job type as an array, without building rows
+
+    Parameters
+    ----------
+    jobtype : str
+        Name of the job type, or *
+
+    instance : str
+        Name of the instance, or *
+
+    sqldb : str
+        SQLite database file
+
+    source : str
+        Cluster, None or * for all
+
+    Returns
+    -------
+    run_times : np.ndarray
+        Run times in days
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    data = db.column_query("job_times", ["run_time"], *job_condition(jobtype, instance, source))
+    db.close()
+    return data["run_time"].astype(float)
+
+def return_histogram_sql(jobtype, instance, sqldb='job.db'):
+    """ Returns the run time histogram of rolled up jobs (see rollup.py)
+
+    Parameters
+    ----------
+    jobtype : str
+        Name of the job type, or *
+
+    instance : str
+        Name of the instance, or *
+
+    sqldb : str
+        SQLite database file
+
+    Returns
+    -------
+    counts : np.ndarray
+        Number of jobs per log-spaced run time bin
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+
+    if jobtype == "*" and instance == "*":
+        counts = load_histogram(db)
+    elif jobtype == "*":
+        counts = load_histogram(db, "instance=?", [instance])
+    elif instance == "*":
+        counts = load_histogram(db, "job_type=?", [jobtype])
+    else:
+        counts = load_histogram(db, "job_type=? AND instance=?", [jobtype, instance])
+
+    db.close()
+    return counts
+
+def get_clusters(source=None):
+    """ Configured clusters (clusters.py) matching a source, all of them for None or * """
+    return select(load_clusters(CLUSTERS_FILE, endpoint=es_endpoint), source)
+
+def search_clusters(query, fields, label, source=None, status_index=False):
+    """ Hits of a query on every selected cluster, queried concurrently
+
+    Each hit is tagged with the name of its cluster under "_cluster".
+    Returns None when no cluster answered.
+    """
+    def run(cluster):
+        res = cluster.search_hits(query, source=fields, index=cluster.status_index if status_index else None)
+        hits = list(res)
+        for hit in hits:
+            hit['_cluster'] = cluster.name
+        return cluster, res, hits
+
+    clusters = get_clusters(source)
+    if len(clusters) == 1:
+        results = [run(clusters[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(clusters)) as pool:
+            results = pool_map(lambda: pool, run, clusters)
+    return _cluster_jobs(results, label)
+
+async def search_clusters_async(session, query, fields, label, source=None, status_index=False):
+    """ search_clusters awaited on a shared aiohttp session, see asyncserver.py """
+    import asyncio
+    async def run(cluster):
+        res = await cluster.search_hits_async(session, query, source=fields,
+                                              index=cluster.status_index if status_index else None)
+        hits = list(res)
+        for hit in hits:
+            hit['_cluster'] = cluster.name
+        return cluster, res, hits
+
+    results = await asyncio.gather(*[run(cluster) for cluster in get_clusters(source)])
+    return _cluster_jobs(results, label)
+
+def _cluster_jobs(results, label):
+    jobs, answered = [], 0
+    for cluster, res, hits in results:
+        if res.status_code == 200:
+            print(f"Number of {label} ({cluster.name}):", res.total)
+            print("  jobs returned:", len(hits))
+            jobs.extend(hits)
+            answered += 1
+        else:
+            print(f"Error ({cluster.name}):", res.status_code)
+            print(res.text)
+    return jobs if answered > 0 else None
+
+def get_queue(size=1000, source=None):
     """ Returns the jobs in the queue
 
     Parameters
     ----------
     size : int
-        Number of hits to use to compute the average
+        Maximum number of jobs to return per cluster
 
-    url : str
-        Elastic search endpoint
+    source : str
+        Cluster to query, None or * for all of them
 
     Returns
     -------
     jobs : list of dicts
         List of jobs currently queued
     """
-    # build query
-    query = {"query":{"bool":{"must":[{"wildcard":{"type":"*"}},{"match":{"status":"job-queued"}}],
+    # query for jobs queued
+    return search_clusters(status_query("job-queued", size), QUEUE_FIELDS, "jobs in queue", source=source)
+
+async def get_queue_async(session, size=1000, source=None):
+    """ get_queue awaited on a shared aiohttp session """
+    return await search_clusters_async(session, status_query("job-queued", size), QUEUE_FIELDS,
+                                       "jobs in queue", source=source)
+
+def status_query(status, size):
+    """ Query for the oldest jobs in a status, e.g. job-queued """
+    return {"query":{"bool":{"must":[{"wildcard":{"type":"*"}},{"match":{"status":status}}],
                 "must_not":[],"should":[]}},"from":0,"size":size,"sort":[{"@timestamp":{"order":"asc"}}],"aggs":{}}
 
-    # query for jobs queued
-    #endpoint = os.path.join(es_endpoint, "job_status-current/_search")
-    endpoint = os.path.join(es_endpoint, "_search")
+def grouped_runtime_prediction(jobtypes, instance="*", sqldb='job.db', source=None):
+    """ Returns runtime_prediction for several job types with one query
 
-    res = requests.post(endpoint, data=json.dumps(query), headers={"Content-Type":"application/json"})#, verify=False, auth=(os.environ['JUSERNAME'], os.environ['JPASSWORD']))
+    Recent jobs are grouped by job type and the rolled up histograms of each
+    job type are merged in, as runtime_prediction does for one job type.
 
-    if res.status_code == 200:
-        search_result = res.json()
-        print("Number of jobs in queue:", search_result['hits']['total'])
-        print("  jobs returned:", len(search_result['hits']['hits']))
-        return search_result['hits']['hits']
-    else:
-        print("Error:", res.status_code)
-        print(res.text)
-        return None
+    Parameters
+    ----------
+    jobtypes : list of str
+        Names of the job types
+
+    instance : str
+        Name of the instance running the jobs, or *
+
+    sqldb : str
+        SQLite database file
 
-def get_jobs_started(size=100):
+    source : str
+        Only jobs of this cluster, None or * for all clusters. Rolled up
+        histograms are not kept per cluster and are left out with a source.
+
+    Returns
+    -------
+    stats : dict
+        Job type -> (run_avg, run_std, run_low, run_high) in days, zeros for
+        job types without history
     """
-    Returns the jobs that have been started
+    jobtypes = [str(job) for job in set(jobtypes)]
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    merge_histograms = (source is None or source == "*") and (HIST_TABLE,) in (db.table_names or [])
+
+    # stay below sqlite's limit on host parameters
+    keys, run_times, hists = [], [], {}
+    for i in range(0, len(jobtypes), 500):
+        chunk = jobtypes[i:i+500]
+        condition, values = job_condition("*", instance, source)
+        condition = " AND ".join(["job_type IN (%s)" % ', '.join(['?']*len(chunk))] + ([condition] if condition else []))
+        data = db.column_query("job_times", ["job_type", "run_time"], condition, chunk + values)
+        keys.append(data["job_type"].astype(str))
+        run_times.append(data["run_time"].astype(float))
+        if merge_histograms:
+            condition, values = job_condition("*", instance)
+            condition = " AND ".join(["job_type IN (%s)" % ', '.join(['?']*len(chunk))] + ([condition] if condition else []))
+            for job, counts in db.table_query(HIST_TABLE, "job_type, counts", condition, chunk + values):
+                hists[job] = hists.get(job, 0) + decode_counts(counts)
+    db.close()
+
+    keys = np.concatenate(keys) if keys else np.array([], dtype=str)
+    run_times = np.concatenate(run_times) if run_times else np.array([])
+    merged = merged_runtime_stats(keys, run_times, hists, bin_centers())
+    return {job: tuple(merged[job][:4]) if job in merged else (0,0,0,0) for job in jobtypes}
+
+def instance_runtime_prediction(jobtype, sqldb='job.db', source=None):
+    """ Returns runtime_prediction for every instance a job type has run on, with one query
+
+    Rolled up histograms of the job type are merged in per instance.
 
     Parameters
     ----------
-    size : int
-        Number of hits to use to compute the average
+    jobtype : str
+        Name of the job type
 
-    url : str
-        Elastic search endpoint
+    sqldb : str
+        SQLite database file
+
+    source : str
+        Only jobs of this cluster, None or * for all clusters
+
+    Returns
+    -------
+    stats : dict
+        Instance -> (run_avg, run_std, run_low, run_high, count), times in days
     """
-    query = {"query":{"bool":{"must":[{"wildcard":{"type":"*"}},{"match":{"status":"job-started"}}],
-                "must_not":[],"should":[]}},"from":0,"size":size,"sort":[{"@timestamp":{"order":"asc"}}],"aggs":{}}
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    data = db.column_query("job_times", ["instance", "run_time"], *job_condition(jobtype, "*", source))
+    hists = {}
+    if (source is None or source == "*") and (HIST_TABLE,) in (db.table_names or []):
+        # rolled up jobs, see runtime_prediction
+        for inst, counts in db.table_query(HIST_TABLE, "instance, counts", "job_type=?", [jobtype]):
+            hists[inst] = hists.get(inst, 0) + decode_counts(counts)
+    db.close()
 
-    # query for jobs queued
-    endpoint = os.path.join(es_endpoint, "job_status-current/_search")
-    res = requests.post(endpoint, data=json.dumps(query), verify=False, auth=(os.environ['JUSERNAME'], os.environ['JPASSWORD']))
-
-    if res.status_code == 200:
-        search_result = res.json()
-        print("Number of jobs currently-started:", search_result['hits']['total'])
-        print("  jobs returned:", len(search_result['hits']['hits']))
-        return search_result['hits']['hits']
-    else:
-        print("Error:", res.status_code)
-        print(res.text)
-        return None
+    return merged_runtime_stats(data["instance"].astype(str), data["run_time"].astype(float), hists, bin_centers())
 
-def estimate_time_to_complete():
+def get_jobs_started(size=10000, source=None):
     """
-    Estimate time for jobs in the queue to complete
+    Returns the jobs that have been started
 
     Parameters
     ----------
     size : int
-        Number of hits to use to compute the average
+        Maximum number of jobs to return per cluster
+
+    source : str
+        Cluster to query, None or * for all of them
     """
+    # query for jobs started, read from the job status index (mozart) of each cluster
+    return search_clusters(status_query("job-started", size), STARTED_FIELDS, "jobs currently-started",
+                           source=source, status_index=True)
 
-    sjobs = get_jobs_started()
+async def get_jobs_started_async(session, size=10000, source=None):
+    """ get_jobs_started awaited on a shared aiohttp session """
+    return await search_clusters_async(session, status_query("job-started", size), STARTED_FIELDS,
+                                       "jobs currently-started", source=source, status_index=True)
 
-    # extract unique jobs
-    job_types = [job['_source']['type'] for job in sjobs]
-    ujobs = set(job_types)
-    jdata = {}
+def estimate_time_to_complete(size=10000, instance="*", sjobs=None, source=None):
+    """
+    Estimate the time left for the jobs that are currently running
 
-    if verbose:
-        print(f"Number of unique jobs in queue: {len(ujobs)}")
+    Parameters
+    ----------
+    size : int
+        Maximum number of running jobs to query for
 
-    # for each job type query for the runtime
-    for job in ujobs:
-        jdata[job] = {}
-        run_avg, run_std, _, _ = runtime_prediction(job, instance="*") # TODO replace with actual instance
-        jdata[job]['run_avg'] = run_avg
-        jdata[job]['run_std'] = run_std
-        jdata[job]['count'] = job_types.count(job)
+    instance : str
+        Instance to take the expected run times from, * for all
 
-    # loop over current jobs and compute the time to completion
-    times = []
-    for job in sjobs:
-        ts = Time(job['_source']['job']['job_info']['time_start'])
-        dt = Time.now().jd - ts.jd # how long the job has been running, TODO check timezones, UTC?
-        ert = jdata[job['_source']['type']]['run_avg'] #+ jdata[job['_source']['type']]['run_std'] # est. run time
-        time_left = max(0, ert - dt) # sometimes is negative
-        times.append(time_left)
+    sjobs : list of dicts
+        Started jobs (elastic search hits), queried when not given
 
-    return times # days
+    source : str
+        Only running jobs and run times of this cluster, None or * for all
 
-def queuetime_prediction(nodes=1, size=4000):
+    Returns
+    -------
+    estimate : dict
+        Arrays of job_id, job_type, source (cluster), elapsed and remaining
+        (days) for every running job
+    """
+    if sjobs is None:
+        sjobs = get_jobs_started(size=size, source=source) or []
+
+    job_ids = np.array([job['_source'].get('job_id', job.get('_id', '')) for job in sjobs], dtype=object)
+    job_types = np.array([job['_source']['type'] for job in sjobs], dtype=object)
+    sources = np.array([job.get('_cluster') for job in sjobs], dtype=object)
+    starts = to_datetime64([job['_source'].get('job', {}).get('job_info', {}).get('time_start') for job in sjobs])
+
+    # how long each job has been running, all against the same now (UTC)
+    now = np.datetime64('now', 'ms')
+    elapsed = (now - starts) / np.timedelta64(1, 'D')
+    elapsed[np.isnat(starts)] = 0
+
+    # expected run time of each job from one lookup per job type
+    ujobs, inverse = np.unique(job_types.astype(str), return_inverse=True)
+    stats = grouped_runtime_prediction(ujobs, instance=instance, source=source)
+    run_avg = np.array([stats[job][0] for job in ujobs], dtype=float)
+
+    remaining = np.maximum(0, run_avg[inverse] - elapsed) # sometimes is negative
+
+    return {
+        'job_id': job_ids,
+        'job_type': job_types,
+        'source': sources,
+        'elapsed': elapsed,
+        'remaining': remaining
+    }
+
+def queuetime_prediction(nodes=1, size=4000, source=None):
     """ Returns a dictionary of the result for the given target
 
     Parameters
@@ -214,7 +567,10 @@ def queuetime_prediction(nodes=1, size=4000):
         Number of nodes / parallel instances running jobs
 
     size : int
-        Number of jobs returned in queue for calculation
+        Number of jobs returned in queue for calculation, per cluster
+
+    source : str
+        Only the queue and run times of this cluster, None or * for all
     
     Returns
     -------
@@ -227,17 +583,42 @@ def queuetime_prediction(nodes=1, size=4000):
     njobs : int
         Number of jobs in the queue
     """
-    qjobs = get_queue(size=size)
+    qjobs = get_queue(size=size, source=source) or []
+    qmin, qmax, njobs = queue_totals([job['_source']['type'] for job in qjobs], source=source)
+
+    # time in days
+    return qmin/nodes, qmax/nodes, njobs
+
+def queue_totals(job_types, source=None):
+    """ Time to run a list of queued jobs on one node
+
+    Parameters
+    ----------
+    job_types : list of str
+        Job type of every queued job
+
+    source : str
+        Take run times from the jobs of this cluster, None or * for all
+
+    Returns
+    -------
+    qmin : float
+        Sum of the run times minus one stdev (at least 0) in days
 
+    qmax : float
+        Sum of the run times plus one stdev in days
+
+    njobs : int
+        Number of jobs
+    """
     # extract unique jobs
-    job_types = [job['_source']['type'] for job in qjobs]
     ujobs = set(job_types)
     jdata = {}
 
     # for each unique job type query for the runtime
     for job in ujobs:
         jdata[job] = {}
-        run_avg, run_std, _, _ = runtime_prediction(job, instance="*")
+        run_avg, run_std, _, _ = runtime_prediction(job, instance="*", source=source)
         jdata[job]['run_avg'] = run_avg
         jdata[job]['run_std'] = run_std
         jdata[job]['count'] = job_types.count(job)
@@ -252,80 +633,9 @@ def queuetime_prediction(nodes=1, size=4000):
         qmax.append(jdata[qjob]['run_avg'] + jdata[qjob]['run_std'])
         qmin.append( max(0, jdata[qjob]['run_avg'] - jdata[qjob]['run_std']))
 
-    # time in days
-    return np.sum(qmin)/nodes, np.sum(qmax)/nodes, len(job_types)
-
-def plot_stats():
-
-    import matplotlib.pyplot as plt
-    
-    # get unique jobs
-    jobs = return_jobs_sql('*', 'c5.9xlarge')
-    run_times = np.array([job['run_time'] for job in jobs])
-    job_types = [job['job_type'] for job in jobs]
-
-    ujobs = list(set(job_types))
+    return np.sum(qmin), np.sum(qmax), len(job_types)
 
-    # compute stdev for each job type
-    jdata = {}
-    newjobs = []
-    for job in ujobs:
-        run_avg, run_std, run_min, run_max = runtime_prediction(job, instance="c5.9xlarge")
-        if run_avg < 1e-6 or run_std < 1e-6:
-            continue
-        jdata[job] = {}
-        jdata[job]['run_avg'] = run_avg
-        jdata[job]['run_std'] = run_std
-        jdata[job]['run_min'] = run_min
-        jdata[job]['run_max'] = run_max
-        jdata[job]['count'] = job_types.count(job)
-        # percent error
-        jdata[job]['perr'] = (jdata[job]['run_std']/ jdata[job]['run_avg']) * 100
-        newjobs.append(job)
-
-    perr = np.array([jdata[job]['perr'] for job in newjobs])
-    avgs = np.array([jdata[job]['run_avg'] for job in newjobs])
-    stds = np.array([jdata[job]['run_std'] for job in newjobs])
-    counts = np.array([jdata[job]['count'] for job in newjobs])
-    mins = np.array([jdata[job]['run_min'] for job in newjobs])
-    maxs = np.array([jdata[job]['run_max'] for job in newjobs])
-    si = np.argsort(counts)[::-1]
-    mask = si[:25]
-
-    # mask to 25 most popular jobs
-    perr = perr[mask]
-    avgs = avgs[mask]
-    stds = stds[mask]
-    counts = counts[mask]
-    mins = mins[mask]
-    maxs = maxs[mask]
-    newjobs = np.array(newjobs)[mask]
-
-    # sort data in run time
-    si = np.argsort(avgs)
-    perr = perr[si]
-    avgs = avgs[si]
-    stds = stds[si]
-    counts = counts[si]
-    mins = mins[si]
-    maxs = maxs[si]
-    newjobs = np.array(newjobs)[si]
-
-    # plot jobs with highest percent error
-    plt.figure(figsize=(10,10))
-    plt.bar(newjobs, avgs*24*60, alpha=0.5, label='Model Estimate')
-
-    for x in np.arange(25):
-        if x == 0:
-            plt.plot([x,x], [mins[x]*24*60, maxs[x]*24*60], 'k--', alpha=0.75, label='Historical Data [min-max]')
-        else:
-            plt.plot([x,x], [mins[x]*24*60, maxs[x]*24*60], 'k--', alpha=0.75)
-
-    plt.errorbar(np.arange(25)+0.1, avgs*24*60, yerr=stds*24*60, fmt='.', ls='none', color='blue',alpha=0.5, label='Model Uncertainty')
-    plt.ylabel("Run Time [min]")
-    plt.legend(loc='best')
-    plt.title("Performance estimate for 25 of the most popular jobs")
-    plt.ylim([0,1])
-    plt.xticks(rotation=90)
-    plt.tight_layout()
-    plt.show()
+def plot_stats(instance="c5.9xlarge", top=25, sqldb='job.db'):
+    """ Plot the estimates of the most popular job types on an instance, see stats_report.py """
+    from stats_report import runtime_report, plot_report
+    plot_report(runtime_report(sqldb, instance), instance, top)
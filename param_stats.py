@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from rollup import NBINS, bin_centers, encode_counts, decode_counts, key_counts, load_key_counts
+from groupstats import weighted_runtime_stats
+
+# run time histograms per job type, instance and params fingerprint, updated at
+# ingest. A job type that runs with different inputs has one mode per fingerprint.
+PARAMS_TABLE = "params_sketches"
+PARAMS_COLUMNS = ("job_type text, instance text, params_hash text, counts text, total integer, "
+                  "PRIMARY KEY (job_type, instance, params_hash)")
+
+# column of job_times holding the fingerprint of each job
+PARAMS_COLUMN = "params_hash text DEFAULT ''"
+
+# param names the fingerprint is computed from (comma separated), * for all of
+# them. The default keeps the spatial extent of a job: hashing every param
+# (urls, ids, dates) gives most jobs a mode of their own.
+DEFAULT_PARAM_KEYS = "bbox,track,frame"
+PARAM_KEYS = [key for key in os.environ.get('ETC_PARAM_KEYS', DEFAULT_PARAM_KEYS).split(',') if key and key != '*']
+
+# jobs of a mode before /runtime answers from it instead of from the job type
+MIN_MODE_JOBS = int(os.environ.get('ETC_MIN_MODE_JOBS', 5))
+
+
+def normalize_params(params, keys=PARAM_KEYS):
+    """ The input parameters of a job as a flat {name: value} dict
+
+    Parameters
+    ----------
+    params : dict or str
+        job.params of a job document, either with a job_specification
+        list of {name, value} or as name/value pairs, or its JSON
+
+    keys : list of str
+        Names to keep, all of them when empty. Internal entries (starting
+        with an underscore, e.g. _command) are always dropped.
+
+    Returns
+    -------
+    values : dict
+    """
+    if isinstance(params, str):
+        try:
+            params = json.loads(params)
+        except ValueError:
+            return {}
+    if not isinstance(params, dict):
+        return {}
+
+    spec = params.get('job_specification')
+    if isinstance(spec, dict) and isinstance(spec.get('params'), list):
+        values = {p['name']: p.get('value') for p in spec['params'] if isinstance(p, dict) and 'name' in p}
+    else:
+        values = {name: value for name, value in params.items() if not str(name).startswith('_')}
+
+    if keys:
+        values = {name: values[name] for name in keys if name in values}
+    return values
+
+def _canonical(value):
+    # the same inputs hash the same whether they come from elastic search or a
+    # query string: 1, 1.0 and "1 " are not told apart, dict order is ignored
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return format(float(value), '.12g')
+    text = str(value).strip()
+    try:
+        return format(float(text), '.12g')
+    except ValueError:
+        return text
+
+def params_fingerprint(params, keys=PARAM_KEYS):
+    """ Hash of the normalized input parameters of a job
+
+    Parameters
+    ----------
+    params : dict or str
+        job.params of a job document or {name: value}, see normalize_params
+
+    keys : list of str
+        Names the fingerprint depends on, all of them when empty
+
+    Returns
+    -------
+    fingerprint : str
+        16 hex digits, empty for a job without parameters
+    """
+    values = normalize_params(params, keys)
+    if len(values) == 0:
+        return ""
+    text = json.dumps(_canonical(values), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def update_params_sketches(db, job_types, instances, fingerprints, run_times):
+    """ Add the run times of newly ingested jobs to the sketch of their mode
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database with a params_sketches table
+
+    job_types, instances, fingerprints : array of str
+        Key of each new job, jobs without a fingerprint are skipped
+
+    run_times : array of float
+        Run time of each job in days
+    """
+    fingerprints = np.asarray(fingerprints, dtype=str)
+    known = fingerprints != ""
+    if not known.any():
+        return
+
+    job_types = np.asarray(job_types, dtype=str)[known]
+    instances = np.asarray(instances, dtype=str)[known]
+    keys = np.char.add(np.char.add(np.char.add(np.char.add(job_types, "\x1f"), instances), "\x1f"),
+                       fingerprints[known])
+    ukeys, inverse = np.unique(keys, return_inverse=True)
+    counts = key_counts(inverse, np.asarray(run_times, dtype=float)[known], len(ukeys))
+    stored = load_key_counts(db, PARAMS_TABLE, ["job_type", "instance", "params_hash"], job_types.tolist())
+
+    records = []
+    for key, key_count in zip(ukeys.tolist(), counts):
+        job_type, instance, fingerprint = key.split("\x1f")
+        total = key_count + stored.get((job_type, instance, fingerprint), 0)
+        records.append({'job_type': job_type, 'instance': instance, 'params_hash': fingerprint,
+                        'counts': encode_counts(total), 'total': int(total.sum())})
+
+    db.replace_records(PARAMS_TABLE, records)
+
+def rebuild_params_sketches(db):
+    """ Recompute all sketches from the fingerprints in the job_times table
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database
+    """
+    db.create_table(PARAMS_TABLE, columns=PARAMS_COLUMNS)
+    db.delete_records(PARAMS_TABLE, "1=1", [])
+    data = db.column_query("job_times", ["job_type", "instance", "params_hash", "run_time"], "params_hash != ?", [""])
+    if len(data["run_time"]) > 0:
+        update_params_sketches(db, data["job_type"].astype(str), data["instance"].astype(str),
+                               data["params_hash"].astype(str), data["run_time"].astype(float))
+
+def load_params_sketch(db, jobtype, instance, fingerprint):
+    """ Sketch of one mode, summed over instances for instance * (primary key lookup otherwise)
+
+    Returns
+    -------
+    counts : np.ndarray
+        Jobs per log-spaced run time bin, all zeros when the mode is unknown
+    """
+    counts = np.zeros(NBINS, dtype=np.int64)
+    if (PARAMS_TABLE,) not in (db.table_names or []):
+        return counts
+
+    if instance == "*":
+        rows = db.table_query(PARAMS_TABLE, "counts", "job_type=? AND params_hash=?", [jobtype, fingerprint])
+    else:
+        rows = db.table_query(PARAMS_TABLE, "counts", "job_type=? AND instance=? AND params_hash=?",
+                              [jobtype, instance, fingerprint])
+    for row in rows:
+        counts += decode_counts(row[0])
+    return counts
+
+def sketch_stats(counts):
+    """ runtime_prediction (median, stdev, p1, p99) of a sketch, in days """
+    return weighted_runtime_stats(bin_centers(), counts)
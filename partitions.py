@@ -0,0 +1,77 @@
+import os
+import argparse
+
+from sql_database import SQLDatabase, PartitionedSQLDatabase
+
+
+def split_database(db_file, db_dir, period='month', chunk=100000):
+    """ Copy a single file job database into a partitioned directory
+
+    Parameters
+    ----------
+    db_file : str
+        Existing sqlite database
+
+    db_dir : str
+        New partitioned database directory
+
+    period : str
+        year, month or day
+
+    chunk : int
+        Rows copied per transaction
+    """
+    src = SQLDatabase()
+    src.open(db_file)
+
+    dst = PartitionedSQLDatabase(period=period)
+    dst.create_db(db_dir)
+
+    tables = src.table_query("sqlite_master", "name, sql", "type='table' AND name NOT LIKE 'sqlite_%'", [])
+    for table, sql in tables:
+        columns = sql[sql.index('(')+1:sql.rindex(')')]
+        dst.create_table(table, columns=columns)
+        names = src.table_column_name(table)
+
+        # page through by rowid so memory stays bounded
+        last = -1
+        while True:
+            rows = src.table_query(table, "rowid, *", "rowid > ? ORDER BY rowid LIMIT ?", [last, chunk])
+            if len(rows) == 0:
+                break
+            last = rows[-1][0]
+            dst.insert_many(table, names, [row[1:] for row in rows])
+        print(f"{table}: copied up to rowid {last}")
+
+    src.close()
+    dst.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Manage a time partitioned job database')
+    parser.add_argument('db_dir', type=str, help='Partitioned database directory')
+    parser.add_argument('--split', default=None, type=str, help='Create db_dir from this single file database')
+    parser.add_argument('--period', default='month', choices=['year', 'month', 'day'], help='Partition period used with --split')
+    parser.add_argument('--drop_before', default=None, type=str, help='Remove partitions older than this key, e.g. 2021_01')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.split:
+        split_database(args.split, args.db_dir, period=args.period)
+
+    db = PartitionedSQLDatabase()
+    db.open(args.db_dir)
+
+    if args.drop_before:
+        for key in db.partitions():
+            if key < args.drop_before:
+                db.drop_partition(key)
+                print(f"dropped {key}")
+
+    for key in db.partitions():
+        path = db.partition_file('job_times', key)
+        print(f"{key}: {os.path.getsize(path)/1024**2:.1f} MB")
+    db.close()
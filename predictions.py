@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import numpy as np
+
+from sql_database import get_database
+from groupstats import merged_runtime_stats
+from rollup import HIST_TABLE, bin_centers, decode_counts
+
+# directory of the versioned prediction tables, CURRENT points at the one served
+PREDICTIONS_DIR = os.environ.get('ETC_PREDICTIONS', 'predictions')
+CURRENT = "current.json"
+
+# versions kept on disk, older ones are deleted by materialize
+KEEP = 5
+
+# seconds between checks of CURRENT by the web server's loader thread
+POLL_SECONDS = float(os.environ.get('ETC_PREDICTIONS_POLL', 30))
+
+WILDCARD = "*"
+
+
+def _histograms(db):
+    """ Summed rolled up histograms per (job type, instance) """
+    hists = {}
+    if (HIST_TABLE,) not in (db.table_names or []):
+        return hists
+    for job_type, instance, counts in db.table_query(HIST_TABLE, "job_type, instance, counts", "", []):
+        key = (job_type, instance)
+        hists[key] = hists.get(key, 0) + decode_counts(counts)
+    return hists
+
+def _level(job_types, instances, run_times, hists, by_type, by_instance):
+    """ Statistics of one roll-up level, recent rows merged with histograms """
+    jt = job_types if by_type else np.full(len(job_types), WILDCARD)
+    inst = instances if by_instance else np.full(len(instances), WILDCARD)
+    keys = np.char.add(np.char.add(jt, "\x1f"), inst) if len(jt) > 0 else np.array([], dtype=str)
+
+    # histograms rolled up to this level
+    level_hists = {}
+    for (h_type, h_inst), counts in hists.items():
+        key = "%s\x1f%s" % (h_type if by_type else WILDCARD, h_inst if by_instance else WILDCARD)
+        level_hists[key] = level_hists.get(key, 0) + counts
+
+    return merged_runtime_stats(keys, run_times, level_hists, bin_centers())
+
+def compute_predictions(sqldb='job.db'):
+    """ runtime_prediction for every known (job type, instance) and wildcard roll-up
+
+    Parameters
+    ----------
+    sqldb : str
+        Database file or directory
+
+    Returns
+    -------
+    table : dict
+        Arrays job_type, instance, mean, stdev, low, high (days) and count,
+        one entry per key with * for rolled up job types or instances
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    data = db.column_query("job_times", ["job_type", "instance", "run_time"], "", [])
+    hists = _histograms(db)
+    db.close()
+
+    job_types = data["job_type"].astype(str)
+    instances = data["instance"].astype(str)
+    run_times = data["run_time"].astype(float)
+
+    stats = {}
+    for by_type in (True, False):
+        for by_instance in (True, False):
+            stats.update(_level(job_types, instances, run_times, hists, by_type, by_instance))
+
+    keys = sorted(stats)
+    values = np.array([stats[k][:4] for k in keys], dtype=float).reshape(-1, 4)
+    split = [k.split("\x1f") for k in keys]
+    return {
+        'job_type': np.array([s[0] for s in split], dtype=str),
+        'instance': np.array([s[1] for s in split], dtype=str),
+        'mean': values[:, 0], 'stdev': values[:, 1], 'low': values[:, 2], 'high': values[:, 3],
+        'count': np.array([stats[k][4] for k in keys], dtype=np.int64),
+    }
+
+def _read_current(out_dir):
+    try:
+        with open(os.path.join(out_dir, CURRENT)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_current(out_dir, current):
+    # replaced atomically, readers see the old or the new pointer
+    tmp = os.path.join(out_dir, CURRENT + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(current, f, indent=2)
+    os.replace(tmp, os.path.join(out_dir, CURRENT))
+
+def version_file(out_dir, version):
+    return os.path.join(out_dir, "v%06d.npz" % version)
+
+def materialize(sqldb='job.db', out_dir=PREDICTIONS_DIR, keep=KEEP, verbose=True):
+    """ Write a new version of the prediction table and make it current
+
+    Parameters
+    ----------
+    sqldb : str
+        Database file or directory
+
+    out_dir : str
+        Directory of the versioned tables
+
+    keep : int
+        Number of versions to keep for rollback
+
+    Returns
+    -------
+    version : int
+        Version now served
+    """
+    start = time.perf_counter()
+    table = compute_predictions(sqldb)
+    os.makedirs(out_dir, exist_ok=True)
+
+    current = _read_current(out_dir) or {'version': 0, 'history': [], 'next': 1}
+    versions = [current['version']] + current['history'] if current['version'] else []
+    # never reuse the number of a rolled back version, loaders compare numbers
+    version = current['next']
+
+    # write the whole table before pointing at it
+    path = version_file(out_dir, version)
+    with open(path + ".tmp", 'wb') as f:
+        np.savez(f, **table)
+    os.replace(path + ".tmp", path)
+
+    history = versions[:keep-1]
+    _write_current(out_dir, {'version': version, 'history': history, 'next': version + 1,
+                             'source': os.path.abspath(sqldb),
+                             'created': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+                             'keys': len(table['job_type'])})
+
+    for old in versions[keep-1:]:
+        if os.path.exists(version_file(out_dir, old)):
+            os.remove(version_file(out_dir, old))
+
+    if verbose:
+        print(f"Prediction table v{version}: {len(table['job_type'])} keys in {time.perf_counter() - start:.1f} s")
+    return version
+
+def rollback(out_dir=PREDICTIONS_DIR, verbose=True):
+    """ Serve the previous version again, the current one is dropped
+
+    Returns
+    -------
+    version : int
+        Version now served, None when there is nothing to roll back to
+    """
+    current = _read_current(out_dir)
+    if current is None or len(current['history']) == 0:
+        print(f"No previous prediction table in {out_dir}")
+        return None
+
+    dropped = current['version']
+    version, history = current['history'][0], current['history'][1:]
+    _write_current(out_dir, dict(current, version=version, history=history,
+                                 rolled_back=time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())))
+    if os.path.exists(version_file(out_dir, dropped)):
+        os.remove(version_file(out_dir, dropped))
+    if verbose:
+        print(f"Rolled back prediction table from v{dropped} to v{version}")
+    return version
+
+
+class _Snapshot:
+    """ One loaded version, never modified after construction """
+    def __init__(self, version, table):
+        self.version = version
+        self.stats = {}
+        self.by_type = {}
+        for i, (job_type, instance) in enumerate(zip(table['job_type'].tolist(), table['instance'].tolist())):
+            row = (float(table['mean'][i]), float(table['stdev'][i]), float(table['low'][i]),
+                   float(table['high'][i]), int(table['count'][i]))
+            self.stats[(job_type, instance)] = row
+            if job_type != WILDCARD and instance != WILDCARD:
+                self.by_type.setdefault(job_type, {})[instance] = row
+
+
+class PredictionTable:
+    """ Current prediction table of the web server, swapped in the background
+
+    A loader thread polls current.json and loads a new version completely
+    before replacing the snapshot reference, so lookups take no lock and see
+    either the old or the new table. Lookups return None until a table has
+    been loaded or for keys it does not have, callers then query the database.
+
+    Example:
+        table = PredictionTable().start()
+        mean, stdev, low, high, count = table.lookup("job-a:develop", "*")
+    """
+    def __init__(self, out_dir=PREDICTIONS_DIR):
+        self.out_dir = out_dir
+        self.path = os.path.join(out_dir, CURRENT)
+        self._snapshot = None
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def version(self):
+        snapshot = self._snapshot
+        return snapshot.version if snapshot is not None else None
+
+    def refresh(self):
+        """ Load the current version if it is not the one served """
+        current = _read_current(self.out_dir)
+        if current is None or current['version'] == self.version:
+            return False
+        try:
+            with np.load(version_file(self.out_dir, current['version'])) as data:
+                snapshot = _Snapshot(current['version'], {k: data[k] for k in data.files})
+        except (OSError, KeyError, ValueError) as err:
+            self.logger.error('Unable to load prediction table v%s: %s' % (current['version'], err))
+            return False
+        self._snapshot = snapshot
+        return True
+
+    def start(self, interval=POLL_SECONDS):
+        """ Load the current table and keep polling for new versions """
+        self.refresh()
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as err:
+                    self.logger.error('Prediction table refresh failed: %s' % err)
+        self._thread = threading.Thread(target=poll, name="prediction-table", daemon=True)
+        self._thread.start()
+        return self
+
+    def lookup(self, jobtype, instance):
+        """ (mean, stdev, low, high, count) in days, or None """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        return snapshot.stats.get((jobtype, instance))
+
+    def instances(self, jobtype):
+        """ Instance -> (mean, stdev, low, high, count) like instance_runtime_prediction, or None """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        return snapshot.by_type.get(jobtype)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build, list or roll back the precomputed prediction tables')
+    parser.add_argument('command', choices=['build', 'rollback', 'list'], help='build a new version, serve the previous one or list versions')
+    parser.add_argument('--sqldb', default='job.db', type=str, help='Database file or directory')
+    parser.add_argument('--dir', default=PREDICTIONS_DIR, type=str, help='Directory of the versioned tables')
+    parser.add_argument('--keep', default=KEEP, type=int, help='Versions to keep for rollback')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.command == 'build':
+        materialize(args.sqldb, args.dir, keep=args.keep)
+    elif args.command == 'rollback':
+        rollback(args.dir)
+    else:
+        current = _read_current(args.dir)
+        if current is None:
+            print(f"No prediction table in {args.dir}")
+        else:
+            print(f"current: v{current['version']} ({current.get('keys')} keys, created {current.get('created')})")
+            for version in current['history']:
+                print(f"previous: v{version}")
@@ -0,0 +1,99 @@
+import os
+import json
+import logging
+import threading
+
+# default location of the price table, reloaded whenever the file changes
+PRICES_FILE = os.environ.get('ETC_PRICES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prices.json'))
+
+MARKETS = ('on_demand', 'spot')
+
+
+class PriceTable:
+    """ Hourly instance prices loaded from a JSON file
+
+    The file is re-read on access when its modification time changes, so prices
+    can be edited without restarting the web server. Format:
+
+        {"instances": {"c5.9xlarge": {"on_demand": 1.53, "spot": 0.61}, ...}}
+    """
+    def __init__(self, path=PRICES_FILE):
+        self.path = path
+        self._prices = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self._mtime is not None:
+                self.logger.error('Price table %s not found, keeping the last prices' % self.path)
+            self._mtime = -1
+            return
+
+        if mtime == self._mtime:
+            return
+
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            try:
+                with open(self.path) as f:
+                    prices = json.load(f)['instances']
+            except (ValueError, KeyError) as err:
+                # keep serving the previous prices while the file is being edited
+                self.logger.error('Unable to read price table %s: %s' % (self.path, err))
+                return
+            self._prices = prices
+            self._mtime = mtime
+
+    @property
+    def prices(self):
+        """ Instance -> {market: USD per hour} """
+        self._refresh()
+        return self._prices
+
+    def get(self, instance, market='on_demand', default=0.):
+        """ Hourly price of an instance
+
+        Parameters
+        ----------
+        instance : str
+            Instance type, e.g. c5.9xlarge
+
+        market : str
+            on_demand or spot
+
+        default : float
+            Returned for unknown instances
+
+        Returns
+        -------
+        price : float
+            USD per hour
+        """
+        return self.prices.get(instance, {}).get(market, default)
+
+
+def pareto_front(options, x='runtime', y='cost'):
+    """ Options not beaten on both x and y by any other option
+
+    Parameters
+    ----------
+    options : list of dicts
+        Candidates with numeric x and y entries
+
+    Returns
+    -------
+    front : list of dicts
+        Pareto optimal options sorted by x (fastest first)
+    """
+    front = []
+    best = float('inf')
+    for option in sorted(options, key=lambda o: (o[x], o[y])):
+        if option[y] < best:
+            front.append(option)
+            best = option[y]
+    return front
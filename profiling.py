@@ -0,0 +1,152 @@
+import os
+import time
+import pstats
+import cProfile
+import threading
+
+# directory where request profiles are written
+PROFILE_DIR = "profiles"
+
+# layers of the stack, matched against the file name of each profiled function
+LAYERS = {
+    'model': ('model.py', 'decayed_stats.py', 'timeutils.py'),
+    'sql_database': ('sql_database.py', "sqlite3."),
+    'es_client': ('es_client.py', 'requests', 'urllib3', 'elasticsearch', 'http/client.py', "'_socket.", "'_ssl.", 'socket.py', 'ssl.py'),
+    'webserver': ('webserver.py', 'flask', 'werkzeug'),
+}
+
+# only one profiler can be active per process (sys.monitoring from python 3.12)
+_lock = threading.Lock()
+
+# the thread being profiled, cProfile only records the thread it was enabled on
+_local = threading.local()
+
+
+def _layer(func):
+    filename, _, name = func
+    where = filename if filename != '~' else name
+    for layer, patterns in LAYERS.items():
+        if any(p in where for p in patterns):
+            return layer
+    return 'other'
+
+def pool_map(pool, func, items):
+    """ Results of func on every item, computed on a thread pool
+
+    On a thread being profiled the items run one after the other on that
+    thread instead, so their time shows up in the profile (worker threads
+    are not profiled). The profile counts them as inline_tasks.
+
+    Parameters
+    ----------
+    pool : callable
+        Returns the executor, only called when it is used
+
+    func : callable
+        Task run on every item
+
+    items : iterable
+
+    Returns
+    -------
+    results : list
+        In the order of the items
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return list(pool().map(func, items))
+    results = [func(item) for item in items]
+    profile.inline_tasks += len(results)
+    return results
+
+class RequestProfile:
+    """ Deterministic profile of a block of code with wall and CPU time
+
+    Example:
+        with RequestProfile() as prof:
+            queuetime_prediction(nodes=5, size=4444)
+        summary = prof.summary()
+    """
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.acquired = False
+        self.inline_tasks = 0
+
+    def __enter__(self):
+        self.acquired = _lock.acquire(blocking=False)
+        if not self.acquired:
+            raise RuntimeError("Another request is being profiled")
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        _local.profile = self
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def stop(self):
+        if self.acquired:
+            self.profiler.disable()
+            self.wall = time.perf_counter() - self.wall
+            self.cpu = time.thread_time() - self.cpu
+            _local.profile = None
+            _lock.release()
+            self.acquired = False
+
+    def summary(self, top=25):
+        """ Break the profile down by layer and function
+
+        Parameters
+        ----------
+        top : int
+            Number of functions to list, sorted by cumulative time
+
+        Returns
+        -------
+        summary : dict
+            wall, cpu and io_wait seconds, self time per layer, the top
+            functions and the number of pool tasks run inline (serially, so
+            the wall time can be longer than unprofiled)
+        """
+        stats = pstats.Stats(self.profiler).stats
+
+        layers = {}
+        functions = []
+        for func, (cc, ncalls, tottime, cumtime, callers) in stats.items():
+            layer = _layer(func)
+            layers[layer] = layers.get(layer, 0.) + tottime
+            if layer != 'other':
+                functions.append({
+                    'layer': layer,
+                    'function': f"{os.path.basename(func[0])}:{func[1]}({func[2]})",
+                    'ncalls': ncalls,
+                    'tottime': tottime,
+                    'cumtime': cumtime
+                })
+        functions.sort(key=lambda f: f['cumtime'], reverse=True)
+
+        return {
+            'wall_time': self.wall,
+            'cpu_time': self.cpu,
+            'io_wait': max(0., self.wall - self.cpu),
+            'layers': {k: layers[k] for k in sorted(layers, key=layers.get, reverse=True)},
+            'functions': functions[:top],
+            'inline_tasks': self.inline_tasks,
+            'units': 'seconds'
+        }
+
+    def dump(self, name, directory=PROFILE_DIR):
+        """ Write the raw profile to disk for snakeviz, pstats etc.
+
+        Returns
+        -------
+        path : str
+            File the profile was written to
+        """
+        os.makedirs(directory, exist_ok=True)
+        safe = "".join(c if c.isalnum() else '_' for c in name).strip('_')
+        path = os.path.join(directory, f"{time.strftime('%Y%m%dT%H%M%S')}_{safe}.prof")
+        self.profiler.dump_stats(path)
+        return path
@@ -0,0 +1,238 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+from collections import Counter
+
+import metrics
+import model
+
+# seconds between full rebuilds, which check the running totals and refresh the run time statistics
+REBUILD_SECONDS = float(os.environ.get('ETC_QUEUE_REBUILD', 300))
+
+# relative difference between the running and rebuilt totals reported as drift
+TOLERANCE = 1e-9
+
+# order of the running sums
+MEAN, VARIANCE, LOW, HIGH = range(4)
+
+
+def job_key(job):
+    """ Identity of a queued job across snapshots """
+    return (job.get('_cluster'), job['_id'])
+
+
+class QueueEstimate:
+    """ Queue time totals maintained from the jobs queued and dequeued between snapshots
+
+    Keeps the job type of every queued job, the number of jobs per type and
+    the sums of their mean run time, variance and one stdev bounds. A new
+    snapshot of the queue is diffed by job id and only the added and removed
+    jobs change the sums, run time statistics are queried once per new job
+    type. Every REBUILD_SECONDS the sums are recomputed from the jobs of the
+    latest full query of the queue, differences with the running totals are
+    logged and counted in etc_queue_estimate_rebuilds_total, and the
+    statistics of every job type are refreshed from the database. The
+    database is never queried while the lock is held.
+
+    Parameters
+    ----------
+    size : int
+        Number of queued jobs per snapshot and cluster
+
+    source : str
+        Cluster of the queue and of the run times, None or * for all
+
+    rebuild_seconds : float
+        Seconds between full rebuilds
+
+    Example:
+        estimate = QueueEstimate(size=4444)
+        estimate.update(model.get_queue(size=4444))
+        qmin, qmax, njobs = estimate.totals()
+    """
+    def __init__(self, size=4444, source=None, rebuild_seconds=REBUILD_SECONDS):
+        self.size = size
+        self.source = source
+        self.rebuild_seconds = rebuild_seconds
+        self.jobs = {}
+        self.counts = Counter()
+        self.stats = {}
+        self.sums = np.zeros(4)
+        self.last_rebuild = time.monotonic()
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _predict(self, job_type):
+        run_avg, run_std, _, _ = model.runtime_prediction(job_type, instance="*", source=self.source)
+        # same bounds as model.queue_totals
+        return np.array([run_avg, run_std**2, max(0, run_avg - run_std), run_avg + run_std], dtype=float)
+
+    def update(self, jobs):
+        """ Apply a snapshot of the queue
+
+        Run time statistics of new job types are queried before the lock is
+        taken, so totals() is never held up by the database. When a rebuild
+        is due the snapshot is checked against the running totals, see
+        _rebuild.
+
+        Parameters
+        ----------
+        jobs : list of dicts
+            Hits of model.get_queue
+
+        Returns
+        -------
+        added : int
+            Jobs queued since the previous snapshot
+
+        removed : int
+            Jobs no longer queued
+        """
+        added, removed, _ = self._update({job_key(job): job['_source']['type'] for job in jobs})
+        return added, removed
+
+    def _update(self, snapshot, rebuild=False):
+        # job types new to the queue are predicted between two takes of the lock
+        predicted = {}
+        while True:
+            with self._lock:
+                added = snapshot.keys() - self.jobs.keys()
+                missing = {snapshot[key] for key in added} - self.stats.keys() - predicted.keys()
+                if len(missing) == 0:
+                    removed = self.jobs.keys() - snapshot.keys()
+                    self._apply(snapshot, added, removed, predicted)
+                    due = rebuild or time.monotonic() - self.last_rebuild > self.rebuild_seconds
+                    if due:
+                        # one rebuild at a time when several requests poll
+                        self.last_rebuild = time.monotonic()
+                    break
+            predicted.update({job_type: self._predict(job_type) for job_type in missing})
+
+        consistent = self._rebuild(snapshot) if due else None
+        return len(added), len(removed), consistent
+
+    def _apply(self, snapshot, added, removed, predicted):
+        # called with the lock held
+        for key in removed:
+            job_type = self.jobs.pop(key)
+            self.sums -= self.stats[job_type]
+            self.counts[job_type] -= 1
+            if self.counts[job_type] == 0:
+                del self.counts[job_type]
+
+        for key in added:
+            job_type = snapshot[key]
+            if job_type not in self.stats:
+                self.stats[job_type] = predicted[job_type]
+            self.jobs[key] = job_type
+            self.sums += self.stats[job_type]
+            self.counts[job_type] += 1
+
+    def poll(self):
+        """ Query the queue and apply it, False when no cluster answered """
+        jobs = model.get_queue(size=self.size, source=self.source)
+        if jobs is None:
+            return False
+        self.update(jobs)
+        return True
+
+    def rebuild(self):
+        """ Query the queue, apply it and check the running totals against it
+
+        Returns
+        -------
+        consistent : bool
+            Whether the running totals matched, None when no cluster answered
+        """
+        jobs = model.get_queue(size=self.size, source=self.source)
+        if jobs is None:
+            return None
+        return self._update({job_key(job): job['_source']['type'] for job in jobs}, rebuild=True)[2]
+
+    def _rebuild(self, snapshot):
+        """ Recompute the totals from a full query of the queue with fresh statistics
+
+        The running totals, which were built up from diffs, are compared
+        with the totals of the queried jobs under the same statistics. The
+        statistics are queried without holding the lock, which is only taken
+        to compare and swap in the rebuilt state.
+
+        Parameters
+        ----------
+        snapshot : dict
+            job_key -> job type of every job of the query
+        """
+        counts = Counter(snapshot.values())
+        # run times change with every ingest, re-query the job types still queued
+        stats = {job_type: self._predict(job_type) for job_type in counts}
+
+        with self._lock:
+            expected = np.zeros(4)
+            known = all(job_type in self.stats for job_type in counts)
+            if known:
+                for job_type, count in counts.items():
+                    expected += count * self.stats[job_type]
+            drift = np.abs(self.sums - expected).max() / max(np.abs(expected).max(), 1e-12)
+            consistent = known and self.jobs == snapshot and counts == self.counts and drift <= TOLERANCE
+            if not consistent:
+                self.logger.warning('Queue estimate of %s drifted by %.3g, rebuilt from %d jobs' %
+                                    (self.source or '*', drift, len(snapshot)))
+            metrics.queue_rebuilds.inc(result="consistent" if consistent else "corrected")
+
+            self.jobs = dict(snapshot)
+            self.stats = stats
+            self.counts = counts
+            self.sums = np.zeros(4)
+            for job_type, count in counts.items():
+                self.sums += count * stats[job_type]
+            self.last_rebuild = time.monotonic()
+        return consistent
+
+    def totals(self):
+        """ (qmin, qmax, njobs) of the current queue on one node, as model.queue_totals """
+        with self._lock:
+            return float(self.sums[LOW]), float(self.sums[HIGH]), len(self.jobs)
+
+    def mean(self):
+        """ Expected time to run the queue on one node and its stdev for independent run times """
+        with self._lock:
+            return float(self.sums[MEAN]), float(np.sqrt(max(self.sums[VARIANCE], 0)))
+
+    def composition(self):
+        """ Number of queued jobs per job type """
+        with self._lock:
+            return Counter(self.counts)
+
+
+_estimates = {}
+_estimates_lock = threading.Lock()
+
+def estimate(size=4444, source=None):
+    """ The shared estimate of a queue size and cluster """
+    with _estimates_lock:
+        key = (int(size), source)
+        if key not in _estimates:
+            _estimates[key] = QueueEstimate(size=int(size), source=source)
+        return _estimates[key]
+
+def queuetime_prediction(nodes=1, size=4000, source=None):
+    """ model.queuetime_prediction from the shared incremental estimate
+
+    Returns
+    -------
+    qmin : float
+        Minimum time to complete all jobs in the queue (-1 stdev)
+
+    qmax : float
+        Maximum time to complete all jobs in the queue (+1 stdev)
+
+    njobs : int
+        Number of jobs in the queue
+    """
+    queue = estimate(size, source)
+    if not queue.poll():
+        return 0, 0, 0
+    qmin, qmax, njobs = queue.totals()
+    return qmin/nodes, qmax/nodes, njobs
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+import metrics
+import queueestimate
+
+# seconds between queue polls of a producer
+POLL_SECONDS = float(os.environ.get('ETC_QUEUE_POLL', 5))
+
+# events buffered per client, the oldest is dropped when a client falls behind
+CLIENT_BUFFER = 8
+
+# seconds without an event before a keep-alive comment is sent
+HEARTBEAT_SECONDS = 15
+
+
+class Subscription:
+    """ Bounded buffer of the events one client has not read yet """
+    def __init__(self, size=CLIENT_BUFFER):
+        self.events = queue.Queue(maxsize=size)
+
+    def offer(self, event):
+        # keep the newest events, a slow client skips intermediate estimates
+        while True:
+            try:
+                self.events.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                    metrics.stream_dropped.inc()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class QueueProducer:
+    """ Background thread publishing the queue estimate when the queue changes
+
+    Polls the queue every POLL_SECONDS while it has subscribers, applies it
+    to the shared queueestimate.QueueEstimate of its size and source and
+    publishes the node independent totals whenever the job types in the
+    queue change. Stops when its last subscriber leaves.
+    """
+    def __init__(self, size=4444, source=None, interval=POLL_SECONDS):
+        self.size = size
+        self.source = source
+        self.interval = interval
+        self.latest = None
+        self._composition = None
+        self.estimate = queueestimate.estimate(size, source)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def subscribe(self):
+        subscription = Subscription()
+        with self._lock:
+            self._subscribers.add(subscription)
+            if self.latest is not None:
+                subscription.offer(self.latest)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="queue-stream", daemon=True)
+                self._thread.start()
+        metrics.stream_clients.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+        metrics.stream_clients.dec()
+
+    def poll(self):
+        """ Query the queue once, publish an estimate if its composition changed """
+        if not self.estimate.poll():
+            return
+        composition = self.estimate.composition()
+        if composition == self._composition:
+            return
+
+        qmin, qmax, njobs = self.estimate.totals()
+        self._composition = composition
+        self.publish({'njobs': njobs, 'min': float(qmin), 'max': float(qmax), 'time': time.time()})
+
+    def publish(self, event):
+        with self._lock:
+            self.latest = event
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.offer(event)
+        metrics.stream_events.inc()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._subscribers) == 0:
+                    self._thread = None
+                    return
+            try:
+                self.poll()
+            except Exception as err:
+                self.logger.error('Queue stream poll failed: %s' % err)
+            time.sleep(self.interval)
+
+
+_producers = {}
+_producers_lock = threading.Lock()
+
+def producer(size=4444, source=None):
+    """ The shared producer of a queue size and cluster """
+    with _producers_lock:
+        key = (int(size), source)
+        if key not in _producers:
+            _producers[key] = QueueProducer(size=int(size), source=source)
+        return _producers[key]
+
+def sse_events(producer, nodes=1, heartbeat=HEARTBEAT_SECONDS):
+    """ Server-sent events of a producer's estimates divided over nodes """
+    subscription = producer.subscribe()
+    try:
+        yield "retry: %d\n\n" % int(producer.interval * 1000)
+        while True:
+            event = subscription.get(timeout=heartbeat)
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            data = {
+                'name': 'Queue Time Estimate',
+                'source': producer.source or '*',
+                'njobs': event['njobs'],
+                'min': f"{event['min']/nodes:.3f}",
+                'max': f"{event['max']/nodes:.3f}",
+                'units': 'day'
+            }
+            yield "event: estimate\nid: %d\ndata: %s\n\n" % (int(event['time'] * 1000), json.dumps(data))
+    finally:
+        producer.unsubscribe(subscription)
@@ -0,0 +1,214 @@
+import json
+import argparse
+import numpy as np
+
+from dbwriter import DatabaseWriter
+from cursors import record_cursors
+
+HIST_TABLE = "job_histograms"
+HIST_COLUMNS = ("job_type text, instance text, month text, counts text, total integer, "
+                "PRIMARY KEY (job_type, instance, month)")
+
+# log-spaced run time bins in days, from ~0.1 second to 100 days
+MIN_RUNTIME = 1e-6
+BINS_PER_DECADE = 50
+NBINS = 8 * BINS_PER_DECADE
+
+# a value is represented by the geometric center of its bin, which is at most
+# half a bin (10**(1/100) - 1 ~ 2.3%) away from it, so quantiles of the merged
+# sample move by less than ~2.5%. The outlier cut at the 90th percentile moves
+# with them, which on synthetic histories kept runtime_prediction's median
+# within 1% and its standard deviation and 1st/99th percentiles within 5%.
+TOLERANCE = 0.05
+
+# job types per IN (...) query when reading stored histograms, below the
+# 999 bound parameters older sqlite versions allow
+QUERY_CHUNK = 500
+
+
+def bin_index(run_times):
+    """ Histogram bin of each run time (days), clipped to the bin range """
+    run_times = np.asarray(run_times, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        idx = np.floor(np.log10(run_times / MIN_RUNTIME) * BINS_PER_DECADE)
+    idx = np.nan_to_num(idx, nan=0, posinf=NBINS-1, neginf=0)
+    return np.clip(idx, 0, NBINS-1).astype(int)
+
+def bin_centers():
+    """ Geometric center of every bin in days """
+    return MIN_RUNTIME * 10**((np.arange(NBINS) + 0.5) / BINS_PER_DECADE)
+
+def encode_counts(counts):
+    """ Sparse JSON of a dense count array """
+    nonzero = np.nonzero(counts)[0]
+    return json.dumps({int(i): int(counts[i]) for i in nonzero})
+
+def decode_counts(text):
+    counts = np.zeros(NBINS, dtype=np.int64)
+    for i, n in json.loads(text).items():
+        counts[int(i)] += n
+    return counts
+
+def key_counts(inverse, values, nkeys):
+    """ Histogram of the values of every key in one bincount
+
+    Parameters
+    ----------
+    inverse : np.ndarray
+        Index of the key of each value, as returned by np.unique(return_inverse=True)
+
+    values : np.ndarray
+        Run (or queue) times in days
+
+    nkeys : int
+        Number of keys
+
+    Returns
+    -------
+    counts : np.ndarray
+        (nkeys, NBINS) jobs per key and bin
+    """
+    flat = np.asarray(inverse) * NBINS + bin_index(values)
+    return np.bincount(flat, minlength=nkeys * NBINS).reshape(-1, NBINS)
+
+def load_key_counts(db, table_name, key_columns, job_types):
+    """ Stored histograms of some job types, read QUERY_CHUNK job types per query
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database
+
+    table_name : str
+        Histogram table with a job_type and a counts column
+
+    key_columns : list of str
+        Primary key columns, job_type first
+
+    job_types : list of str
+        Job types to read
+
+    Returns
+    -------
+    counts : dict
+        Key (tuple of the key columns) -> jobs per bin, for every stored
+        histogram of the job types
+    """
+    job_types = sorted(set(job_types))
+    stored = {}
+    for start in range(0, len(job_types), QUERY_CHUNK):
+        chunk = job_types[start:start + QUERY_CHUNK]
+        condition = "job_type IN (%s)" % ", ".join("?" * len(chunk))
+        for row in db.table_query(table_name, ", ".join(list(key_columns) + ["counts"]), condition, chunk) or []:
+            stored[tuple(row[:-1])] = decode_counts(row[-1])
+    return stored
+
+def load_histogram(db, condition="", values=()):
+    """ Sum of the stored histograms matching a condition
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database
+
+    condition : str
+        sql conditional statement on job_type, instance or month
+
+    values : list
+        Values for the condition
+
+    Returns
+    -------
+    counts : np.ndarray
+        Dense counts per bin, all zeros when nothing has been rolled up
+    """
+    counts = np.zeros(NBINS, dtype=np.int64)
+    if (HIST_TABLE,) not in (db.table_names or []):
+        return counts
+    for row in db.table_query(HIST_TABLE, "counts", condition, list(values)):
+        counts += decode_counts(row[0])
+    return counts
+
+def rollup(db, age=180., now=None, verbose=True):
+    """ Collapse old job rows into per (job type, instance, month) histograms
+
+    Rows older than `age` days are binned, added to the histogram of their
+    month (so repeated runs keep accumulating) and deleted from job_times.
+
+    Parameters
+    ----------
+    db : SQLDatabase or PartitionedSQLDatabase
+        Open database
+
+    age : float
+        Rows older than this many days are rolled up
+
+    now : str
+        Reference time (ISO-8601), defaults to the current time
+
+    Returns
+    -------
+    nrows : int
+        Number of rows rolled up
+    """
+    now = np.datetime64(now or 'now', 's')
+    cutoff = str(now - np.timedelta64(int(age*86400), 's'))
+
+    # the ingest cursors must not depend on the rows deleted here
+    record_cursors(db)
+
+    db.create_table(HIST_TABLE, columns=HIST_COLUMNS)
+    months = sorted({row[0] for row in db.table_query("job_times", "DISTINCT substr(timestamp, 1, 7)",
+                                                      "timestamp < ?", [cutoff])})
+
+    nrows = 0
+    for month in months:
+        # the month's histograms and the deletion of its rows are committed together, or
+        # not at all: a failed histogram write must not lose the rows
+        with db.transaction():
+            condition = "substr(timestamp, 1, 7) = ? AND timestamp < ?"
+            rows = db.table_query("job_times", "job_type, instance, run_time", condition, [month, cutoff])
+            if len(rows) == 0:
+                continue
+
+            job_types, instances, run_times = zip(*rows)
+            keys = np.char.add(np.char.add(np.array(job_types, dtype=str), '\n'), np.array(instances, dtype=str))
+            ukeys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.zeros((len(ukeys), NBINS), dtype=np.int64)
+            np.add.at(counts, (inverse, bin_index(run_times)), 1)
+
+            records = []
+            for i, key in enumerate(ukeys):
+                job_type, instance = str(key).split('\n', 1)
+                existing = db.table_query(HIST_TABLE, "counts", "job_type=? AND instance=? AND month=?",
+                                          [job_type, instance, month])
+                total = counts[i] + (decode_counts(existing[0][0]) if len(existing) > 0 else 0)
+                records.append({'job_type': job_type, 'instance': instance, 'month': month,
+                                'counts': encode_counts(total), 'total': int(total.sum())})
+
+            db.replace_records(HIST_TABLE, records)
+            db.delete_records("job_times", condition, [month, cutoff])
+            nrows += len(rows)
+            if verbose:
+                print(f"{month}: rolled up {len(rows)} rows into {len(records)} histograms")
+
+    return nrows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Roll up old job rows into run time histograms')
+    parser.add_argument('--sqldb', default='job.db', type=str, help='SQLite database file, or partitioned or columnar database directory')
+    parser.add_argument('--age', default=180., type=float, help='Roll up rows older than this many days')
+    parser.add_argument('--vacuum', action='store_true', default=False, help='Reclaim the freed disk space afterwards')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # waits for a running update.py, both write through a DatabaseWriter
+    with DatabaseWriter(args.sqldb) as writer:
+        nrows = writer.call(rollup, age=args.age)
+        print(f"Rolled up {nrows} rows")
+        if args.vacuum:
+            writer.call(lambda db: db.vacuum())
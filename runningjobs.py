@@ -0,0 +1,305 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+
+import metrics
+import model
+from timeutils import to_datetime64, to_days
+
+# status of the jobs held by the index
+RUNNING_STATUS = "job-started"
+
+# _source fields read from the job status index
+RUNNING_FIELDS = ["type", "status", "job_id", "@timestamp", "job.job_info.time_start",
+                  "job.job_info.facts.ec2_instance_type"]
+
+# seconds between incremental refreshes, which read the status changes since the last one
+REFRESH_SECONDS = float(os.environ.get('ETC_RUNNING_REFRESH', 10))
+
+# seconds between full resyncs, which reload every running job and refresh the run time statistics
+RESYNC_SECONDS = float(os.environ.get('ETC_RUNNING_RESYNC', 600))
+
+# changes indexed up to this many seconds late (older @timestamp than the cursor) are still read
+OVERLAP_SECONDS = 60
+
+# hits per elastic search request
+PAGE_SIZE = 1000
+
+
+def changes_query(since, skip=0, size=PAGE_SIZE, status=None):
+    """ Query for the job documents updated at or after a timestamp, oldest first then by job id """
+    must = [{"wildcard":{"type":"*"}}]
+    if status is not None:
+        must.append({"match":{"status":status}})
+    if since is not None:
+        must.append({"range":{"@timestamp":{"gte":since}}})
+    # job_id breaks @timestamp ties, so every request sees equal timestamps in the same order
+    return {"query":{"bool":{"must":must,"must_not":[],"should":[]}},"from":skip,"size":size,
+            "sort":[{"@timestamp":{"order":"asc"}},{"job_id":{"order":"asc"}}],"aggs":{}}
+
+def search_pages(cluster, since=None, status=None, size=PAGE_SIZE):
+    """ Page through the job status index of a cluster by @timestamp
+
+    Every request starts at the last timestamp of the previous page and skips
+    the hits already read with that timestamp, so deep paging never needs a
+    large offset. Hits with the same timestamp are sorted by job id, so the
+    ones skipped are the ones already read. Yields lists of hits, raises
+    RuntimeError when a request fails.
+    """
+    cursor, skip = since, 0
+    while True:
+        res = cluster.search_hits(changes_query(cursor, skip, size, status), source=RUNNING_FIELDS,
+                                  index=cluster.status_index)
+        hits = list(res)
+        if res.status_code != 200:
+            raise RuntimeError(f"Error ({cluster.name}): {res.status_code} {res.text}")
+        if len(hits) > 0:
+            yield hits
+        if len(hits) < size:
+            return
+        last = hits[-1]['_source']['@timestamp']
+        same = sum(1 for hit in hits if hit['_source']['@timestamp'] == last)
+        skip = skip + same if last == cursor else same
+        cursor = last
+
+def shift_timestamp(timestamp, seconds):
+    """ ISO-8601 timestamp moved by a number of seconds """
+    moved = to_datetime64(timestamp)[0] + np.timedelta64(int(seconds*1e3), 'ms')
+    return np.datetime_as_string(moved, unit='ms') + 'Z'
+
+
+class RunningJobIndex:
+    """ In-memory index of the running jobs of every cluster, keyed by job id
+
+    A full sync pages through the started jobs of each cluster's status
+    index. Afterwards every refresh only reads the documents whose
+    @timestamp changed since the latest one seen (less OVERLAP_SECONDS):
+    started jobs are added and jobs in any other status are removed. Each
+    entry holds the job's start time and the key of its run time
+    statistics, which are predicted once per job type and instance (one
+    query per instance) and shared by its jobs, so an ETA is a dict lookup. A background thread
+    refreshes every REFRESH_SECONDS once started, and every RESYNC_SECONDS
+    the index is reloaded in full, differences are counted in
+    etc_running_index_resyncs_total and the statistics are re-predicted.
+
+    Parameters
+    ----------
+    predict : callable
+        (job_types, instance) -> {job_type: (run_avg, run_std, run_low,
+        run_high)} in days, model.grouped_runtime_prediction by default
+
+    source : str
+        Cluster to index, None or * for all
+
+    Example:
+        index = RunningJobIndex().start()
+        eta = index.eta("job-a-1234")
+    """
+    def __init__(self, predict=None, source=None, refresh_seconds=REFRESH_SECONDS, resync_seconds=RESYNC_SECONDS):
+        self.predict = predict or model.grouped_runtime_prediction
+        self.source = source
+        self.refresh_seconds = refresh_seconds
+        self.resync_seconds = resync_seconds
+        self.jobs = {}
+        self.stats = {}
+        self.cursors = {}
+        self.last_resync = None
+        self.last_refresh = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def _parse(self, hits, cluster):
+        """ Entries (job_type, instance, cluster, start in unix seconds) of the started jobs in a page """
+        sources = [hit['_source'] for hit in hits]
+        infos = [source.get('job', {}).get('job_info', {}) for source in sources]
+        starts = to_days([info.get('time_start') for info in infos]) * 86400
+        # a started job without a start time counts from its status change
+        missing = np.isnan(starts)
+        if missing.any():
+            starts[missing] = to_days([source.get('@timestamp') for source in sources])[missing] * 86400
+
+        entries = {}
+        for hit, source, info, start in zip(hits, sources, infos, starts.tolist()):
+            job_id = source.get('job_id', hit.get('_id', ''))
+            if source.get('status') != RUNNING_STATUS:
+                entries[job_id] = None
+                continue
+            instance = info.get('facts', {}).get('ec2_instance_type') or "*"
+            entries[job_id] = (source['type'], instance, cluster.name, start)
+        return entries
+
+    def _add_stats(self, entries, stats):
+        # new keys are predicted without holding the lock, lookups go on meanwhile
+        keys = {entry[:2] for entry in entries if entry is not None} - stats.keys()
+        by_instance = {}
+        for job_type, instance in keys:
+            by_instance.setdefault(instance, []).append(job_type)
+        for instance, job_types in by_instance.items():
+            predicted = self.predict(job_types, instance)
+            for job_type in job_types:
+                stats[(job_type, instance)] = tuple(float(value) for value in predicted[job_type][:4])
+
+    def resync(self):
+        """ Reload every running job and refresh the run time statistics
+
+        Returns
+        -------
+        changed : int
+            Jobs added, removed or changed compared with the incremental
+            index, None when no cluster answered
+        """
+        with self._sync_lock:
+            # changes made while the jobs are read are applied by the next refresh
+            started = np.datetime_as_string(np.datetime64('now', 'ms'), unit='ms') + 'Z'
+            jobs, cursors, answered = {}, dict(self.cursors), 0
+            for cluster in model.get_clusters(self.source):
+                try:
+                    cursor = started
+                    for hits in search_pages(cluster, status=RUNNING_STATUS):
+                        jobs.update(self._parse(hits, cluster))
+                        cursor = max(cursor, hits[-1]['_source']['@timestamp'])
+                    cursors[cluster.name] = cursor
+                    answered += 1
+                except Exception as err:
+                    # keep the jobs of a cluster that did not answer
+                    self.logger.error('Running jobs of %s not reloaded: %s' % (cluster.name, err))
+                    jobs.update({job_id: entry for job_id, entry in self.jobs.items() if entry[2] == cluster.name})
+            if answered == 0:
+                return None
+
+            # run times change with every ingest, re-predict the keys still running
+            stats = {}
+            self._add_stats(jobs.values(), stats)
+            with self._lock:
+                changed = sum(1 for job_id in jobs.keys() | self.jobs.keys() if jobs.get(job_id) != self.jobs.get(job_id))
+                self.jobs = jobs
+                self.stats = stats
+                self.cursors = cursors
+            if self.last_resync is not None:
+                if changed > 0:
+                    self.logger.warning('Running job index of %s differed by %d jobs, reloaded %d jobs' %
+                                        (self.source or '*', changed, len(jobs)))
+                metrics.running_resyncs.inc(result="consistent" if changed == 0 else "corrected")
+            self.last_resync = self.last_refresh = time.monotonic()
+            metrics.running_jobs.set(len(jobs))
+            return changed
+
+    def refresh(self):
+        """ Apply the status changes since the last refresh, resync when it is due
+
+        Returns
+        -------
+        added, removed : int
+            Jobs started and jobs no longer running, None when the index was
+            (re)synced instead
+        """
+        clusters = model.get_clusters(self.source)
+        # a cluster that was down at the last resync has no cursor to refresh from
+        if self.last_resync is None or time.monotonic() - self.last_resync > self.resync_seconds or \
+                any(cluster.name not in self.cursors for cluster in clusters):
+            self.resync()
+            return None
+
+        with self._sync_lock:
+            added = removed = 0
+            for cluster in clusters:
+                cursor = self.cursors[cluster.name]
+                try:
+                    for hits in search_pages(cluster, since=shift_timestamp(cursor, -OVERLAP_SECONDS)):
+                        entries = self._parse(hits, cluster)
+                        self._add_stats(entries.values(), self.stats)
+                        with self._lock:
+                            for job_id, entry in entries.items():
+                                if entry is None:
+                                    removed += self.jobs.pop(job_id, None) is not None
+                                else:
+                                    added += job_id not in self.jobs
+                                    self.jobs[job_id] = entry
+                            self.cursors[cluster.name] = max(cursor, hits[-1]['_source']['@timestamp'])
+                except Exception as err:
+                    self.logger.error('Running jobs of %s not refreshed: %s' % (cluster.name, err))
+            self.last_refresh = time.monotonic()
+            metrics.running_jobs.set(len(self.jobs))
+            return added, removed
+
+    def start(self):
+        """ Sync once and keep refreshing in the background, callers wait for the first sync """
+        with self._start_lock:
+            if self._thread is None:
+                self.resync()
+                self._thread = threading.Thread(target=self._run, name="running-jobs", daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as err:
+                self.logger.error('Running job index refresh failed: %s' % err)
+
+    def eta(self, job_id, now=None):
+        """ Time left for a running job
+
+        Parameters
+        ----------
+        job_id : str
+            Id of the job
+
+        now : float
+            Unix time to measure from, the current time by default
+
+        Returns
+        -------
+        eta : dict
+            job_type, instance, source, start (unix seconds), elapsed and the
+            expected remaining time (mean, low, high) in seconds given how long
+            the job has run, with overdue set once it ran past the high run
+            time. history is False and the run and remaining times are None
+            when its job type never completed on its instance. None when the
+            job is not running.
+        """
+        entry = self.jobs.get(job_id)
+        if entry is None:
+            return None
+        job_type, instance, cluster, start = entry
+        elapsed = max(0., (now or time.time()) - start)
+        estimate = {
+            'job_type': job_type,
+            'instance': instance,
+            'source': cluster,
+            'start': start,
+            'elapsed': elapsed,
+            'history': False,
+            'run_avg': None,
+            'run_std': None,
+            'remaining': None,
+            'remaining_low': None,
+            'remaining_high': None,
+            'overdue': False
+        }
+        stats = self.stats.get((job_type, instance), (0, 0, 0, 0))
+        if not any(stats):
+            # predict returns zeros for a job type without run times
+            return estimate
+
+        run_avg, run_std, run_low, run_high = [value*24*60*60 for value in stats]
+        estimate.update({
+            'history': True,
+            'run_avg': run_avg,
+            'run_std': run_std,
+            'remaining': max(0., run_avg - elapsed),
+            'remaining_low': max(0., run_low - elapsed),
+            'remaining_high': max(0., run_high - elapsed),
+            'overdue': run_high > 0 and elapsed > run_high
+        })
+        return estimate
+
+    def __len__(self):
+        return len(self.jobs)
@@ -0,0 +1,71 @@
+import threading
+
+import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """ Share one in-flight computation between concurrent identical calls
+
+    The first caller of a key runs the function, callers arriving with the
+    same key while it runs block and get its result (or its exception).
+    Nothing is kept once the call returns, the next caller computes again.
+
+    Example:
+        group = SingleFlight('queuetime')
+        result, shared = group.do(('/queuetime', 'size=4444&nodes=5'), compute)
+    """
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """ Run func or wait for the identical call in flight
+
+        Returns
+        -------
+        result : object
+            Return value of func
+
+        shared : bool
+            True when the result came from another caller's computation
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            metrics.coalesced_requests.inc(group=self.name, role="waiter")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        metrics.coalesced_requests.inc(group=self.name, role="leader")
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result, False
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
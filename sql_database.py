@@ -1,11 +1,24 @@
 
 import os
+import re
+import json
 import sqlite3
 import logging
 from string import Template
+from contextlib import contextmanager
+from functools import partial
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor
 
+from metrics import track_sql
+from profiling import pool_map
+from storage import StorageBackend
 
-class SQLDatabase:
+# journal mode of databases opened for writing, with WAL readers are not blocked by the writer
+JOURNAL_MODE = os.environ.get('ETC_JOURNAL_MODE', 'wal')
+
+
+class SQLDatabase(StorageBackend):
     def __init__(self):
         self._connected = False
         self.db_connection = None
@@ -17,6 +30,9 @@ class SQLDatabase:
         # database table names
         self._table_names = None
 
+        # writes are committed together when the transaction() ends
+        self._in_transaction = False
+
         # logger
         self.logger = logging.getLogger(__name__)
 
@@ -51,7 +67,7 @@ class SQLDatabase:
 
         return
 
-    def open(self, db_file, timeout=30):
+    def open(self, db_file, timeout=30, readonly=False):
         """Open sqlite database
 
         Parameters
@@ -62,6 +78,10 @@ class SQLDatabase:
         timeout : float
             Timeout in seconds
 
+        readonly : bool
+            Open a read only connection, used by the model and web server.
+            Writable connections switch the database to JOURNAL_MODE.
+
         Returns
         -------
         None
@@ -71,7 +91,11 @@ class SQLDatabase:
             return
 
         try:
-            self.db_connection = sqlite3.connect(database=db_file, timeout=timeout)
+            if readonly:
+                uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(db_file))
+                self.db_connection = sqlite3.connect(database=uri, timeout=timeout, uri=True)
+            else:
+                self.db_connection = sqlite3.connect(database=db_file, timeout=timeout)
         except sqlite3.DatabaseError as err:
             self.logger.error('Unable to open sqlite database %s' % db_file)
             self.logger.error('sqlite error : %s' % err)
@@ -79,9 +103,24 @@ class SQLDatabase:
             self._db_name = os.path.splitext(db_file)[0]
             self.db_cursor = self.db_connection.cursor()
             self._connected = True
+            if not readonly:
+                self._journal_mode()
 
         return
 
+    def _journal_mode(self):
+        # persistent in the file, only the first writable open of an older database changes it
+        try:
+            mode = self.db_cursor.execute("PRAGMA journal_mode").fetchone()[0]
+            if mode.lower() != JOURNAL_MODE.lower():
+                # stepped to the end, an unfinished statement keeps the journal of the switch
+                self.db_cursor.execute("PRAGMA journal_mode=%s" % JOURNAL_MODE).fetchall()
+            if JOURNAL_MODE.lower() == 'wal':
+                # commits survive a crash of the process, a power loss may drop the last ones
+                self.db_cursor.execute("PRAGMA synchronous=NORMAL").fetchall()
+        except sqlite3.OperationalError as err:
+            self.logger.warning('Unable to set journal mode %s of %s: %s' % (JOURNAL_MODE, self._db_name, err))
+
     def close(self):
         """Disconnect from the database.
 
@@ -100,6 +139,49 @@ class SQLDatabase:
 
         return
 
+    def _commit(self):
+        # writes inside transaction() are committed when it ends
+        if not self._in_transaction:
+            self.db_connection.commit()
+
+    def begin(self):
+        """Start collecting writes into one transaction, see transaction()"""
+        self._in_transaction = True
+
+    def end(self, commit=True):
+        """Commit (or roll back) the writes since begin()"""
+        self._in_transaction = False
+        if self.isConnected:
+            if commit:
+                self.db_connection.commit()
+            else:
+                self.db_connection.rollback()
+
+    @contextmanager
+    def transaction(self):
+        """Commit the writes of a block together, or none of them
+
+        Inside the block writes are not committed one by one and sqlite errors
+        are raised instead of logged. The writes are committed when the block
+        ends and rolled back when it raises, so readers never see part of
+        them. Nested blocks join the outer transaction.
+
+        Example:
+            with db.transaction():
+                db.insert_many("job_times", columns, rows)
+                db.replace_records(STATS_TABLE, records)
+        """
+        if self._in_transaction:
+            yield
+            return
+        self.begin()
+        try:
+            yield
+        except BaseException:
+            self.end(commit=False)
+            raise
+        self.end()
+
     def create_db(self, db_file, timeout=30):
         """Create sqlite database
 
@@ -124,6 +206,7 @@ class SQLDatabase:
             self._db_name = os.path.splitext(db_file)[0]
             self.db_cursor = self.db_connection.cursor()
             self._connected = True
+            self._journal_mode()
 
         return
 
@@ -210,6 +293,56 @@ class SQLDatabase:
 
         return
 
+    def table_schema(self, table_name):
+        """Get the column definitions a table was created with.
+
+        Parameters
+        ----------
+        table_name : str
+            Database table name
+
+        Return
+        ------
+        columns : str
+            Column definitions as passed to create_table, None if the table does not exist
+        """
+        rows = self.table_query("sqlite_master", "sql", "type='table' AND name=?", [table_name])
+        if rows:
+            sql = rows[0][0]
+            return sql[sql.index('(')+1:sql.rindex(')')].strip()
+        return
+
+    def add_column(self, table_name, column):
+        """Add a column to an existing table, rows get its default value.
+
+        Parameters
+        ----------
+        table_name : str
+            Database table name
+
+        column : str
+            Column name + data type (+ DEFAULT value)
+
+        Returns
+        -------
+        None
+        """
+        if self.isConnected:
+            try:
+                sql_template = Template('ALTER TABLE $table_name ADD COLUMN $column')
+                sql_statement = sql_template.substitute({'table_name': table_name, 'column': column})
+                self.db_cursor.execute(sql_statement)
+                self._commit()
+            except sqlite3.OperationalError as err:
+                if self._in_transaction:
+                    raise
+                self.logger.error('Failed to add column to table %s' % table_name)
+                self.logger.error('sqlite error : %s' % err)
+        else:
+            self.logger.warning('Database not open')
+
+        return
+
     def get_all_rows(self, table_name):
         """Get all rows in the database table.
 
@@ -239,6 +372,7 @@ class SQLDatabase:
 
         return
 
+    @track_sql('table_query')
     def table_query(self, table_name, columns, condition, values):
         """Get all rows in the database table.
 
@@ -276,6 +410,8 @@ class SQLDatabase:
                 try:
                     self.db_cursor.execute(sql_statement, values)
                 except sqlite3.OperationalError as err:
+                    if self._in_transaction:
+                        raise
                     self.logger.error('Failed to query tables(s): %s' % table_name)
                     self.logger.error('sqlite error : %s' % err)
                 else:
@@ -287,6 +423,7 @@ class SQLDatabase:
 
         return list()
 
+    @track_sql('count_rows')
     def count_rows(self, table_name, columns, condition, values):
         """Return number of rows in the database table.
 
@@ -324,6 +461,8 @@ class SQLDatabase:
                 try:
                     self.db_cursor.execute(sql_statement, values)
                 except sqlite3.OperationalError as err:
+                    if self._in_transaction:
+                        raise
                     self.logger.error('Failed to query tables(s): %s' % table_name)
                     self.logger.error('sqlite error : %s' % err)
                 else:
@@ -366,6 +505,7 @@ class SQLDatabase:
 
         return
 
+    @track_sql('insert_records')
     def insert_records(self, table_name, entries):
         """Insert values to table
 
@@ -402,8 +542,10 @@ class SQLDatabase:
                 # execute insert statement
                 try:
                     self.db_cursor.execute(sql_statement, values)
-                    self.db_connection.commit()
+                    self._commit()
                 except sqlite3.OperationalError as err:
+                    if self._in_transaction:
+                        raise
                     self.logger.error('Failed to insert the record')
                     self.logger.error('sqlite error : %s' % err)
             else:
@@ -413,6 +555,89 @@ class SQLDatabase:
 
         return
 
+    @track_sql('insert_many')
+    def insert_many(self, table_name, columns, rows):
+        """Bulk insert rows in one transaction
+
+        Parameters
+        ----------
+        table_name : str
+            Table Name
+
+        columns : list of str
+            Column names
+
+        rows : iterable
+            Sequences of values ordered like columns
+
+        Returns
+        -------
+        None
+        """
+        if self.isConnected:
+            sql_template = Template('INSERT INTO $table_name ($column_name) VALUES ($values)')
+            sql_statement = sql_template.substitute({'table_name': table_name,
+                                                     'column_name': ', '.join(columns),
+                                                     'values': ', '.join(['?']*len(columns))})
+            self.logger.debug('SQL statement: %s' % sql_statement)
+
+            try:
+                self.db_cursor.executemany(sql_statement, rows)
+                self._commit()
+            except sqlite3.OperationalError as err:
+                if self._in_transaction:
+                    raise
+                self.logger.error('Failed to insert the records')
+                self.logger.error('sqlite error : %s' % err)
+        else:
+            self.logger.warning('Database not open')
+
+        return
+
+    @track_sql('replace_records')
+    def replace_records(self, table_name, entries):
+        """Insert or replace several records in one transaction
+
+        Parameters
+        ----------
+        table_name : str
+            Table Name
+
+        entries : list of dict
+            entries as dictionaries sharing the same keys, rows that collide
+            with a unique key are replaced
+
+        Returns
+        -------
+        None
+        """
+        if self.isConnected:
+            if isinstance(entries, (list, tuple)):
+                if len(entries) == 0:
+                    return
+
+                columns = list(entries[0].keys())
+                sql_template = Template('INSERT OR REPLACE INTO $table_name ($column_name) VALUES ($values)')
+                sql_statement = sql_template.substitute({'table_name': table_name,
+                                                         'column_name': ', '.join(columns),
+                                                         'values': ', '.join(['?']*len(columns))})
+                self.logger.debug('SQL statement: %s' % sql_statement)
+
+                try:
+                    self.db_cursor.executemany(sql_statement, [[entry[c] for c in columns] for entry in entries])
+                    self._commit()
+                except sqlite3.OperationalError as err:
+                    if self._in_transaction:
+                        raise
+                    self.logger.error('Failed to replace the records')
+                    self.logger.error('sqlite error : %s' % err)
+            else:
+                self.logger.error('Entries should be a list of python dictionaries')
+        else:
+            self.logger.warning('Database not open')
+
+        return
+
     def table_update(self, table_name, entries, condition):
         """Update table record
 
@@ -451,8 +676,10 @@ class SQLDatabase:
                 # execute insert statement
                 try:
                     self.db_cursor.execute(sql_statement, values)
-                    self.db_connection.commit()
+                    self._commit()
                 except sqlite3.OperationalError as err:
+                    if self._in_transaction:
+                        raise
                     self.logger.error('Failed to update the record')
                     self.logger.error(sql_statement, values)
                     self.logger.error('sqlite error : %s' % err)
@@ -463,6 +690,7 @@ class SQLDatabase:
 
         return
 
+    @track_sql('delete_records')
     def delete_records(self, table_name, condition, values):
         """Delete rows in the database table.
            db.delete_records("test", "Name == ?", ["DUDE"])
@@ -492,10 +720,12 @@ class SQLDatabase:
                 try:
                     self.db_cursor.execute(sql_statement, values)
                 except sqlite3.OperationalError as err:
+                    if self._in_transaction:
+                        raise
                     self.logger.error('Failed to query tables(s): %s' % table_name)
                     self.logger.error('sqlite error : %s' % err)
                 else:
-                    self.db_connection.commit()
+                    self._commit()
             else:
                 self.logger.error('Query conditional values should be list or tuple')
         else:
@@ -503,6 +733,447 @@ class SQLDatabase:
 
         return
 
+    def vacuum(self):
+        """Rebuild the database file to reclaim the space of deleted rows
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        None
+        """
+        if self.isConnected:
+            try:
+                self.db_connection.commit()
+                self.db_cursor.execute('VACUUM')
+            except sqlite3.OperationalError as err:
+                self.logger.error('Failed to vacuum the database')
+                self.logger.error('sqlite error : %s' % err)
+        else:
+            self.logger.warning('Database not open')
+
+        return
+
+
+class PartitionedSQLDatabase(StorageBackend):
+    """Directory of sqlite files with time partitioned tables
+
+    Tables registered as partitioned (job_times by default) are split into one
+    file per period, e.g. job_times_2022_04.db, routed by a timestamp column.
+    Inserts go to the partition of each row, queries run on all partitions in
+    parallel and their rows are concatenated, oldest period first. Other
+    tables live in main.db. Dropping a period is a file removal.
+
+    Conditions are evaluated per partition, so ORDER BY or LIMIT clauses apply
+    within each partition. Single MIN/MAX/SUM/COUNT column aggregates are merged.
+    """
+    CONFIG = 'partitions.json'
+    MAIN = 'main.db'
+    PERIODS = {'year': 4, 'month': 7, 'day': 10} # length of the timestamp prefix
+
+    _aggregate = re.compile(r'^\s*(MIN|MAX|SUM|COUNT)\s*\(.*\)\s*$', re.IGNORECASE)
+    _pool = None
+
+    def __init__(self, period='month', partitioned=None, workers=8):
+        self.period = period
+        self.partitioned = dict(partitioned or {'job_times': 'timestamp'})
+        self.schemas = {}
+        self.workers = workers
+
+        self._connected = False
+        self._db_dir = None
+        self._timeout = 30
+        self._readonly = False
+        self.main = SQLDatabase()
+        self._writers = {}
+        self._in_transaction = False
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def isConnected(self):
+        return self._connected
+
+    @property
+    def db_name(self):
+        return self._db_dir
+
+    @property
+    def table_names(self):
+        if self.isConnected:
+            names = set(self.main.table_names or [])
+            names.update((table,) for table in self.schemas)
+            return sorted(names)
+        else:
+            self.logger.warning('Database not open')
+
+    @classmethod
+    def _executor(cls):
+        if cls._pool is None:
+            cls._pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+        return cls._pool
+
+    def _save_config(self):
+        with open(os.path.join(self._db_dir, self.CONFIG), 'w') as f:
+            json.dump({'period': self.period, 'partitioned': self.partitioned, 'schemas': self.schemas}, f, indent=2)
+
+    def open(self, db_dir, timeout=30, readonly=False):
+        """Open a partitioned database directory
+
+        Parameters
+        ----------
+        db_dir : str
+            Database directory
+
+        timeout : float
+            Timeout in seconds
+
+        readonly : bool
+            Read main.db and the partitions with read only connections
+
+        Returns
+        -------
+        None
+        """
+        self._readonly = readonly
+        self._connect(db_dir, timeout, partial(self.main.open, readonly=readonly))
+        return
+
+    def _connect(self, db_dir, timeout, main_open):
+        config = os.path.join(db_dir, self.CONFIG)
+        if not os.path.isfile(config):
+            self.logger.error('Partitioned database %s not found.' % db_dir)
+            return
+
+        with open(config) as f:
+            settings = json.load(f)
+        self.period = settings['period']
+        self.partitioned = settings['partitioned']
+        self.schemas = settings.get('schemas', {})
+
+        main_open(os.path.join(db_dir, self.MAIN), timeout=timeout)
+        if self.main.isConnected:
+            self._db_dir = db_dir
+            self._timeout = timeout
+            self._connected = True
+
+        return
+
+    def create_db(self, db_dir, timeout=30):
+        """Create a partitioned database directory
+
+        Parameters
+        ----------
+        db_dir : str
+            Database directory
+
+        timeout : float
+            Timeout in seconds
+
+        Returns
+        -------
+        None
+        """
+        if self.period not in self.PERIODS:
+            self.logger.error('Unknown partition period %s, use one of %s' % (self.period, list(self.PERIODS)))
+            return
+
+        os.makedirs(db_dir, exist_ok=True)
+        self._db_dir = db_dir
+        if not os.path.isfile(os.path.join(db_dir, self.CONFIG)):
+            self._save_config()
+        self._connect(db_dir, timeout, self.main.create_db)
+
+    def close(self):
+        if self.isConnected:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers = {}
+            self.main.close()
+            self._connected = False
+        else:
+            self.logger.warning('Database not open')
+
+    def partitions(self, table_name='job_times'):
+        """Sorted period keys (e.g. 2022_04) of a partitioned table"""
+        prefix = table_name + '_'
+        keys = []
+        if self._db_dir is not None:
+            for name in os.listdir(self._db_dir):
+                if name.startswith(prefix) and name.endswith('.db'):
+                    keys.append(name[len(prefix):-3])
+        return sorted(keys)
+
+    def partition_file(self, table_name, key):
+        return os.path.join(self._db_dir, '%s_%s.db' % (table_name, key))
+
+    def partition_key(self, timestamp):
+        """Period key of a timestamp, e.g. 2022-04-20T12:00:00Z -> 2022_04"""
+        return str(timestamp)[:self.PERIODS[self.period]].replace('-', '_')
+
+    def drop_partition(self, key, table_name='job_times'):
+        """Remove a whole period of a partitioned table
+
+        Parameters
+        ----------
+        key : str
+            Period key, e.g. 2020_01
+
+        table_name : str
+            Partitioned table
+
+        Returns
+        -------
+        None
+        """
+        # reads open their own connections and close them when done, the writer is the only one kept
+        writer = self._writers.pop((table_name, key), None)
+        if writer is not None:
+            writer.close()
+        path = self.partition_file(table_name, key)
+        if os.path.isfile(path):
+            os.remove(path)
+        else:
+            self.logger.warning('Partition %s not found' % path)
+        # a partition created again with the same key must not pick up the old write-ahead log
+        for suffix in ('-wal', '-shm'):
+            if os.path.isfile(path + suffix):
+                os.remove(path + suffix)
+
+    def _writer(self, table_name, key):
+        # one connection per partition written to, created with the table schema
+        writer = self._writers.get((table_name, key))
+        if writer is None:
+            writer = SQLDatabase()
+            writer.create_db(self.partition_file(table_name, key), timeout=self._timeout)
+            writer.create_table(table_name, columns=self.schemas[table_name])
+            if self._in_transaction:
+                writer.begin()
+            self._writers[(table_name, key)] = writer
+        return writer
+
+    @contextmanager
+    def transaction(self):
+        """Commit the writes of a block together, see SQLDatabase.transaction
+
+        Each file has its own sqlite transaction. The partitions are committed
+        before main.db, so a crash in between leaves partition rows that
+        main.db (e.g. the ingest cursor) does not know about yet, never the
+        other way round.
+        """
+        if self._in_transaction:
+            yield
+            return
+        self._in_transaction = True
+        for db in [self.main] + list(self._writers.values()):
+            db.begin()
+        try:
+            yield
+        except BaseException:
+            self._in_transaction = False
+            for db in [self.main] + list(self._writers.values()):
+                db.end(commit=False)
+            raise
+        self._in_transaction = False
+        for db in list(self._writers.values()) + [self.main]:
+            db.end()
+
+    def create_table(self, table_name, columns=""):
+        if not self.isConnected:
+            self.logger.warning('Database not open')
+        elif table_name in self.partitioned:
+            if self.schemas.get(table_name) != columns:
+                self.schemas[table_name] = columns
+                self._save_config()
+        else:
+            self.main.create_table(table_name, columns=columns)
+
+    def drop_table(self, table_name):
+        if table_name in self.partitioned:
+            for key in self.partitions(table_name):
+                self.drop_partition(key, table_name)
+        else:
+            self.main.drop_table(table_name)
+
+    def _fan_out(self, table_name, method, *args):
+        # run a read on every partition, each worker with its own connection
+        def run(key):
+            db = SQLDatabase()
+            db.open(self.partition_file(table_name, key), timeout=self._timeout, readonly=self._readonly)
+            try:
+                return getattr(db, method)(table_name, *args)
+            finally:
+                if db.isConnected:
+                    db.close()
+
+        keys = self.partitions(table_name)
+        if len(keys) <= 1:
+            return [run(key) for key in keys]
+        return pool_map(self._executor, run, keys)
+
+    def table_column_name(self, table_name):
+        if table_name not in self.partitioned:
+            return self.main.table_column_name(table_name)
+        results = self._fan_out(table_name, 'table_column_name')
+        if len(results) > 0:
+            return results[0]
+        if table_name in self.schemas:
+            # no partition written yet, the columns are the ones partitions will be created with
+            from columnar_database import parse_schema
+            return parse_schema(self.schemas[table_name])[0]
+        return None
+
+    def table_schema(self, table_name):
+        if table_name in self.partitioned:
+            return self.schemas.get(table_name)
+        return self.main.table_schema(table_name)
+
+    def add_column(self, table_name, column):
+        if table_name not in self.partitioned:
+            return self.main.add_column(table_name, column)
+        for key in self.partitions(table_name):
+            self._writer(table_name, key).add_column(table_name, column)
+        self.schemas[table_name] = self.schemas[table_name] + ", " + column
+        self._save_config()
+
+    @track_sql('table_query')
+    def table_query(self, table_name, columns, condition, values):
+        if not self.isConnected:
+            self.logger.warning('Database not open')
+            return list()
+        if table_name not in self.partitioned:
+            return self.main.table_query(table_name, columns, condition, values)
+
+        results = self._fan_out(table_name, 'table_query', columns, condition, values)
+        match = self._aggregate.match(columns)
+        if match is None or ',' in columns:
+            return [row for rows in results for row in rows]
+
+        # merge a single column aggregate
+        values = [rows[0][0] for rows in results if len(rows) > 0 and rows[0][0] is not None]
+        func = match.group(1).upper()
+        if len(values) == 0:
+            return [(0,)] if func == 'COUNT' else [(None,)]
+        if func == 'MAX':
+            return [(max(values),)]
+        if func == 'MIN':
+            return [(min(values),)]
+        return [(sum(values),)]
+
+    @track_sql('count_rows')
+    def count_rows(self, table_name, columns, condition, values):
+        if not self.isConnected:
+            self.logger.warning('Database not open')
+            return 0
+        if table_name not in self.partitioned:
+            return self.main.count_rows(table_name, columns, condition, values)
+        return sum(self._fan_out(table_name, 'count_rows', columns, condition, values))
+
+    @track_sql('insert_records')
+    def insert_records(self, table_name, entries):
+        if table_name not in self.partitioned:
+            return self.main.insert_records(table_name, entries)
+        key = self.partition_key(entries[self.partitioned[table_name]])
+        self._writer(table_name, key).insert_records(table_name, entries)
+
+    def _route(self, table_name, column_names, rows):
+        # group rows by the partition of their timestamp
+        idx = list(column_names).index(self.partitioned[table_name])
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.partition_key(row[idx]), []).append(row)
+        return groups
+
+    @track_sql('insert_many')
+    def insert_many(self, table_name, columns, rows):
+        if table_name not in self.partitioned:
+            return self.main.insert_many(table_name, columns, rows)
+        for key, group in self._route(table_name, columns, rows).items():
+            self._writer(table_name, key).insert_many(table_name, columns, group)
+
+    @track_sql('replace_records')
+    def replace_records(self, table_name, entries):
+        if table_name not in self.partitioned:
+            return self.main.replace_records(table_name, entries)
+        if len(entries) == 0:
+            return
+        column = self.partitioned[table_name]
+        groups = {}
+        for entry in entries:
+            groups.setdefault(self.partition_key(entry[column]), []).append(entry)
+        for key, group in groups.items():
+            self._writer(table_name, key).replace_records(table_name, group)
+
+    def table_update(self, table_name, entries, condition):
+        if table_name not in self.partitioned:
+            return self.main.table_update(table_name, entries, condition)
+        for key in self.partitions(table_name):
+            self._writer(table_name, key).table_update(table_name, entries, condition)
+
+    @track_sql('delete_records')
+    def delete_records(self, table_name, condition, values):
+        if table_name not in self.partitioned:
+            return self.main.delete_records(table_name, condition, values)
+        for key in self.partitions(table_name):
+            self._writer(table_name, key).delete_records(table_name, condition, values)
+
+    def vacuum(self):
+        """Drop empty partitions and compact the others"""
+        for table_name in self.schemas:
+            for key in self.partitions(table_name):
+                writer = self._writer(table_name, key)
+                if writer.count_rows(table_name, '*', '', []) == 0:
+                    self.drop_partition(key, table_name)
+                else:
+                    writer.vacuum()
+        self.main.vacuum()
+
+
+# storage backends selectable with get_database(backend=...) or ETC_STORAGE
+BACKENDS = ('sqlite', 'columnar')
+
+def get_database(db_path, period=None, backend=None):
+    """Unopened database object for a path
+
+    Existing databases are recognized from their layout. New ones use the
+    backend argument, else the ETC_STORAGE environment variable (sqlite or
+    columnar), else a single sqlite file.
+
+    Parameters
+    ----------
+    db_path : str
+        sqlite file, or directory of a partitioned or columnar database
+
+    period : str
+        Partition period (year, month or day) when creating a new partitioned database
+
+    backend : str
+        sqlite or columnar, when creating a new database
+
+    Returns
+    -------
+    db : StorageBackend
+        SQLDatabase, PartitionedSQLDatabase or ColumnarDatabase
+    """
+    from columnar_database import ColumnarDatabase
+
+    if os.path.isdir(db_path):
+        if os.path.isfile(os.path.join(db_path, ColumnarDatabase.CONFIG)):
+            return ColumnarDatabase()
+        return PartitionedSQLDatabase(period=period or 'month')
+    if os.path.exists(db_path):
+        return SQLDatabase()
+
+    backend = backend or os.environ.get('ETC_STORAGE', 'sqlite')
+    if backend not in BACKENDS:
+        raise ValueError('Unknown storage backend %s, use one of %s' % (backend, BACKENDS))
+    if backend == 'columnar':
+        return ColumnarDatabase()
+    if period is not None:
+        return PartitionedSQLDatabase(period=period)
+    return SQLDatabase()
+
 
 def getData(db_file, table_name):
     """Get all records from a table"""
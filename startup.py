@@ -0,0 +1,160 @@
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+import threading
+import subprocess
+import numpy as np
+
+from sql_database import get_database
+
+# job keys preloaded before the web server reports ready, 0 disables the warm-up
+WARMUP_KEYS = int(os.environ.get('ETC_WARMUP', 0))
+
+_IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_breakdown(module='webserver', top=20):
+    """ Import times of a module and its imports, measured in a fresh interpreter
+
+    Parameters
+    ----------
+    module : str
+        Module to import
+
+    top : int
+        Number of imports to return
+
+    Returns
+    -------
+    imports : list of tuples
+        (name, self seconds, cumulative seconds, depth) of the slowest
+        imports by cumulative time, the module itself first
+    """
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                         capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if res.returncode != 0:
+        raise RuntimeError("Unable to import %s: %s" % (module, res.stderr.strip().splitlines()[-1:]))
+
+    imports = []
+    for line in res.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match is not None:
+            own, cumulative, indent, name = match.groups()
+            imports.append((name, int(own)*1e-6, int(cumulative)*1e-6, (len(indent) - 1)//2))
+    imports.sort(key=lambda i: -i[2])
+    return imports[:top]
+
+def top_keys(sqldb='job.db', n=100):
+    """ The (job type, instance) keys with the most jobs
+
+    Parameters
+    ----------
+    sqldb : str
+        Database file or directory
+
+    n : int
+        Number of keys
+
+    Returns
+    -------
+    keys : list of tuples
+        (job type, instance), most frequent first
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    data = db.column_query("job_times", ["job_type", "instance"], "", [])
+    db.close()
+    if len(data["job_type"]) == 0:
+        return []
+
+    keys = np.char.add(np.char.add(data["job_type"].astype(str), "\x1f"), data["instance"].astype(str))
+    ukeys, counts = np.unique(keys, return_counts=True)
+    order = np.argsort(-counts, kind='stable')[:n]
+    return [tuple(k.split("\x1f")) for k in ukeys[order].tolist()]
+
+
+class Warmup:
+    """ Preloads the statistics of the most frequent job keys in the background
+
+    Until the warm-up has finished the web server's readiness endpoint
+    answers 503, so a load balancer only routes traffic to it once the
+    SQLite pages of the busiest keys are cached. Without keys to preload
+    it is ready immediately.
+
+    Parameters
+    ----------
+    load : callable
+        Called with (job type, instance) for every key and with
+        (job type, '*') for every job type
+
+    sqldb : str
+        Database file or directory
+    """
+    def __init__(self, load, sqldb='job.db'):
+        self.load = load
+        self.sqldb = sqldb
+        self.keys = 0
+        self.loaded = 0
+        self.seconds = None
+        self.error = None
+        self._done = threading.Event()
+        self._done.set()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def ready(self):
+        return self._done.is_set()
+
+    def start(self, n=WARMUP_KEYS):
+        """ Preload the top n keys in a background thread """
+        if n <= 0 or self._thread is not None:
+            return self
+        self._done.clear()
+        self._thread = threading.Thread(target=self.run, args=(n,), name="warmup", daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self, n):
+        start = time.perf_counter()
+        try:
+            keys = top_keys(self.sqldb, n)
+            jobtypes = list(dict.fromkeys(k[0] for k in keys))
+            work = keys + [(jobtype, '*') for jobtype in jobtypes]
+            self.keys = len(work)
+            for jobtype, instance in work:
+                self.load(jobtype, instance)
+                self.loaded += 1
+        except Exception as err:
+            # a failed warm-up must not keep the server out of rotation
+            self.error = str(err)
+            self.logger.error('Warm-up failed: %s' % err)
+        finally:
+            self.seconds = time.perf_counter() - start
+            print(f"Warm-up: {self.loaded} keys in {self.seconds:.1f} s")
+            self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def status(self):
+        return {'ready': self.ready, 'keys': self.keys, 'loaded': self.loaded,
+                'seconds': self.seconds, 'error': self.error}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Import time breakdown of the web server or another module')
+    parser.add_argument('--module', default='webserver', type=str, help='Module to import')
+    parser.add_argument('--top', default=20, type=int, help='Number of imports to list')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    imports = import_breakdown(args.module, args.top)
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for name, own, cumulative, depth in imports:
+        print(f"{cumulative*1e3:9.1f} ms {own*1e3:7.1f} ms  {'  '*depth}{name}")
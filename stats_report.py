@@ -0,0 +1,155 @@
+import json
+import argparse
+import numpy as np
+
+from sql_database import get_database
+from groupstats import group_runtime_stats, group_summary
+from rollup import HIST_TABLE, bin_centers, decode_counts
+from model import job_condition
+
+# percentiles of the observed run times in every row of the report
+REPORT_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+# job types in the report when no top is given
+TOP = 25
+
+
+def load_run_times(sqldb='job.db', instance="*", source=None):
+    """ Run time of every job on an instance, rolled up jobs included
+
+    Parameters
+    ----------
+    sqldb : str
+        Database file or directory
+
+    instance : str
+        Name of the instance, or * for all of them
+
+    source : str
+        Only jobs of this cluster, None or * for all clusters. Rolled up
+        histograms are not kept per cluster and are left out with a source.
+
+    Returns
+    -------
+    job_types : np.ndarray
+        Job type of each run time
+
+    run_times : np.ndarray
+        Run times in days, rolled up jobs at the center of their bin
+    """
+    db = get_database(sqldb)
+    db.open(sqldb, readonly=True)
+    data = db.column_query("job_times", ["job_type", "run_time"], *job_condition("*", instance, source))
+    job_types, run_times = [data["job_type"].astype(str)], [data["run_time"].astype(float)]
+
+    if (source is None or source == "*") and (HIST_TABLE,) in (db.table_names or []):
+        condition, values = job_condition("*", instance)
+        centers = bin_centers()
+        for job_type, counts in db.table_query(HIST_TABLE, "job_type, counts", condition, values):
+            counts = decode_counts(counts)
+            job_types.append(np.full(counts.sum(), job_type))
+            run_times.append(np.repeat(centers, counts))
+    db.close()
+    return np.concatenate(job_types), np.concatenate(run_times)
+
+def runtime_report(sqldb='job.db', instance="*", source=None, percentiles=REPORT_PERCENTILES):
+    """ Model estimate and observed run time distribution of every job type
+
+    All job types are summarized in one pass over the sorted run times
+    instead of one runtime_prediction per type.
+
+    Parameters
+    ----------
+    sqldb : str
+        Database file or directory
+
+    instance : str
+        Name of the instance, or * for all of them
+
+    source : str
+        Only jobs of this cluster, None or * for all clusters
+
+    percentiles : tuple of float
+        Percentiles of the observed run times to report
+
+    Returns
+    -------
+    rows : list of dict
+        One row per job type, most jobs first: job_type, count, the
+        runtime_prediction estimate (run_avg, run_std, run_low, run_high),
+        its relative uncertainty perr (percent) and the observed mean, std,
+        min, max and percentiles, times in days
+    """
+    job_types, run_times = load_run_times(sqldb, instance, source)
+    if len(run_times) == 0:
+        return []
+
+    ukeys, run_avg, run_std, run_low, run_high, counts = group_runtime_stats(job_types, run_times)
+    summary = group_summary(job_types, run_times, percentiles)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        perr = np.where(run_avg > 0, run_std / run_avg * 100, 0)
+
+    observed = [name for name in summary if name not in ('key', 'count')]
+    rows = []
+    for i in np.lexsort((ukeys, -counts)):
+        row = {'job_type': str(ukeys[i]), 'count': int(counts[i]), 'run_avg': float(run_avg[i]),
+               'run_std': float(run_std[i]), 'run_low': float(run_low[i]), 'run_high': float(run_high[i]),
+               'perr': float(perr[i])}
+        row['observed'] = {name: float(summary[name][i]) for name in observed}
+        rows.append(row)
+    return rows
+
+def plot_report(rows, instance="*", top=TOP):
+    """ Bar chart of the estimates of the most popular job types, sorted by run time
+
+    Job types without spread (identical run times) are left out.
+    """
+    import matplotlib.pyplot as plt
+
+    rows = [row for row in rows if row['run_avg'] >= 1e-6 and row['run_std'] >= 1e-6][:top]
+    rows = sorted(rows, key=lambda row: row['run_avg'])
+    names = [row['job_type'] for row in rows]
+    avgs = np.array([row['run_avg'] for row in rows])*24*60
+    stds = np.array([row['run_std'] for row in rows])*24*60
+    mins = np.array([row['observed']['min'] for row in rows])*24*60
+    maxs = np.array([row['observed']['max'] for row in rows])*24*60
+
+    plt.figure(figsize=(10,10))
+    plt.bar(names, avgs, alpha=0.5, label='Model Estimate')
+    for x in np.arange(len(rows)):
+        plt.plot([x,x], [mins[x], maxs[x]], 'k--', alpha=0.75, label='Historical Data [min-max]' if x == 0 else None)
+    plt.errorbar(np.arange(len(rows))+0.1, avgs, yerr=stds, fmt='.', ls='none', color='blue', alpha=0.5, label='Model Uncertainty')
+    plt.ylabel("Run Time [min]")
+    plt.legend(loc='best')
+    plt.title(f"Performance estimate for {len(rows)} of the most popular jobs ({instance})")
+    plt.xticks(rotation=90)
+    plt.tight_layout()
+    plt.show()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run time statistics of every job type')
+    parser.add_argument('--sqldb', default='job.db', type=str, help='Database file or directory')
+    parser.add_argument('--instance', default='*', type=str, help='Instance of the jobs, * for all')
+    parser.add_argument('--source', default=None, type=str, help='Only jobs of this cluster')
+    parser.add_argument('--top', default=TOP, type=int, help='Most popular job types to report')
+    parser.add_argument('--plot', action='store_true', default=False, help='Plot the report (needs matplotlib)')
+    parser.add_argument('--output', default=None, type=str, help='JSON report file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rows = runtime_report(args.sqldb, args.instance, args.source)
+
+    print(f"{len(rows)} job types on {args.instance}")
+    for row in rows[:args.top]:
+        print(f"  {row['job_type']}: {row['count']} jobs, {row['run_avg']*24*60*60:.1f} +- "
+              f"{row['run_std']*24*60*60:.1f} s ({row['perr']:.0f}%)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows[:args.top], f, indent=2)
+
+    if args.plot:
+        plot_report(rows, args.instance, args.top)
@@ -0,0 +1,137 @@
+import abc
+import numpy as np
+from contextlib import contextmanager
+
+
+class StorageBackend(abc.ABC):
+    """Operations the model, web server and update scripts need from a database
+
+    Implemented by SQLDatabase (one sqlite file), PartitionedSQLDatabase (a
+    directory of sqlite files split by time) and ColumnarDatabase (memory
+    mapped column files). Tables are created from sqlite column definitions,
+    conditions are sql WHERE clauses with ? placeholders and rows come back as
+    lists of tuples, so callers do not depend on the backend. Use
+    sql_database.get_database to pick the backend of a path.
+
+    column_query is the vectorized read path: it returns numpy arrays instead
+    of python tuples, which is what the statistics in model.py consume.
+    """
+
+    @property
+    @abc.abstractmethod
+    def isConnected(self):
+        pass
+
+    @property
+    @abc.abstractmethod
+    def db_name(self):
+        pass
+
+    @property
+    @abc.abstractmethod
+    def table_names(self):
+        """List of (name,) tuples like sqlite_master"""
+
+    @abc.abstractmethod
+    def open(self, db_path, timeout=30, readonly=False):
+        """Connect to an existing database, readonly for readers that never write"""
+
+    @abc.abstractmethod
+    def create_db(self, db_path, timeout=30):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def create_table(self, table_name, columns=""):
+        pass
+
+    @abc.abstractmethod
+    def drop_table(self, table_name):
+        pass
+
+    @abc.abstractmethod
+    def table_column_name(self, table_name):
+        pass
+
+    @abc.abstractmethod
+    def table_schema(self, table_name):
+        """Column definitions the table was created with"""
+
+    @abc.abstractmethod
+    def add_column(self, table_name, column):
+        """Add a column (sqlite definition, e.g. "source text DEFAULT 'x'") to an existing table"""
+
+    @abc.abstractmethod
+    def table_query(self, table_name, columns, condition, values):
+        pass
+
+    @abc.abstractmethod
+    def count_rows(self, table_name, columns, condition, values):
+        pass
+
+    @abc.abstractmethod
+    def insert_records(self, table_name, entries):
+        pass
+
+    @abc.abstractmethod
+    def insert_many(self, table_name, columns, rows):
+        pass
+
+    @abc.abstractmethod
+    def replace_records(self, table_name, entries):
+        pass
+
+    @abc.abstractmethod
+    def table_update(self, table_name, entries, condition):
+        pass
+
+    @abc.abstractmethod
+    def delete_records(self, table_name, condition, values):
+        pass
+
+    @abc.abstractmethod
+    def vacuum(self):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """Commit the writes of a block together, backends without transactions commit each write"""
+        yield
+
+    def get_all_rows(self, table_name):
+        return self.table_query(table_name, '*', '', [])
+
+    def get_table_data(self, table_name):
+        rows = self.get_all_rows(table_name)
+        cols = self.table_column_name(table_name) or []
+        return [dict(zip(cols, row)) for row in rows]
+
+    def column_query(self, table_name, columns, condition, values):
+        """Query columns as numpy arrays
+
+        Parameters
+        ----------
+        table_name : str
+            Database table name
+
+        columns : list of str
+            Column names
+
+        condition : str
+            sql conditional statement
+
+        values : list or tuple
+            List of values corresponding to conditional statement
+
+        Returns
+        -------
+        data : dict
+            Column name -> np.ndarray, empty arrays when nothing matches
+        """
+        rows = self.table_query(table_name, ', '.join(columns), condition, values) or []
+        if len(rows) == 0:
+            return {c: np.array([]) for c in columns}
+        return {c: np.array(col) for c, col in zip(columns, zip(*rows))}
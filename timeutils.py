@@ -0,0 +1,65 @@
+import re
+import numpy as np
+
+# trailing UTC designators used by elastic search, e.g. Z or +00:00
+_tz_suffix = re.compile(r'(Z|[+-]00:?00)$')
+
+def to_datetime64(timestamps, unit='ms'):
+    """ Convert ISO-8601 timestamps (UTC) into a datetime64 array
+
+    Parameters
+    ----------
+    timestamps : str or list of str
+        Timestamps like 2022-04-20T12:34:56.789Z
+
+    unit : str
+        Resolution of the returned array
+
+    Returns
+    -------
+    times : np.ndarray
+        Array of datetime64, NaT for empty or malformed entries
+    """
+    if isinstance(timestamps, str):
+        timestamps = [timestamps]
+
+    clean = []
+    for ts in timestamps:
+        if not ts:
+            clean.append('NaT')
+        else:
+            clean.append(_tz_suffix.sub('', str(ts).strip()).replace(' ', 'T'))
+
+    try:
+        return np.array(clean, dtype=f'datetime64[{unit}]')
+    except ValueError:
+        # fall back to parsing one at a time so a bad entry doesn't spoil the batch
+        times = np.empty(len(clean), dtype=f'datetime64[{unit}]')
+        for i, ts in enumerate(clean):
+            try:
+                times[i] = np.datetime64(ts, unit)
+            except ValueError:
+                times[i] = np.datetime64('NaT')
+        return times
+
+def to_days(timestamps):
+    """ Convert ISO-8601 timestamps (UTC) into days since the unix epoch
+
+    Parameters
+    ----------
+    timestamps : str or list of str
+        Timestamps like 2022-04-20T12:34:56.789Z
+
+    Returns
+    -------
+    days : np.ndarray
+        Float array, NaN for empty or malformed entries
+    """
+    times = to_datetime64(timestamps, unit='ms')
+    days = times.astype('int64').astype(float) / 86400e3
+    days[np.isnat(times)] = np.nan
+    return days
+
+def now_days():
+    """ Current time in days since the unix epoch (UTC) """
+    return np.datetime64('now', 'ms').astype('int64') / 86400e3
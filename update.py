@@ -1,18 +1,77 @@
 import os
+import sys
 import json
 import argparse
-import requests
+import time
+import queue
+import threading
+import traceback
 import numpy as np
-from astropy.time import Time
 
-from sql_database import SQLDatabase
-
-from hysds.celery import app
+from metrics import record_ingest, peak_rss_mb
+from sql_database import BACKENDS, get_database
+from dbwriter import DatabaseWriter
+from timeutils import to_days
+from clusters import CLUSTERS_FILE, DEFAULT_ENDPOINT, DEFAULT_SOURCE, SOURCE_COLUMN, Cluster, load_clusters
+from predictions import PREDICTIONS_DIR, materialize
+from decayed_stats import HALF_LIFE, STATS_TABLE, STATS_COLUMNS, update_decayed_stats, rebuild_decayed_stats
+from waittime import WAIT_TABLE, WAIT_COLUMNS, update_wait_sketches, rebuild_wait_sketches
+from cursors import CURSOR_TABLE, CURSOR_COLUMNS, load_cursors, save_cursor
+from param_stats import PARAMS_TABLE, PARAMS_COLUMNS, PARAMS_COLUMN, params_fingerprint, update_params_sketches, \
+    rebuild_params_sketches
 
 # new metrics: http://localhost:9200
-def return_jobs(jobtype="*", instance="*", start_idx=0, start_timestamp="2020-01-01T00:00:00",
-                es_index="_search", es_endpoint="http://18.236.110.240:49200/", status="successful", 
-                size=1000, verbose=False, return_total=False):
+# endpoint of the default cluster when no clusters file is configured, patched by the benchmarks
+default_es_endpoint = DEFAULT_ENDPOINT
+
+# parsed pages waiting for the database writer, per cluster
+PAGE_QUEUE = 4
+
+# _source fields read from each job document, everything else stays in elastic search
+INGEST_FIELDS = ["type", "@timestamp", "job.job_info.time_queued", "job.job_info.time_start",
+                 "job.job_info.time_end", "job.job_info.facts.ec2_instance_type", "job.job_info.job_queue",
+                 "job.params"]
+
+JOB_COLUMNS = ("uid integer primary key autoincrement, job_type text, "
+               "instance text, run_time real, timestamp datetime, data text, " + SOURCE_COLUMN + ", "
+               "queue text, queue_time real, " + PARAMS_COLUMN)
+
+# columns added to job_times after its first release, (name, definition)
+JOB_MIGRATIONS = [("source", SOURCE_COLUMN), ("queue", "queue text"), ("queue_time", "queue_time real"),
+                  ("params_hash", PARAMS_COLUMN)]
+
+def search_jobs(jobtype="*", instance="*", start_idx=0, start_timestamp="2020-01-01T00:00:00",
+                es_index="_search", es_endpoint=None, status="successful", size=1000, source=INGEST_FIELDS,
+                cluster=None):
+    """ Query elastic search for jobs and decode the hits as they arrive
+
+    Parameters
+    ----------
+    jobtype : str
+        Job type wildcard
+
+    instance : str
+        Execute node wildcard
+
+    start_idx : int
+        Offset of the first hit
+
+    start_timestamp : str
+        Only jobs with a later @timestamp
+
+    source : list of str
+        _source fields to return, None for whole documents
+
+    cluster : clusters.Cluster
+        Cluster to query, replaces es_endpoint and es_index
+
+    Returns
+    -------
+    hits : es_client.HitStream
+        Iterable of hits with the total and the bytes transferred
+    """
+    if cluster is None:
+        cluster = Cluster(DEFAULT_SOURCE, es_endpoint or default_es_endpoint, es_index)
 
     # set up elastic search query
     query = {"query":{"bool":{ 
@@ -31,36 +90,88 @@ def return_jobs(jobtype="*", instance="*", start_idx=0, start_timestamp="2020-01
     }
 
     # query end point
-    endpoint = os.path.join(es_endpoint, es_index)
+    return cluster.search_hits(query, source=source)
 
-    if "localhost" in endpoint:
-        res = requests.post(endpoint, data=json.dumps(query), headers={"Content-Type":"application/json"})
-    else:
-        res = requests.post(endpoint, data=json.dumps(query), verify=False)
+def return_jobs(jobtype="*", instance="*", start_idx=0, start_timestamp="2020-01-01T00:00:00",
+                es_index="_search", es_endpoint=None, status="successful", 
+                size=1000, verbose=False, return_total=False, source=INGEST_FIELDS, cluster=None):
+
+    stream = search_jobs(jobtype=jobtype, instance=instance, start_idx=start_idx, start_timestamp=start_timestamp,
+                         es_index=es_index, es_endpoint=es_endpoint, status=status, size=size, source=source,
+                         cluster=cluster)
+    jobs = list(stream)
 
     # parse response
-    jobs = []
-    if res.status_code == 200:
-        search_result = res.json()
-        jobs.extend(search_result['hits']['hits'])
+    if stream.status_code == 200:
         if verbose:
-            print("search results for completed jobs:", search_result['hits']['total'])
-            print("   values returned:", len(search_result['hits']['hits']))
+            print("search results for completed jobs:", stream.total)
+            print("   values returned:", len(jobs))
     else:
-        print("Error:", res.status_code)
+        print("Error:", stream.status_code)
 
     if return_total:
-        return jobs, search_result['hits']['total']
+        return jobs, stream.total
     else:
         return jobs
 
-def create_backup_table(table_name):
+def parse_jobs(hits):
+    """ Extract the ingested fields of job documents in a single pass
+
+    Parameters
+    ----------
+    hits : iterable of dicts
+        Elastic search hits, e.g. a HitStream
+
+    Returns
+    -------
+    jobs : dict
+        Arrays of job_type, instance, run_time (days, 0 when a time is missing),
+        timestamp, queue, queue_time (days, NaN when a time is missing) and
+        params_hash (param_stats.params_fingerprint, empty without params)
+    """
+    job_types, instances, timestamps, queues, fingerprints = [], [], [], [], []
+    queued, started, ended = [], [], []
+    for hit in hits:
+        source = hit['_source']
+        info = source.get('job', {}).get('job_info', {})
+        job_types.append(source['type'])
+        timestamps.append(source['@timestamp'])
+        instances.append(info.get('facts', {}).get('ec2_instance_type', ''))
+        queues.append(info.get('job_queue', ''))
+        queued.append(info.get('time_queued'))
+        started.append(info.get('time_start'))
+        ended.append(info.get('time_end'))
+        fingerprints.append(params_fingerprint(source.get('job', {}).get('params')))
+
+    # compute queued, started and completed time for each
+    tq, ts, te = to_days(queued), to_days(started), to_days(ended)
+    run_times = te - ts
+    run_times[np.isnan(tq) | np.isnan(ts) | np.isnan(te)] = 0
+
+    return {
+        'job_type': np.array(job_types, dtype=str),
+        'instance': np.array(instances, dtype=str),
+        'run_time': run_times,
+        'timestamp': np.array(timestamps, dtype=str),
+        'queue': np.array(queues, dtype=str),
+        'queue_time': ts - tq,
+        'params_hash': np.array(fingerprints, dtype=str)
+    }
+
+def create_backup_table(table_name, period=None, backend=None):
     """ Create a SQL database to store job information
 
     Parameters
     ----------
     table_name : str
         Name of SQL database on disk
+
+    period : str
+        Partition job_times by year, month or day into a directory of files,
+        None for a single file
+
+    backend : str
+        Storage backend (sqlite or columnar), defaults to ETC_STORAGE or sqlite
     
     Returns
     -------
@@ -68,109 +179,226 @@ def create_backup_table(table_name):
     """
 
     if not os.path.exists(table_name):
-        db = SQLDatabase()
+        db = get_database(table_name, period=period, backend=backend)
 
         db.create_db(table_name)
 
-        columns = ("uid integer primary key autoincrement, job_type text, "
-                   "instance text, run_time real, timestamp datetime, data text")
-
-        db.create_table('job_times', columns=columns)
+        db.create_table('job_times', columns=JOB_COLUMNS)
+        db.create_table(STATS_TABLE, columns=STATS_COLUMNS)
+        db.create_table(WAIT_TABLE, columns=WAIT_COLUMNS)
+        db.create_table(PARAMS_TABLE, columns=PARAMS_COLUMNS)
+        db.create_table(CURSOR_TABLE, columns=CURSOR_COLUMNS)
         db.close()
     else:
         print(f"Database already exists: {table_name}")
 
 
-def populate_backup_table(table_name):
+def migrate_job_times(db):
+    """ Add the columns job_times gained since a database was created
+
+    Jobs ingested before multi-cluster ingest belong to the default cluster,
+    their queue and queue time are unknown (null), jobs ingested before
+    params fingerprints have none (empty).
+    """
+    columns = db.table_column_name("job_times") or []
+    for name, definition in JOB_MIGRATIONS:
+        if name not in columns:
+            print(f"Adding column {definition} to job_times")
+            db.add_column("job_times", definition)
+
+def fetch_pages(cluster, start_timestamp, pages, size=1000):
+    """ Page through the new jobs of one cluster, putting parsed pages on a queue
+
+    Puts (cluster, index, jobs, stream) for every page, then (cluster, None,
+    None, error) when done, error being None or the exception that stopped it.
+    """
+    try:
+        # quick elastic search to get total number of jobs
+        jobs, total = return_jobs(jobtype="*", instance="*", size=1, verbose=True, start_idx=0,
+                                  start_timestamp=start_timestamp, return_total=True, cluster=cluster)
+
+        # loop over all the jobs in es
+        for i in range(0, total['value'], size):
+            # query to get jobs, decoded one hit at a time
+            stream = search_jobs(jobtype="*", instance="*", size=size, start_idx=i,
+                                 start_timestamp=start_timestamp, cluster=cluster)
+            pages.put((cluster, i, parse_jobs(stream), stream))
+        pages.put((cluster, None, None, None))
+    except Exception as err:
+        pages.put((cluster, None, None, err))
+
+def prepare_ingest(db, clusters):
+    """ Create and migrate the tables of an ingest, returns the cursor of every cluster """
+    db.create_table(STATS_TABLE, columns=STATS_COLUMNS) # older databases
+    db.create_table(WAIT_TABLE, columns=WAIT_COLUMNS)
+    db.create_table(PARAMS_TABLE, columns=PARAMS_COLUMNS)
+    migrate_job_times(db)
+    cursors = load_cursors(db, [cluster.name for cluster in clusters])
+
+    # partitioned and columnar databases commit job_times before the cursor, rows
+    # past it are left by an interrupted page and are ingested again with it
+    for source, cursor in cursors.items():
+        if db.count_rows("job_times", "*", "source = ? AND timestamp > ?", [source, cursor]) > 0:
+            print(f"Removing the rows of an interrupted ingest from {source} after {cursor}")
+            db.delete_records("job_times", "source = ? AND timestamp > ?", [source, cursor])
+    return cursors
+
+def insert_page(db, source, jobs, half_life=HALF_LIFE):
+    """ Insert the new jobs of a page and fold them into the statistics, all in one transaction
+
+    Parameters
+    ----------
+    db : StorageBackend
+        Database opened for writing
+
+    source : str
+        Cluster the jobs were read from
+
+    jobs : dict
+        Arrays of parse_jobs
+
+    half_life : float
+        Half-life in days of the time-decayed run time statistics
+
+    Returns
+    -------
+    inserted : int
+        Number of jobs that were not in the database yet
+    """
+    # the rows, statistics and cursor of a page are committed together
+    with db.transaction():
+        # the page is ingested, jobs without a run time included
+        if len(jobs['timestamp']) > 0:
+            save_cursor(db, source, max(jobs['timestamp'].tolist()))
+
+        # mask out zero values
+        zmask = jobs['run_time'] == 0
+        run_times = jobs['run_time'][~zmask]
+        instances = jobs['instance'][~zmask]
+        job_types = jobs['job_type'][~zmask]
+        timestamp = jobs['timestamp'][~zmask]
+        queues = jobs['queue'][~zmask]
+        queue_times = jobs['queue_time'][~zmask]
+        fingerprints = jobs['params_hash'][~zmask]
+        if len(timestamp) == 0:
+            return 0
+
+        # jobs of this cluster already stored in the time range of the page
+        existing = set(db.table_query("job_times", "timestamp, job_type, instance",
+                                      "timestamp >= ? AND timestamp <= ? AND source = ?",
+                                      [min(timestamp.tolist()), max(timestamp.tolist()), source]) or [])
+
+        inserted, rows = [], []
+        for j in range(len(timestamp)):
+            key = (timestamp[j], job_types[j], instances[j])
+            if key not in existing:
+                existing.add(key)
+                rows.append((job_types[j], instances[j], float(run_times[j]), timestamp[j], source, queues[j],
+                             None if np.isnan(queue_times[j]) else float(queue_times[j]), fingerprints[j]))
+                inserted.append(j)
+
+        db.insert_many("job_times", ["job_type", "instance", "run_time", "timestamp", "source", "queue", "queue_time",
+                                      "params_hash"], rows)
+
+        # fold the new jobs into the time-decayed statistics, shared by all clusters
+        update_decayed_stats(db, job_types[inserted], instances[inserted],
+                             run_times[inserted], timestamp[inserted], half_life=half_life)
+        update_wait_sketches(db, job_types[inserted], queues[inserted], queue_times[inserted])
+        update_params_sketches(db, job_types[inserted], instances[inserted], fingerprints[inserted], run_times[inserted])
+        return len(inserted)
+
+def populate_backup_table(table_name, half_life=HALF_LIFE, period=None, backend=None, clusters=None):
     """ Populate SQL database with job information
     
+    Every cluster is paged through on its own thread from its own cursor (the
+    latest timestamp ingested from it, kept in the ingest_cursors table so
+    rolled up clusters are not ingested again). All writes go through one
+    DatabaseWriter and the rows, statistics and cursor of a page are committed
+    together (db.transaction), so readers of the database are not blocked
+    during the ingest and never see half a page.
+
     Parameters
     ----------
     table_name : str
         Name of SQL database on disk
+
+    half_life : float
+        Half-life in days of the time-decayed run time statistics
+
+    period : str
+        Partition period (year, month or day) if the database has to be created
+
+    backend : str
+        Storage backend (sqlite or columnar) if the database has to be created
+
+    clusters : list of clusters.Cluster
+        Clusters to ingest, defaults to the ones in ETC_CLUSTERS (clusters.json)
     
     Returns
     -------
 
     """
+    start = time.perf_counter()
+    if clusters is None:
+        clusters = load_clusters(CLUSTERS_FILE, endpoint=default_es_endpoint)
+
     # if table does not exist, create it
     if not os.path.exists(table_name):
-        create_backup_table(table_name)
-
-    # query for most recent timestamp
-    db = SQLDatabase()
-    db.open(table_name)
-    rows = db.table_query("job_times", "MAX(timestamp)", "", [])
-    if len(rows) > 0:
-        recent_timestamp = rows[0][0]
-    else:
-        recent_timestamp = "2020-01-01T00:00:00"
-    db.close()
-
-    # quick elastic search to get total number of jobs
-    jobs, total = return_jobs(jobtype="*", instance="*", size=1, verbose=True,
-                              start_idx=0, start_timestamp=recent_timestamp,
-                              return_total=True)
-
-    # loop over all the jobs in es 
-    for i in range(0,total['value'],1000):
-        
-        # query to get jobs
-        jobs = return_jobs(jobtype="*", instance="*", verbose=False, 
-                           size=1000, start_idx=i, return_total=False)
-
-        # compute queued, started and completed time for each
-        for job in jobs:
-            try:
-                tq = Time(job['_source']['job']['job_info']['time_queued'])
-                ts = Time(job['_source']['job']['job_info']['time_start'])
-                te = Time(job['_source']['job']['job_info']['time_end'])
-
-                job['queue_time'] = ts.jd - tq.jd # queue time
-                job['run_time'] = te.jd - ts.jd # run time
-            except:
-                job['queue_time'] = 0
-                job['run_time'] = 0
-
-        print(i, jobs[0]['_source']['@timestamp'], jobs[-1]['_source']['@timestamp'])
-
-        # extract job information
-        run_times = np.array([job['run_time'] for job in jobs])
-        instances = np.array([job['_source']['job']['job_info'].get('facts',{}).get('ec2_instance_type','') for job in jobs])
-        job_types = np.array([job['_source']['type'] for job in jobs])
-        timestamp = np.array([job['_source']['@timestamp'] for job in jobs])
-
-        params = []
-        for j, job in enumerate(jobs):
-            if zmask[j]:
+        create_backup_table(table_name, period=period, backend=backend)
+
+    with DatabaseWriter(table_name) as writer:
+        # query for most recent timestamp of every cluster
+        cursors = writer.call(prepare_ingest, clusters)
+        for cluster in clusters:
+            print(f"{cluster.name}: jobs after {cursors[cluster.name]} from {cluster.endpoint}")
+
+        pages = queue.Queue(maxsize=PAGE_QUEUE*len(clusters))
+        for cluster in clusters:
+            threading.Thread(target=fetch_pages, args=(cluster, cursors[cluster.name], pages),
+                             name=f"ingest-{cluster.name}", daemon=True).start()
+
+        running, errors, writes = len(clusters), [], []
+        while running > 0:
+            cluster, i, jobs, stream = pages.get()
+            if i is None:
+                running -= 1
+                if stream is not None:
+                    print(f"{cluster.name}: ingest failed: {stream}")
+                    errors.append(stream)
                 continue
-            try:
-                params.append(json.dumps(job['_source']['job']['params']['job_specification']['params']))
-            except:
-                params.append("")
 
-        # insert jobs into database
-        db.open(table_name)
-        for j in range(len(timestamp)):
+            if len(jobs['timestamp']) == 0:
+                print(cluster.name, i, "no jobs returned, status", stream.status_code)
+                continue
 
-            # check for duplicate before inserting
-            count = db.count_rows("job_times", "*", 
-                            "timestamp = ? AND job_type = ? AND instance = ?", 
-                            [timestamp[j], job_types[j], instances[j]])
+            print(cluster.name, i, jobs['timestamp'][0], jobs['timestamp'][-1],
+                  f"{stream.bytes/1024:.0f} kB received, {stream.peak_buffer/1024:.0f} kB buffered, peak rss {peak_rss_mb():.0f} MB")
 
-            if count == 0:
-                db.insert_records("job_times",
-                                  {"job_type":job_types[j], "instance":instances[j], 
-                                  "run_time":run_times[j], "timestamp":timestamp[j]}) 
-                                  #"params":params[j]} )
+            # insert jobs into database
+            writes.append(writer.submit(insert_page, cluster.name, jobs, half_life))
 
-        db.close()
+        ninserted = sum(write.result() for write in writes)
+
+        # summary for the web server's /metrics
+        elapsed = time.perf_counter() - start
+        print(f"Inserted {ninserted} jobs in {elapsed:.1f} s")
+        writer.call(record_ingest, elapsed, ninserted)
+
+    if len(errors) > 0:
+        raise errors[0]
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--sqldb', default='job.db', type=str, help='SQLite database file')
+    parser.add_argument('--sqldb', default='job.db', type=str, help='SQLite database file, or partitioned or columnar database directory')
+    parser.add_argument('--partition', default=None, choices=['year', 'month', 'day'], help='Create a new database partitioned by this period')
+    parser.add_argument('--backend', default=None, choices=BACKENDS, help='Storage backend of a new database, defaults to ETC_STORAGE or sqlite')
+    parser.add_argument('--clusters', default=CLUSTERS_FILE, type=str, help='JSON file of the elastic search clusters to ingest, see clusters.example.json')
     parser.add_argument('--cadence', default=0, type=float, help='Cadence in days')
+    parser.add_argument('--half_life', default=HALF_LIFE, type=float, help='Half-life of decayed run time statistics in days')
+    parser.add_argument('--predictions', default=PREDICTIONS_DIR, type=str, help='Directory of the precomputed prediction tables')
+    parser.add_argument('--no_predictions', action='store_true', default=False, help='Do not build a new prediction table after the ingest')
+    parser.add_argument('--rebuild_stats', action='store_true', default=False, help='Recompute decayed statistics, queue time and params sketches from all jobs, e.g. after changing the half-life')
     return  parser.parse_args()
 
 
@@ -178,7 +406,16 @@ if __name__ == '__main__':
     args = parse_args()
     status = 0
     try:
-        populate_backup_table(args.sqldb)
+        if args.rebuild_stats and os.path.exists(args.sqldb):
+            with DatabaseWriter(args.sqldb) as writer:
+                writer.call(migrate_job_times)
+                writer.call(rebuild_decayed_stats, half_life=args.half_life)
+                writer.call(rebuild_wait_sketches)
+                writer.call(rebuild_params_sketches)
+        populate_backup_table(args.sqldb, half_life=args.half_life, period=args.partition, backend=args.backend,
+                              clusters=load_clusters(args.clusters, endpoint=default_es_endpoint))
+        if not args.no_predictions:
+            materialize(args.sqldb, args.predictions)
     except Exception as e:
         status = 1
         with open('_alt_error.txt', 'w') as f:
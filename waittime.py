@@ -0,0 +1,113 @@
+import numpy as np
+
+from rollup import NBINS, MIN_RUNTIME, BINS_PER_DECADE, encode_counts, decode_counts, key_counts, load_key_counts
+
+# log-spaced histograms of queue times per job type and queue, updated at ingest.
+# A quantile is read within its bin, so it is off by at most one bin (~4.7%).
+WAIT_TABLE = "wait_sketches"
+WAIT_COLUMNS = ("job_type text, queue text, counts text, total integer, "
+                "PRIMARY KEY (job_type, queue)")
+
+QUANTILES = (50, 90, 99)
+
+
+def update_wait_sketches(db, job_types, queues, queue_times):
+    """ Add the queue times of newly ingested jobs to the persisted sketches
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database with a wait_sketches table
+
+    job_types : array of str
+        Job type of each new job
+
+    queues : array of str
+        Queue each job was submitted to
+
+    queue_times : array of float
+        Time from queued to started in days, NaN when unknown
+    """
+    queue_times = np.asarray(queue_times, dtype=float)
+    known = ~np.isnan(queue_times)
+    if not known.any():
+        return
+
+    job_types = np.asarray(job_types, dtype=str)[known]
+    keys = np.char.add(np.char.add(job_types, "\x1f"), np.asarray(queues, dtype=str)[known])
+    ukeys, inverse = np.unique(keys, return_inverse=True)
+    counts = key_counts(inverse, queue_times[known], len(ukeys))
+    stored = load_key_counts(db, WAIT_TABLE, ["job_type", "queue"], job_types.tolist())
+
+    records = []
+    for key, key_count in zip(ukeys.tolist(), counts):
+        job_type, queue = key.split("\x1f")
+        total = key_count + stored.get((job_type, queue), 0)
+        records.append({'job_type': job_type, 'queue': queue, 'counts': encode_counts(total),
+                        'total': int(total.sum())})
+
+    db.replace_records(WAIT_TABLE, records)
+
+def rebuild_wait_sketches(db):
+    """ Recompute all sketches from the job_times table
+
+    Parameters
+    ----------
+    db : SQLDatabase
+        Open database
+    """
+    db.create_table(WAIT_TABLE, columns=WAIT_COLUMNS)
+    db.delete_records(WAIT_TABLE, "1=1", [])
+    data = db.column_query("job_times", ["job_type", "queue", "queue_time"], "queue_time >= 0", [])
+    if len(data["queue_time"]) > 0:
+        update_wait_sketches(db, data["job_type"].astype(str), data["queue"].astype(str),
+                             data["queue_time"].astype(float))
+
+def load_wait_sketch(db, jobtype="*", queue="*"):
+    """ Sum of the sketches of a job type and queue, * matches any
+
+    Returns
+    -------
+    counts : np.ndarray
+        Jobs per log-spaced queue time bin, all zeros when nothing matches
+    """
+    counts = np.zeros(NBINS, dtype=np.int64)
+    if (WAIT_TABLE,) not in (db.table_names or []):
+        return counts
+
+    terms, values = [], []
+    for column, value in (("job_type", jobtype), ("queue", queue)):
+        if value != "*":
+            terms.append(column + "=?")
+            values.append(value)
+    for row in db.table_query(WAIT_TABLE, "counts", " AND ".join(terms), values):
+        counts += decode_counts(row[0])
+    return counts
+
+def sketch_quantiles(counts, quantiles=QUANTILES):
+    """ Quantiles of a sketch, interpolated log-linearly within their bin
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Jobs per bin
+
+    quantiles : list of float
+        Percentiles between 0 and 100
+
+    Returns
+    -------
+    values : np.ndarray
+        Queue time of every quantile in days, NaN for an empty sketch
+    """
+    counts = np.asarray(counts, dtype=float)
+    total = counts.sum()
+    if total == 0:
+        return np.full(len(quantiles), np.nan)
+
+    cumulative = np.cumsum(counts)
+    ranks = np.asarray(quantiles, dtype=float) / 100. * total
+    idx = np.minimum(np.searchsorted(cumulative, ranks, side='left'), NBINS - 1)
+    below = cumulative[idx] - counts[idx]
+    frac = np.clip((ranks - below) / np.maximum(counts[idx], 1), 0, 1)
+    return MIN_RUNTIME * 10**((idx + frac) / BINS_PER_DECADE)
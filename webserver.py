@@ -1,19 +1,209 @@
-from subprocess import Popen
-from flask import Flask, request
+import time
+_import_start = time.perf_counter()
+
+from functools import wraps
+from flask import Flask, Response, g, request, make_response, stream_with_context
 import argparse
-import psutil
+import hashlib
 import json
+import gzip
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-from model import runtime_prediction, queuetime_prediction
+import metrics
+from profiling import RequestProfile
+import numpy as np
+
+from model import runtime_prediction, decayed_prediction, estimate_time_to_complete, \
+    instance_runtime_prediction, grouped_runtime_prediction, get_clusters, waittime_prediction, params_prediction
+from param_stats import MIN_MODE_JOBS, params_fingerprint
+from singleflight import SingleFlight
+from queueestimate import queuetime_prediction
+from predictions import PredictionTable
+from waittime import QUANTILES
+import queuestream
+from pricing import PriceTable, MARKETS, pareto_front
+from sql_database import get_database
+from startup import WARMUP_KEYS, Warmup
+from stats_report import TOP, runtime_report
+from runningjobs import RunningJobIndex
 
 app = Flask(__name__)
 
-instance2cost = {
-    # unit cost per hour
-    'c5.9xlarge': 0.,
-}
+# admin flag, per-request profiling is refused unless set
+app.config['PROFILING'] = os.environ.get('ETC_PROFILING', '0') == '1'
+
+# days between ingest runs, estimates from the database can be cached this long
+app.config['CADENCE'] = float(os.environ.get('ETC_CADENCE', 1/24.))
+
+# responses larger than this are gzipped for clients that accept it
+GZIP_MIN_BYTES = 1024
+
+SQLDB = 'job.db'
+
+# unit cost per hour, reloaded when prices.json changes
+prices = PriceTable()
+
+# precomputed run time predictions, swapped in when update.py builds a new version
+prediction_table = PredictionTable().start()
+
+# /stats reports per (instance, source), recomputed when the database changes
+stats_reports = {}
+
+# seconds spent importing this module, reported by /ready
+IMPORT_SECONDS = time.perf_counter() - _import_start
+
+def json_bytes(data):
+    ''' JSON encoded with orjson when it is installed '''
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+def json_response(data):
+    return Response(json_bytes(data), content_type='application/json')
+
+def data_generation(*paths):
+    '''
+    Token that changes whenever one of the files changes, directories
+    (partitioned or columnar databases) change with any file they hold.
+    '''
+    stamps = []
+    for path in paths:
+        files = [path, path + '-wal']
+        if os.path.isdir(path):
+            files = [entry.path for entry in os.scandir(path)]
+        for name in sorted(files):
+            try:
+                stat = os.stat(name)
+            except OSError:
+                continue
+            stamps.append(f"{name}:{stat.st_mtime_ns}:{stat.st_size}")
+    return ";".join(stamps)
+
+def cached(generation=None):
+    '''
+    Conditional GET for a route. With generation (a function returning a
+    token of the data the route answers from, e.g. database_generation) the
+    ETag is derived from it and the query, so a matching If-None-Match
+    returns 304 before the model runs, and clients may reuse the response for
+    one ingest cadence. Without generation the ETag is a hash of the body and
+    clients must revalidate.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if 'profile' in g:
+                return view(*args, **kwargs)
+
+            query = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+            if generation is not None:
+                key = f"{request.path}?{query}|{generation()}"
+                etag = hashlib.sha1(key.encode()).hexdigest()[:20]
+                cache_control = f"public, max-age={int(app.config['CADENCE']*24*60*60)}"
+                if request.if_none_match.contains_weak(etag):
+                    metrics.cache_lookup('http_etag', True)
+                    response = Response(status=304)
+                    response.set_etag(etag, weak=True)
+                    response.headers['Cache-Control'] = cache_control
+                    return response
+
+            response = make_response(view(*args, **kwargs))
+            if generation is None:
+                etag = hashlib.sha1(response.get_data()).hexdigest()[:20]
+                cache_control = "no-cache"
+                if request.if_none_match.contains_weak(etag):
+                    response = Response(status=304)
+            metrics.cache_lookup('http_etag', response.status_code == 304)
+
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapper
+    return decorator
+
+def coalesced(name, when=None):
+    '''
+    Concurrent identical requests (same path and query) wait for the one in
+    flight and get a copy of its response instead of repeating the
+    elastic search and model work. when(args) restricts coalescing to the
+    requests worth it, e.g. wildcard queries.
+    '''
+    group = SingleFlight(name)
+    def decorator(view):
+        def compute():
+            response = make_response(view())
+            return response.get_data(), response.status_code, response.headers.to_wsgi_list()
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if 'profile' in g or (when is not None and not when(request.args)):
+                return view(*args, **kwargs)
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            (body, status, headers), _ = group.do(key, compute)
+            return Response(body, status=status, headers=headers)
+        return wrapper
+    return decorator
+
+def has_wildcard(args):
+    return any('*' in args.get(name, '') for name in ('jobtype', 'instance'))
+
+def database_generation():
+    # the prediction table version actually served, current.json on disk can be
+    # ahead of it until the loader thread picks the new version up
+    return f"{data_generation(SQLDB)}|predictions:{prediction_table.version}"
+
+def pricing_generation():
+    # prices.json is re-read by the request itself when it changes
+    return f"{database_generation()}|{data_generation(prices.path)}"
+
+def runtime_stats(jobtype, instance, source=None):
+    '''
+    runtime_prediction from the precomputed table, or from the database
+    for keys the table does not have (e.g. before the first build). The
+    table merges all clusters, a single source is read from the database.
+    '''
+    if source is not None:
+        return runtime_prediction(jobtype, instance, source=source)
+    stats = prediction_table.lookup(jobtype, instance)
+    metrics.cache_lookup('prediction_table', stats is not None)
+    if stats is not None:
+        return stats[:4]
+    return runtime_prediction(jobtype, instance)
+
+def grouped_runtime_stats(jobtypes, instance):
+    ''' runtime_stats of several job types, the ones missing from the table are read with one query '''
+    stats, missing = {}, []
+    for jobtype in jobtypes:
+        row = prediction_table.lookup(jobtype, instance)
+        metrics.cache_lookup('prediction_table', row is not None)
+        if row is None:
+            missing.append(jobtype)
+        else:
+            stats[jobtype] = row[:4]
+    if len(missing) > 0:
+        stats.update(grouped_runtime_prediction(missing, instance, sqldb=SQLDB))
+    return stats
+
+# running jobs of every cluster for /eta, synced by the first request
+running_jobs = RunningJobIndex(predict=grouped_runtime_stats)
+
+def cluster_names():
+    return [cluster.name for cluster in get_clusters()]
+
+def warm_key(jobtype, instance):
+    ''' Read the run times of a key once so its database pages are cached '''
+    runtime_prediction(jobtype, instance, sqldb=SQLDB)
+
+# preloads the busiest keys before /ready reports healthy, see startup.py
+warmup = Warmup(warm_key, SQLDB).start(WARMUP_KEYS)
 
 def check_for_process(cmd):
+    # only the update route needs psutil, it is not imported at startup
+    import psutil
     # https://psutil.readthedocs.io/en/latest/#psutil.Process.as_dict
     adict = {}
     for p in psutil.process_iter(['name','cmdline']):
@@ -27,11 +217,123 @@ def check_for_process(cmd):
                 return pdict
     return None
 
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.before_request
+def start_profile():
+    mode = request.args.get('profile', request.headers.get('X-Profile'))
+    if mode in (None, '', '0'):
+        return
+    if not app.config['PROFILING']:
+        return 'Profiling is disabled, start the server with --profiling\n', 403
+
+    g.profile = RequestProfile()
+    g.profile_mode = mode
+    try:
+        g.profile.__enter__()
+    except RuntimeError as err:
+        g.pop('profile')
+        return f'{err}, try again\n', 409
+
+@app.after_request
+def compress(response):
+    '''
+    Gzip large responses (e.g. /completiontime with every running job) for
+    clients that accept it. Registered first so it runs after the other hooks.
+    '''
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed or
+            'Content-Encoding' in response.headers or
+            'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+
+    response.set_data(gzip.compress(body, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def stop_profile(response):
+    '''
+    Attach the profile of the request, ?profile=1 returns the breakdown with
+    the response and ?profile=store only writes it to disk.
+    '''
+    if 'profile' not in g:
+        return response
+
+    g.profile.stop()
+    path = g.profile.dump(request.full_path)
+    if g.profile_mode == 'store' or response.is_streamed:
+        response.headers['X-Profile-File'] = path
+        return response
+
+    body = response.get_data(as_text=True)
+    try:
+        body = json.loads(body)
+    except ValueError:
+        pass
+    return Response(json.dumps({'response': body, 'profile': g.profile.summary(), 'file': path}),
+                    status=response.status_code, content_type='application/json')
+
+@app.after_request
+def record_latency(response):
+    if 'start_time' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.http_request_duration.observe(time.perf_counter() - g.start_time,
+            route=route, method=request.method, status=response.status_code)
+    return response
+
+def collect_ingest_metrics():
+    # ingest runs in its own process (update.py) and leaves a summary in the database
+    db = get_database(SQLDB)
+    db.open(SQLDB, readonly=True)
+    if db.isConnected:
+        metrics.load_ingest_metrics(db)
+        db.close()
+
+metrics.REGISTRY.add_collector(collect_ingest_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    '''
+     """ Prometheus metrics: request latency, SQLite and elastic search timings,
+            ingest rate and cache hit ratios.
+
+        Example:
+            curl "localhost:5000/metrics"
+    '''
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    '''
+     """ Readiness probe, 503 until the warm-up (--warmup or ETC_WARMUP)
+            has preloaded the most frequent job keys.
+
+        Example:
+            curl "localhost:5000/ready"
+    '''
+    status = dict(warmup.status(), import_seconds=round(IMPORT_SECONDS, 3),
+                  prediction_table=prediction_table.version)
+    response = json_response(status)
+    response.status_code = 200 if warmup.ready else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/update', methods=['GET'])
 def update():
     '''
     Launch a subprocess that adds new jobs to the model database.
     '''
+    return json_response(launch_update())
+
+def launch_update():
+    ''' Start update.py unless it is running, returns its pid and what was done '''
     UPDATE_CMD = "python update.py"
     jdata = {} # json data to return
 
@@ -42,54 +344,110 @@ def update():
         jdata['pid'] = proc['pid']
     else:
         # may vary depending on the machine
+        from subprocess import Popen
         p = Popen(UPDATE_CMD.split(' '))
         message = "process launched"
         jdata['pid'] = check_for_process(cmd=UPDATE_CMD)['pid']
 
     jdata['message'] = message
-    return json.dumps(jdata)
+    return jdata
 
 @app.route('/runtime', methods=['GET'])
+@cached(database_generation)
+@coalesced('/runtime', when=has_wildcard)
 def run_times():
     '''
      """ Query for the runtime of a process, must provide a process name and instance type. 
 
+        Use weighting=decayed to favour recent jobs over old ones and
+        source=<cluster> to only use the jobs of one cluster. With the
+        job's parameters (params=<JSON object>, or their fingerprint=<hash>)
+        the estimate comes from the jobs that ran with the same parameters,
+        or from the job type when there are too few of them.
+
         Example:
             curl "localhost:5000/runtime?jobtype=job-standard*&instance=*"
+            curl "localhost:5000/runtime?jobtype=job-standard*&instance=*&weighting=decayed"
+            curl -G "localhost:5000/runtime?jobtype=job-standard-product-s1gunw-topsapp:develop&instance=*" \
+                --data-urlencode 'params={"bbox": [1, 2]}'
     '''
     jobtype = request.args.get('jobtype')
     instance = request.args.get('instance')
+    weighting = request.args.get('weighting', 'uniform')
+    source = request.args.get('source')
+    params = request.args.get('params')
+    fingerprint = request.args.get('fingerprint')
     if jobtype == None or instance == None:
         return f'Please specify jobtype ({jobtype}) and instance ({instance})\n'
+    if source is not None and source not in cluster_names():
+        return f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n'
+    if params is not None:
+        try:
+            params = json.loads(params)
+        except ValueError:
+            params = None
+        if not isinstance(params, dict):
+            return f'Invalid params ({request.args["params"]}), use a JSON object of the job parameters\n'
+        fingerprint = params_fingerprint(params)
 
-    mean,stdev,_,_ = runtime_prediction(jobtype, instance)
+    # the parameter modes merge all clusters, like the precomputed table
+    mode = None
+    if fingerprint and weighting == 'uniform' and source is None and '*' not in jobtype:
+        *stats, count = params_prediction(jobtype, instance, fingerprint, sqldb=SQLDB)
+        if count >= MIN_MODE_JOBS:
+            mode = stats
+
+    if mode is not None:
+        mean,stdev,_,_ = mode
+    elif weighting == 'decayed' and source is None:
+        mean,stdev,_ = decayed_prediction(jobtype, instance)
+    elif weighting == 'decayed':
+        return f'Decayed statistics merge all clusters, remove source ({source})\n'
+    elif weighting == 'uniform':
+        mean,stdev,_,_ = runtime_stats(jobtype, instance, source)
+    else:
+        return f'Unknown weighting ({weighting}), use uniform or decayed\n'
 
     jdata = {
         'name': jobtype,
         'instance': instance,
+        'source': source or '*',
         'mean': f"{mean*24*60*60:.2f}",
         'stdev': f"{stdev*24*60*60:.2f}",
         'units': 'seconds'
     }
-    return json.dumps(jdata)
+    if fingerprint:
+        jdata['params'] = fingerprint
+        jdata['mode'] = 'params' if mode is not None else 'job_type'
+    return json_response(jdata)
 
 @app.route('/runcost', methods=['GET'])
+@cached(pricing_generation)
 def run_cost():
     '''
      """ Query for the runtime of a process and estimate its cost based on the instance, 
             must provide a process name and instance type. 
 
+        Optionally price with market=spot instead of on_demand.
+
         Example:
             curl "localhost:5000/runcost?jobtype=job-standard*&instance=*"
     '''
     jobtype = request.args.get('jobtype')
     instance = request.args.get('instance')
-    unitcost = instance2cost.get(instance, 0)
+    market = request.args.get('market', 'on_demand')
+    source = request.args.get('source')
 
     if jobtype == None or instance == None:
         return f'Please specify jobtype ({jobtype}) and instance ({instance})\n'
+    if market not in MARKETS:
+        return f'Unknown market ({market}), use on_demand or spot\n'
+    if source is not None and source not in cluster_names():
+        return f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n'
+
+    unitcost = prices.get(instance, market)
 
-    mean,stdev,_,_ = runtime_prediction(jobtype, instance)
+    mean,stdev,_,_ = runtime_stats(jobtype, instance, source)
 
     jdata = {
         'name': jobtype,
@@ -98,9 +456,141 @@ def run_cost():
         'stdev': f"{stdev*24*unitcost:.2f}",
         'units': 'USD'
     }
-    return json.dumps(jdata)
+    return json_response(jdata)
+
+@app.route('/recommend', methods=['GET'])
+@cached(pricing_generation)
+def recommend():
+    '''
+     """ Runtime and cost of a job type on every instance it has run on,
+            with the pareto front of the fastest and cheapest options.
+
+        Example:
+            curl "localhost:5000/recommend?jobtype=job-standard-product-s1gunw-topsapp:develop"
+    '''
+    jobtype = request.args.get('jobtype')
+    source = request.args.get('source')
+    if jobtype == None:
+        return f'Please specify jobtype ({jobtype})\n'
+    if source is not None and source not in cluster_names():
+        return f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n'
+
+    stats = prediction_table.instances(jobtype) if source is None else None
+    if source is None:
+        metrics.cache_lookup('prediction_table', stats is not None)
+    if stats is None:
+        stats = instance_runtime_prediction(jobtype, source=source)
+    options = []
+    for instance, (mean, stdev, _, _, count) in stats.items():
+        for market in MARKETS:
+            unitcost = prices.get(instance, market, default=None)
+            if unitcost is None:
+                continue
+            options.append({
+                'instance': instance,
+                'market': market,
+                'runtime': mean*24*60*60,
+                'runtime_stdev': stdev*24*60*60,
+                'cost': mean*24*unitcost,
+                'count': count
+            })
+
+    front = pareto_front(options)
+    def fmt(option):
+        return {**option, 'runtime': f"{option['runtime']:.2f}", 'runtime_stdev': f"{option['runtime_stdev']:.2f}",
+                'cost': f"{option['cost']:.4f}"}
+
+    rdata = {
+        'name': jobtype,
+        'options': [fmt(o) for o in sorted(options, key=lambda o: o['runtime'])],
+        'pareto': [fmt(o) for o in front],
+        'unpriced': sorted(inst for inst in stats if inst not in prices.prices),
+        'units': {'runtime': 'seconds', 'cost': 'USD'}
+    }
+    return json_response(rdata)
+
+@app.route('/waittime', methods=['GET'])
+@cached(database_generation)
+def wait_times():
+    '''
+     """ Query for how long a job type waits in a queue before it starts,
+            from the queue times of past jobs. Either can be *.
+
+        Example:
+            curl "localhost:5000/waittime?jobtype=job-standard-product-s1gunw-topsapp:develop&queue=*"
+    '''
+    jobtype = request.args.get('jobtype')
+    queue = request.args.get('queue', '*')
+    if jobtype == None:
+        return f'Please specify jobtype ({jobtype})\n'
+
+    waits, count = waittime_prediction(jobtype, queue)
+
+    wdata = {
+        'name': jobtype,
+        'queue': queue,
+        'count': count,
+        'units': 'seconds'
+    }
+    if count > 0:
+        for q, wait in zip(QUANTILES, waits*24*60*60):
+            wdata[f'p{q}'] = f"{wait:.2f}"
+    return json_response(wdata)
+
+@app.route('/stats', methods=['GET'])
+@cached(database_generation)
+@coalesced('/stats')
+def stats():
+    '''
+     """ Run time statistics of the most popular job types on an instance:
+            the model estimate next to the observed distribution.
+
+        Example:
+            curl "localhost:5000/stats?instance=c5.9xlarge&top=25"
+    '''
+    instance = request.args.get('instance', '*')
+    source = request.args.get('source')
+    try:
+        top = int(request.args.get('top', TOP))
+    except ValueError:
+        return f'Invalid top ({request.args["top"]}), use a number of job types\n'
+    if source is not None and source not in cluster_names():
+        return f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n'
+
+    # one report serves every top, it is rebuilt after each ingest
+    generation = data_generation(SQLDB)
+    cached_report = stats_reports.get((instance, source))
+    metrics.cache_lookup('stats_report', cached_report is not None and cached_report[0] == generation)
+    if cached_report is None or cached_report[0] != generation:
+        cached_report = stats_reports[(instance, source)] = (generation, runtime_report(SQLDB, instance, source))
+    rows = cached_report[1]
+
+    def fmt(row):
+        seconds = lambda days: f"{days*24*60*60:.2f}"
+        return {
+            'name': row['job_type'],
+            'count': row['count'],
+            'mean': seconds(row['run_avg']),
+            'stdev': seconds(row['run_std']),
+            'low': seconds(row['run_low']),
+            'high': seconds(row['run_high']),
+            'perr': f"{row['perr']:.1f}",
+            'observed': {name: seconds(value) for name, value in row['observed'].items()}
+        }
+
+    sdata = {
+        'instance': instance,
+        'source': source or '*',
+        'njobtypes': len(rows),
+        'njobs': sum(row['count'] for row in rows),
+        'jobs': [fmt(row) for row in rows[:max(top, 0)]],
+        'units': 'seconds'
+    }
+    return json_response(sdata)
 
 @app.route('/queuetime', methods=['GET'])
+@cached()
+@coalesced('/queuetime')
 def queue_times():
     '''
      """ Query for the wait time of jobs the queue, must provide
@@ -111,16 +601,135 @@ def queue_times():
     '''
     size = request.args.get('size',4444)
     nodes = float(request.args.get('nodes',1))
-    qmin, qmax, njobs = queuetime_prediction(nodes=nodes, size=size)
+    source = request.args.get('source')
+    if source is not None and source not in cluster_names():
+        return f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n'
+    qmin, qmax, njobs = queuetime_prediction(nodes=nodes, size=size, source=source)
+    return json_response(queue_data(qmin, qmax, njobs, source))
 
-    qdata = {
+def queue_data(qmin, qmax, njobs, source=None):
+    ''' Body of /queuetime, times in days '''
+    return {
         'name': 'Queue Time Estimate',
+        'source': source or '*',
         'njobs': njobs,
         'min': f"{qmin:.3f}",
         'max': f"{qmax:.3f}",
         'units': 'day'
     }
-    return json.dumps(qdata)
+
+@app.route('/queuetime/stream', methods=['GET'])
+def queue_time_stream():
+    '''
+     """ Server-sent events with a new queue time estimate whenever the
+            job types in the queue change. All clients share one background
+            poller per size and source.
+
+        Example:
+            curl -N "localhost:5000/queuetime/stream?size=4444&nodes=5"
+    '''
+    size = int(request.args.get('size', 4444))
+    nodes = float(request.args.get('nodes', 1))
+    source = request.args.get('source')
+    if source is not None and source not in cluster_names():
+        return f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n'
+
+    events = queuestream.sse_events(queuestream.producer(size, source), nodes=nodes)
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/completiontime', methods=['GET'])
+@cached()
+@coalesced('/completiontime')
+def completion_times():
+    '''
+     """ Estimate the time left for every running job, optional
+            arguments are the maximum number of running jobs to look at,
+            the instance to take run times from and jobs=0 to only
+            return the aggregate percentiles.
+
+        Example:
+            curl "localhost:5000/completiontime?size=10000&instance=*&jobs=0"
+    '''
+    size = int(request.args.get('size', 10000))
+    instance = request.args.get('instance', '*')
+    per_job = request.args.get('jobs', '1') != '0'
+    source = request.args.get('source')
+    if source is not None and source not in cluster_names():
+        return f'Unknown source ({source}), use one of {", ".join(cluster_names())}\n'
+
+    estimate = estimate_time_to_complete(size=size, instance=instance, source=source)
+    return json_response(completion_data(estimate, source, per_job))
+
+@app.route('/eta', methods=['GET'])
+def eta():
+    '''
+     """ Query for when a running job will finish, from its start time and
+            the run times of its job type on its instance.
+
+        Example:
+            curl "localhost:5000/eta?job_id=job-standard-product-s1gunw-topsapp:develop-20220420T123456.789Z"
+    '''
+    job_id = request.args.get('job_id')
+    if job_id == None:
+        return f'Please specify job_id ({job_id})\n'
+
+    estimate = running_jobs.start().eta(job_id)
+    if estimate is None and running_jobs.last_resync is None:
+        return 'No cluster answered, the running jobs are unknown\n', 503
+    if estimate is None:
+        return f'Job {job_id} is not running\n'
+
+    def iso(seconds):
+        return np.datetime_as_string(np.datetime64(int(seconds*1e3), 'ms'), unit='ms') + 'Z'
+
+    edata = {
+        'job_id': job_id,
+        'name': estimate['job_type'],
+        'instance': estimate['instance'],
+        'source': estimate['source'],
+        'started': iso(estimate['start']),
+        'elapsed': f"{estimate['elapsed']:.2f}",
+        'remaining': "no history",
+        'remaining_low': "no history",
+        'remaining_high': "no history",
+        'eta': "no history",
+        'overdue': estimate['overdue'],
+        'units': 'seconds'
+    }
+    if estimate['history']:
+        edata.update({
+            'remaining': f"{estimate['remaining']:.2f}",
+            'remaining_low': f"{estimate['remaining_low']:.2f}",
+            'remaining_high': f"{estimate['remaining_high']:.2f}",
+            'eta': iso(estimate['start'] + estimate['elapsed'] + estimate['remaining'])
+        })
+    return json_response(edata)
+
+def completion_data(estimate, source=None, per_job=True):
+    ''' Body of /completiontime from estimate_time_to_complete '''
+    remaining = estimate['remaining']*24*60*60
+
+    cdata = {
+        'name': 'Completion Time Estimate',
+        'source': source or '*',
+        'njobs': len(remaining),
+        'units': 'seconds'
+    }
+    if len(remaining) > 0:
+        cdata['total'] = f"{remaining.sum():.2f}"
+        for q in (50, 90, 99):
+            cdata[f'p{q}'] = f"{np.percentile(remaining, q):.2f}"
+        cdata['max'] = f"{remaining.max():.2f}"
+
+    if per_job:
+        cdata['jobs'] = [
+            {'job_id': job_id, 'type': job_type, 'source': cluster, 'elapsed': f"{elapsed:.2f}", 'remaining': f"{left:.2f}"}
+            for job_id, job_type, cluster, elapsed, left in zip(estimate['job_id'].tolist(), estimate['job_type'].tolist(),
+                                                                estimate['source'].tolist(),
+                                                                (estimate['elapsed']*24*60*60).tolist(), remaining.tolist())
+        ]
+    return cdata
 
 
 if __name__ == '__main__':
@@ -134,8 +743,17 @@ if __name__ == '__main__':
                         help='https server port')
     parser.add_argument('--debug',action='store_true', default=False,
                         help='Debug mode')
+    parser.add_argument('--profiling',action='store_true', default=False,
+                        help='Allow per-request profiling with ?profile=1')
+    parser.add_argument('--cadence', action='store', type=float, default=app.config['CADENCE'],
+                        help='Ingest cadence in days, max-age of cached estimates')
+    parser.add_argument('--warmup', action='store', type=int, default=WARMUP_KEYS,
+                        help='Job keys to preload before /ready reports healthy, 0 to skip')
     # parse arguments
     args = parser.parse_args()
+    app.config['PROFILING'] = app.config['PROFILING'] or args.profiling
+    app.config['CADENCE'] = args.cadence
+    warmup.start(args.warmup)
 
     #app.run(debug=True)
     app.run(host='0.0.0.0', debug=True)